@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for coverme backup stages against local stand-ins.
+
+Generates synthetic directory tree and database dump, then measures
+archiving, compression and uploads for every archive format. Uploads
+go to in-process moto mock (if installed) or to local S3/Glacier
+compatible server via `--endpoint-url`.
+
+Usage:
+
+    pip install moto[s3,glacier]
+    python benchmarks/bench.py --files 200 --file-size 1M --dump-size 256M
+
+Reported for every stage: throughput in MB/s of input data, peak RSS
+of the process while stage is running and peak temp disk usage.
+
+Glacier uploads are benchmarked against moto as well, but moto
+implements only single request uploads, so Glacier stages of archives
+larger than `part_size` (64M) need a stand-in server provided via
+`--endpoint-url`.
+"""
+import os
+import sys
+import json
+import shutil
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import click
+import coverme
+
+DEFAULT_FORMATS = 'zip,gztar,bztar,xztar,zsttar,lz4tar'
+STREAM_FORMATS = 'gz,bz2,xz,zst,lz4,raw'
+
+
+class StageMonitor(object):
+    """
+    Sample peak RSS of the process and peak used space on temp file
+    system while stage is running.
+    """
+    def __init__(self, temp_dir, interval=0.05):
+        self.temp_dir = temp_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self._disk_base = _disk_used(self.temp_dir)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        self.peak_rss = max(self.peak_rss, _rss())
+        self.peak_disk = max(self.peak_disk,
+                             _disk_used(self.temp_dir) - self._disk_base)
+
+
+class Bench(object):
+    """Run stages and collect results."""
+    def __init__(self, temp_dir):
+        self.temp_dir = temp_dir
+        self.results = []
+
+    @contextmanager
+    def stage(self, name, aformat, size_in):
+        """Measure stage, body has to set `result['size_out']`."""
+        result = {'stage': name, 'format': aformat, 'size_in': size_in,
+                  'size_out': None, 'error': None}
+        started = time.time()
+        with StageMonitor(self.temp_dir) as monitor:
+            try:
+                yield result
+            except Exception as e:
+                result['error'] = str(e)
+        result['seconds'] = time.time() - started
+        result['mb_per_sec'] = (size_in / result['seconds'] / 1e6
+                                if result['seconds'] else None)
+        result['peak_rss_mb'] = monitor.peak_rss / 1e6
+        result['peak_disk_mb'] = monitor.peak_disk / 1e6
+        self.results.append(result)
+        _print_result(result)
+
+
+def make_tree(path, files, file_size, ratio, seed=0):
+    """
+    Generate directory tree with `files` files of `file_size` bytes,
+    `ratio` is share of compressible data in every file.
+    """
+    rnd = random.Random(seed)
+    text = b''.join(b'line %d of synthetic text file\n' % i
+                    for i in range(4096))
+    for i in range(files):
+        sub_dir = os.path.join(path, 'd%02d' % (i % 16))
+        coverme._smakedirs(sub_dir)
+        compressible = int(file_size * ratio)
+        random_size = file_size - compressible
+        with open(os.path.join(sub_dir, 'f%05d.bin' % i), 'wb') as fp:
+            while compressible > 0:
+                fp.write(text[:compressible])
+                compressible -= len(text)
+            if random_size:
+                fp.write(rnd.getrandbits(random_size * 8).to_bytes(
+                    random_size, 'little'))
+    return files * file_size
+
+
+def iter_dump(size, seed=0):
+    """Generate synthetic SQL dump of `size` bytes by chunks."""
+    rnd = random.Random(seed)
+    written = 0
+    while written < size:
+        chunk = ''.join(
+            "INSERT INTO items VALUES "
+            "(%d, 'item-%x', %0.2f, '2016-10-%02d');\n"
+            % (i, rnd.getrandbits(32), rnd.random() * 1000, i % 28 + 1)
+            for i in range(written, written + 4096)
+        ).encode('ascii')[:size - written]
+        written += len(chunk)
+        yield chunk
+
+
+def make_backup(temp_dir, endpoint_url=None, region='us-east-1',
+                bucket='coverme-bench', vault='coverme-bench'):
+    """Create `coverme.Backup` with S3 and Glacier vaults."""
+    common = {'region': region}
+    if endpoint_url:
+        common['endpoint_url'] = endpoint_url
+    settings = {
+        'defaults': {'tmpdir': temp_dir,
+                     'statedir': os.path.join(temp_dir, 'state')},
+        'backups': [],
+        'vaults': {
+            's3': dict(common, service='s3', name=bucket),
+            'glacier': dict(common, service='glacier', name=vault,
+                            account='-'),
+        },
+    }
+    return coverme.Backup(settings, dict(os.environ))
+
+
+def run_benchmarks(bench, backup, tree_dir, tree_size, dump_path,
+                   formats, stream_formats, upload):
+    environ = dict(os.environ)
+    dump_size = os.path.getsize(dump_path)
+    archives = []
+
+    for aformat in formats:
+        source = coverme.DirBackupSource(backup, settings={
+            'type': 'dir', 'path': tree_dir, 'format': aformat,
+            'name': 'dir-%s' % aformat}, environ=environ)
+        work_dir = tempfile.mkdtemp(dir=bench.temp_dir)
+        with bench.stage('dir archive', aformat, tree_size) as result:
+            arch_path = source.archive(work_dir)
+            result['size_out'] = os.path.getsize(arch_path)
+            archives.append((aformat, arch_path))
+
+    for aformat in formats:
+        source = coverme.PostgresqlBackupSource(backup, settings={
+            'type': 'database', 'url': 'postgres://localhost/bench',
+            'format': aformat, 'name': 'dump-%s.sql' % aformat},
+            environ=environ)
+        work_dir = tempfile.mkdtemp(dir=bench.temp_dir)
+        data_dir = source._prepare_data_path(work_dir)
+        coverme._smakedirs(data_dir)
+        shutil.copy(dump_path, os.path.join(data_dir, 'dump.sql'))
+        with bench.stage('dump archive', aformat, dump_size) as result:
+            arch_path = source._make_archive(data_dir)
+            result['size_out'] = os.path.getsize(arch_path)
+        shutil.rmtree(data_dir)
+
+    for aformat in stream_formats:
+        codec = coverme.STREAM_CODECS[aformat]
+        with bench.stage('stream compress', aformat, dump_size) as result, \
+                open(dump_path, 'rb') as fp:
+            chunks = coverme.iter_chunks(fp)
+            if codec:
+                chunks = coverme.iter_compress(chunks, codec(None, None))
+            result['size_out'] = sum(len(chunk) for chunk in chunks)
+
+    if not upload:
+        return
+    for aformat, arch_path in archives:
+        size = os.path.getsize(arch_path)
+        for key in ('s3', 'glacier'):
+            vault = backup.vaults[key]
+            with bench.stage('%s upload' % key, aformat, size) as result:
+                success, _ = vault.upload(
+                    arch_path, upload_name=os.path.basename(arch_path))
+                result['size_out'] = size if success else 0
+
+
+def _print_result(result):
+    if result['error']:
+        click.secho("%-16s %-8s error: %s" % (
+            result['stage'], result['format'], result['error']), fg='red')
+        return
+    click.echo("%-16s %-8s %10.1f MB/s %8.1f MB in %8.1f MB out "
+               "%8.1f MB RSS %8.1f MB disk" % (
+                   result['stage'], result['format'], result['mb_per_sec'],
+                   result['size_in'] / 1e6, (result['size_out'] or 0) / 1e6,
+                   result['peak_rss_mb'], result['peak_disk_mb']))
+
+
+def _rss():
+    """Get current resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _disk_used(path):
+    usage = shutil.disk_usage(path)
+    return usage.total - usage.free
+
+
+@contextmanager
+def _stand_in(endpoint_url, region, bucket, vault):
+    """Start moto mock unless external endpoint is provided."""
+    if endpoint_url:
+        yield
+        return
+    try:
+        from moto import mock_aws
+    except ImportError:
+        raise click.ClickException("Install `moto[s3,glacier]` or provide "
+                                   "`--endpoint-url` to benchmark uploads")
+    import boto3
+    with mock_aws():
+        boto3.client('s3', region_name=region).create_bucket(Bucket=bucket)
+        boto3.client('glacier', region_name=region).create_vault(
+            vaultName=vault)
+        yield
+
+
+@click.command()
+@click.option('--files', default=100, show_default=True,
+              help="Number of files in synthetic directory.")
+@click.option('--file-size', default='1M', show_default=True,
+              help="Size of every file.")
+@click.option('--ratio', default=0.5, show_default=True,
+              help="Share of compressible data in files.")
+@click.option('--dump-size', default='128M', show_default=True,
+              help="Size of synthetic database dump.")
+@click.option('--formats', default=DEFAULT_FORMATS, show_default=True,
+              help="Archive formats, comma separated.")
+@click.option('--stream-formats', default=STREAM_FORMATS,
+              show_default=True,
+              help="Streaming compression formats, comma separated.")
+@click.option('--tmpdir', default=None,
+              help="Base temp directory, default is system temp dir.")
+@click.option('--endpoint-url', default=None,
+              help="Local S3 / Glacier compatible server URL, "
+                   "in-process moto mock is used by default.")
+@click.option('--region', default='us-east-1', show_default=True)
+@click.option('--no-upload', is_flag=True, help="Skip upload stages.")
+@click.option('--json', 'json_path', default=None,
+              help="Save results to JSON file.")
+def main(files, file_size, ratio, dump_size, formats, stream_formats,
+         tmpdir, endpoint_url, region, no_upload, json_path):
+    """Benchmark coverme backup stages."""
+    coverme.LOGS.setLevel('WARNING')
+    # Credentials for moto mock, boto3 reads them from environment
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    available = set(coverme.ARCHIVE_EXTENSIONS)
+    formats = [f for f in formats.split(',') if f in available]
+    stream_formats = [f for f in stream_formats.split(',')
+                      if f in coverme.STREAM_CODECS]
+    if coverme.zstandard is None:
+        formats = [f for f in formats if f != 'zsttar']
+        stream_formats = [f for f in stream_formats if f != 'zst']
+    if coverme.lz4 is None:
+        formats = [f for f in formats if f != 'lz4tar']
+        stream_formats = [f for f in stream_formats if f != 'lz4']
+
+    temp_dir = tempfile.mkdtemp(prefix='coverme-bench-', dir=tmpdir)
+    try:
+        tree_dir = os.path.join(temp_dir, 'tree')
+        click.echo("... generating %s files in %s" % (files, tree_dir))
+        tree_size = make_tree(tree_dir, files,
+                              coverme.parse_size(file_size), ratio)
+        dump_path = os.path.join(temp_dir, 'dump.sql')
+        click.echo("... generating dump %s" % dump_path)
+        with open(dump_path, 'wb') as fp:
+            for chunk in iter_dump(coverme.parse_size(dump_size)):
+                fp.write(chunk)
+        bench = Bench(temp_dir)
+        with _stand_in(endpoint_url, region,
+                       'coverme-bench', 'coverme-bench'):
+            backup = make_backup(temp_dir, endpoint_url, region)
+            run_benchmarks(bench, backup, tree_dir, tree_size, dump_path,
+                           formats, stream_formats, not no_upload)
+        if json_path:
+            with open(json_path, 'w') as fp:
+                json.dump(bench.results, fp, indent=2)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
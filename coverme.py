@@ -5,13 +5,36 @@ except ImportError:
     pass
 
 import os
+import io
 import sys
+import bz2
+import base64
 import json
+import re
+import time
+import hashlib
+import heapq
+import hmac
+import lzma
+import zlib
 import logging
 import datetime
 import shutil
 import subprocess
+import tarfile
 import tempfile
+import threading
+import zipfile
+import queue
+import random
+import multiprocessing
+import struct
+import signal
+import importlib
+import itertools
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
+from contextlib import contextmanager
 from copy import deepcopy
 
 try:
@@ -20,13 +43,38 @@ except ImportError:
     import urllib.parse
     urlparse = urllib.parse.urlparse
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 try:
     import dotenv
     dotenv.load_dotenv()
 except ImportError:
     pass
 
-import boto3.session
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    AESGCM = None
+
 import yaml
 
 __version__ = '0.8.1'
@@ -38,8 +86,75 @@ ARCHIVE_EXTENSIONS = {
     'tar': '.tar',
     'gztar': '.tar.gz',
     'bztar': '.tar.bz2',
+    'xztar': '.tar.xz',
+    'zsttar': '.tar.zst',
+    'lz4tar': '.tar.lz4',
+    'gz': '.gz',
+    'bz2': '.bz2',
+    'xz': '.xz',
+    'zst': '.zst',
+    'lz4': '.lz4',
+    'raw': '',
+}
+
+
+def _zstd_compressor(level, threads):
+    """Make Zstandard compressor, `threads` is `None` for all CPUs."""
+    if zstandard is None:
+        raise ImportError("Package `zstandard` is required for zstd "
+                          "compression: pip install coverme[zstd]")
+    return zstandard.ZstdCompressor(
+        level=3 if level is None else level,
+        threads=-1 if threads is None else threads
+    ).compressobj()
+
+
+class LZ4Compressor(object):
+    """LZ4 frame compressor with `zlib.compressobj()` interface."""
+    def __init__(self, level):
+        if lz4 is None:
+            raise ImportError("Package `lz4` is required for lz4 "
+                              "compression: pip install coverme[lz4]")
+        self._compressor = lz4.frame.LZ4FrameCompressor(
+            compression_level=level or 0)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, b''
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        header, self._header = self._header, b''
+        return header + self._compressor.flush()
+
+
+# Compressor factories for streaming mode, every factory accepts
+# compression level and threads number (`None` for defaults) and
+# returns an object with `compress()` and `flush()` methods, like
+# `zlib.compressobj()`.
+STREAM_CODECS = {
+    # wbits=31 means gzip container with zero mtime in header,
+    # so the same input always gives the same output
+    'gz': lambda level, threads: zlib.compressobj(
+        9 if level is None else level, zlib.DEFLATED, 31),
+    'bz2': lambda level, threads: bz2.BZ2Compressor(
+        9 if level is None else level),
+    'xz': lambda level, threads: lzma.LZMACompressor(
+        preset=level),
+    'zst': _zstd_compressor,
+    'lz4': lambda level, threads: LZ4Compressor(level),
+    'raw': None,
 }
 
+# Read chunk size for streaming pipelines
+CHUNK_SIZE = 1024 * 1024
+
+# Vault key of local backups directory set by `localdir`
+LOCAL_VAULT_KEY = 'localdir'
+
+# ioctl request to clone file extents on Linux: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
 
 def expand_value(value, params):
     """Expand str / list value with parameters by using str.format()."""
@@ -55,449 +170,5246 @@ def expand_value(value, params):
     return value
 
 
-def register_archive_extension(archive_type, ext):
-    """Register new archive type file name extension, e.g.
-    register_archive_extension('7z', '.7z')
+def parse_size(value):
+    """
+    Parse size value in bytes, which could be int or str with
+    binary unit suffix, e.g. `64M`, `1.5G`, `512K`.
+    """
+    if value is None or isinstance(value, int):
+        return value
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
 
-    This should be used together with `shutil.register_archive_format()`
-    to properly construct archive names for uploads.
+
+def parse_duration(value):
     """
-    return ARCHIVE_EXTENSIONS.setdefault(archive_type, ext)
+    Parse duration in seconds, which could be number or str with
+    unit suffix, e.g. `30s`, `15m`, `1h`, `1d`, `1w`.
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    value = str(value).strip().lower()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
 
 
-class Backup(object):
-    def __init__(self, settings, environ):
-        self.defaults = settings.get('defaults', {})
-        self.sources = self._make_sources(settings['backups'], environ)
-        self.vaults = self._make_vaults(settings['vaults'], environ)
+# Classes of `ionice` setting
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
 
-    @classmethod
-    def create_with_config(cls, environ, path=None,
-                           stream=None, file_format=None):
-        """
-        Read config and create backup instance with config.
-        Return 2-tuple: (instance, errors)
 
-        If configuration contais errors, `instance` is not created,
-        and `errors` is a dict with error keys and readable
-        descriptions.
-        """
-        if path:
-            _, ext = os.path.splitext(path)
-            if not file_format:
-                if ext in ('.json',):
-                    file_format = 'json'
-                else:
-                    file_format = 'yaml'
+def parse_ionice(value):
+    """
+    Parse I/O priority: class name with optional level, e.g. `idle`,
+    `best-effort:7`. Return 2-tuple: (class number, level or `None`).
+    """
+    name, _, level = str(value).partition(':')
+    if name not in IONICE_CLASSES:
+        raise ValueError("Unknown ionice class `%s`" % name)
+    return IONICE_CLASSES[name], int(level) if level else None
 
-            load = yaml.safe_load if file_format == 'yaml' else json.loads
 
-            try:
-                with open(path) as fp:
-                    settings = load(fp)
-                    echo("... reading config from %s" % path)
-            except IOError:
-                return None, {'path': path, '': "No config file found"}
-        elif stream:
-            echo("Reading config from stdin")
-            text = '\n'.join([line for line in stream])
-            if text.startswith('---'):
-                settings = yaml.safe_load(text)
-            else:
-                settings = json.loads(text)
-        else:
-            raise Exception("Either config path or stream must be provided.")
+def priority_args(nice=None, ionice=None):
+    """
+    Get command prefix to run process with `nice` level and `ionice`
+    priority. Niceness is absolute, i.e. it's not increased if this
+    process already runs with the same or higher one.
+    """
+    args = []
+    if nice is not None:
+        increment = int(nice) - os.getpriority(os.PRIO_PROCESS, 0)
+        if increment > 0:
+            args += ['nice', '-n', str(increment)]
+    if ionice:
+        io_class, level = parse_ionice(ionice)
+        args += ['ionice', '-c', str(io_class)]
+        if level is not None:
+            args += ['-n', str(level)]
+    return args
 
-        errors = cls.validate(settings)
-        if not errors:
+
+def set_priority(nice=None, ionice=None):
+    """
+    Set `nice` level and `ionice` priority of this process. Threads
+    and processes started after it inherit priority.
+    """
+    if nice is not None and int(nice) > os.getpriority(os.PRIO_PROCESS, 0):
+        os.setpriority(os.PRIO_PROCESS, 0, int(nice))
+    if ionice:
+        io_class, level = parse_ionice(ionice)
+        args = ['ionice', '-c', str(io_class)]
+        if level is not None:
+            args += ['-n', str(level)]
+        subprocess.check_call(args + ['-p', str(os.getpid())])
+
+
+def read_full(fp, size):
+    """Read exactly `size` bytes from file object or less on EOF."""
+    chunks = []
+    while size > 0:
+        chunk = fp.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def iter_chunks(fp, chunk_size=CHUNK_SIZE):
+    """Read file object by chunks until EOF."""
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def iter_compress(chunks, compressor):
+    """Compress chunks iterable with compressor object."""
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    data = compressor.flush()
+    if data:
+        yield data
+
+
+def _zstd_decompressor():
+    if zstandard is None:
+        raise ImportError("Package `zstandard` is required for zstd "
+                          "decompression: pip install coverme[zstd]")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _lz4_decompressor():
+    if lz4 is None:
+        raise ImportError("Package `lz4` is required for lz4 "
+                          "decompression: pip install coverme[lz4]")
+    return lz4.frame.LZ4FrameDecompressor()
+
+
+# Decompressor factories for `STREAM_CODECS` formats, every factory
+# returns an object with `decompress()` method
+STREAM_DECODERS = {
+    'gz': lambda: zlib.decompressobj(31),
+    'bz2': bz2.BZ2Decompressor,
+    'xz': lzma.LZMADecompressor,
+    'zst': _zstd_decompressor,
+    'lz4': _lz4_decompressor,
+    'raw': None,
+}
+
+
+def iter_decompress(chunks, decompressor):
+    """Decompress chunks iterable with decompressor object."""
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    flush = getattr(decompressor, 'flush', None)
+    if flush:
+        data = flush()
+        if data:
+            yield data
+
+
+# Encrypted stream header: magic, chunk size, key ID and nonce prefix
+ENCRYPTION_MAGIC = b'CVMEGCM1'
+ENCRYPTION_HEADER = struct.Struct('>8sI8s8s')
+
+# Size of plain text chunks, every chunk is authenticated separately
+ENCRYPTION_CHUNK_SIZE = 1024 * 1024
+
+# Name extension of encrypted archives
+ENCRYPTION_EXTENSION = '.enc'
+
+
+def parse_key(value):
+    """Parse AES key from base64 of 16, 24 or 32 bytes."""
+    try:
+        key = base64.b64decode(value, validate=True)
+    except (ValueError, TypeError):
+        key = b''
+    if len(key) not in (16, 24, 32):
+        raise ValueError("Encryption key must be base64 of 16, 24 "
+                         "or 32 bytes")
+    return key
+
+
+def _aesgcm(key):
+    if AESGCM is None:
+        raise ImportError("Package `cryptography` is required for "
+                          "encryption: pip install coverme[crypto]")
+    return AESGCM(key)
+
+
+def _key_id(key):
+    return hashlib.sha256(b'coverme-key-id' + key).digest()[:8]
+
+
+def iter_encrypt(chunks, key, chunk_size=ENCRYPTION_CHUNK_SIZE):
+    """
+    Encrypt chunks iterable with AES-GCM by fixed size chunks. Nonce
+    of every chunk is random prefix and chunk number, the last chunk
+    is marked in associated data, so reordered or truncated stream
+    fails to decrypt.
+    """
+    aesgcm = _aesgcm(key)
+    header = ENCRYPTION_HEADER.pack(ENCRYPTION_MAGIC, chunk_size,
+                                    _key_id(key), os.urandom(8))
+    nonce_prefix = header[-8:]
+    yield header
+    number = 0
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) > chunk_size:
+            yield aesgcm.encrypt(nonce_prefix + struct.pack('>I', number),
+                                 bytes(buf[:chunk_size]), header + b'\0')
+            del buf[:chunk_size]
+            number += 1
+    yield aesgcm.encrypt(nonce_prefix + struct.pack('>I', number),
+                         bytes(buf), header + b'\1')
+
+
+def encrypted_size(size, chunk_size=ENCRYPTION_CHUNK_SIZE):
+    """Get size of data encrypted by :func:`iter_encrypt`."""
+    chunks = max(size - 1, 0) // chunk_size + 1
+    return ENCRYPTION_HEADER.size + size + 16 * chunks
+
+
+def iter_decrypt(chunks, key):
+    """Decrypt chunks iterable encrypted by :func:`iter_encrypt`."""
+    aesgcm = _aesgcm(key)
+    buf = bytearray()
+    chunks = iter(chunks)
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) >= ENCRYPTION_HEADER.size:
+            break
+    if len(buf) < ENCRYPTION_HEADER.size:
+        raise ValueError("Encrypted stream is truncated")
+    header = bytes(buf[:ENCRYPTION_HEADER.size])
+    del buf[:ENCRYPTION_HEADER.size]
+    magic, chunk_size, key_id, nonce_prefix = ENCRYPTION_HEADER.unpack(header)
+    if magic != ENCRYPTION_MAGIC:
+        raise ValueError("Stream is not encrypted by coverme")
+    if key_id != _key_id(key):
+        raise ValueError("Stream is encrypted with other key")
+    frame_size = chunk_size + 16
+    number = 0
+
+    def decrypt(data, last):
+        try:
+            return aesgcm.decrypt(
+                nonce_prefix + struct.pack('>I', number), bytes(data),
+                header + (b'\1' if last else b'\0'))
+        except InvalidTag:
+            raise ValueError("Encrypted chunk %s is corrupted" % number)
+
+    # Data read with header could already hold several chunks
+    for chunk in itertools.chain([b''], chunks):
+        buf += chunk
+        while len(buf) > frame_size:
+            yield decrypt(buf[:frame_size], False)
+            del buf[:frame_size]
+            number += 1
+    yield decrypt(buf, True)
+
+
+def iter_prefetch(tasks, concurrency):
+    """
+    Run callables from `tasks` iterable in thread pool, up to
+    `concurrency` at once, and yield results in order.
+    """
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    futures = []
+    try:
+        for task in tasks:
+            futures.append(pool.submit(task))
+            if len(futures) >= concurrency:
+                yield futures.pop(0).result()
+        while futures:
+            yield futures.pop(0).result()
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+class IterStream(io.RawIOBase):
+    """
+    Read-only file object on top of bytes iterable, so generator chain
+    could be passed to anything expecting a file, e.g. boto3 uploads.
+    """
+    def __init__(self, chunks, source=None):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self.source = source
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            if hasattr(self._chunks, 'close'):
+                self._chunks.close()
+            if self.source is not None:
+                self.source.close()
+        super().close()
+
+    def readinto(self, b):
+        while not self._buffer:
             try:
-                return cls(settings=settings, environ=environ), None
-            except Exception as e:
-                errors = {'': e}
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self.bytes_read += size
+        return size
 
-        errors['path'] = path
-        return None, errors
 
-    @classmethod
-    def validate(cls, settings):
-        """Validate settings and show human readable errors."""
-        errors = {}
-        if not settings.get('backups'):
-            errors['backups'] = "Section `backups` is empty"
-        if not settings.get('vaults'):
-            errors['vaults'] = "Section `vaults` is empty"
-        return errors
+class FanOut(object):
+    """
+    Read stream once and feed the same chunks to several consumers
+    running concurrently. Every consumer gets own file-like reader from
+    `readers` list and must call `reader.detach()` when done, so
+    failed consumer never blocks others.
+    """
+    def __init__(self, stream, count, queue_size=8):
+        self.stream = stream
+        self.readers = [FanOutReader(queue_size) for _ in range(count)]
 
     def run(self):
-        """Run backup for all sources."""
-        echo("... started at [%s]" % datetime.datetime.now())
-        for source in self.sources:
-            temp_dir = _smaketemp(self.get_temp_dir())
+        """Read stream till the end and feed chunks to readers."""
+        try:
+            for chunk in iter_chunks(self.stream):
+                if not self._feed(chunk):
+                    break
+            self._feed(None)
+        except Exception as e:
+            self._feed(e)
+
+    def _feed(self, item):
+        active = [r for r in self.readers if not r.detached]
+        for reader in active:
+            reader.put(item)
+        return bool(active)
+
+
+class FanOutReader(io.RawIOBase):
+    """
+    Reader for :class:`FanOut` consumer. Chunk `None` means EOF, and
+    exception means that source stream has failed.
+    """
+    def __init__(self, queue_size):
+        self.detached = False
+        self.bytes_read = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._buffer = b''
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def put(self, item):
+        if not self.detached:
+            self._queue.put(item)
+
+    def detach(self):
+        """Stop receiving chunks and release blocked producer."""
+        self.detached = True
+        while True:
             try:
-                self._run_with_temp_dir(source, temp_dir)
-            except Exception as e:
-                echo('*** error in %s: %s' % (source, e))
-            # finally:
-            #     shutil.rmtree(temp_dir, ignore_errors=True)
-        echo("... completed at [%s]" % datetime.datetime.now())
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
 
-    def get_temp_dir(self):
-        """Get base temp directory path."""
-        return os.path.realpath(self.defaults.get('tmpdir', '/tmp'))
+    def readinto(self, b):
+        while not self._buffer:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, Exception):
+                self._eof = True
+                raise item
+            else:
+                self._buffer = item
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self.bytes_read += size
+        return size
 
-    def get_local_dir(self):
-        """Get directory path for local backups."""
-        localdir = self.defaults.get('localdir')
-        if localdir:
-            return os.path.realpath(localdir)
 
-    def _run_with_temp_dir(self, source, temp_dir):
-        """Run backup for source within temp directory."""
-        arch_path = source.archive(temp_dir)
-        if arch_path:
-            upload_name = source.get_archive_fullname()
-            vault_keys = source.get_vault_keys()
-            if vault_keys[0] == '*':
-                vault_keys = self.vaults.keys()
-            for k in vault_keys:
-                vault = self.vaults[k]
-                success, data = vault.upload(arch_path,
-                                             upload_name=upload_name)
-                if success:
-                    echo("+++ uploaded to %s: %s" % (vault, data))
-                else:
-                    echo("*** not uploaded to %s" % vault)
-            base_local_dir = source.get_local_dir()
-            if base_local_dir:
-                local_dir = os.path.join(base_local_dir,
-                                         os.path.dirname(upload_name))
-                _smove(arch_path, local_dir)
-                echo("+++ local backup saved to %s" % local_dir)
-        else:
-            echo("*** nothing to upload from source %s" % source)
+# Gear table for content-defined chunking, derived from SHA-256
+# so chunk boundaries are the same on every platform and version
+CDC_GEAR = [
+    int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big')
+    for i in range(256)
+]
 
-    def _make_sources(self, config_list, environ):
-        """
-        Create new sources by list of dicts. Return list
-        of `BackupSource` objects.
-        """
-        sources = []
-        environ = deepcopy(environ)
-        for conf in config_list:
-            source_type = conf.get('type')
-            source_url = conf['url']
-            scheme, _ = source_url.split('://', 1)
-            if source_type == 'database':
-                if scheme == 'postgres':
-                    source_cls = PostgresqlBackupSource
-                elif scheme == 'mysql':
-                    source_cls = MySQLBackupSource
-                else:
-                    raise ValueError(
-                        "Unknown scheme in URL `%s`" % source_url
-                    )
-            elif source_type == 'dir':
-                source_cls = DirBackupSource
-            sources.append(source_cls(
-                self,
-                settings=deepcopy(conf),
-                environ=environ
-            ))
-        return sources
 
-    def _make_vaults(self, config_dict, environ):
-        """
-        Create new vaults by dict. Return dict of `BaseVault` objects.
-        """
-        vaults = {}
-        for k, conf in config_dict.items():
-            v_service = conf.get('service')
-            if v_service == 'glacier':
-                vault_cls = GlacierVault
-            elif v_service == 's3':
-                vault_cls = S3Bucket
+CDC_GEAR_ARRAY = (numpy.array(CDC_GEAR, dtype=numpy.uint32)
+                  if numpy is not None else None)
+
+# Size of blocks to search chunk boundary in with numpy
+CDC_BLOCK_SIZE = 64 * 1024
+
+
+def iter_cdc_chunks(stream, avg_size, min_size=None, max_size=None):
+    """
+    Split stream to content-defined chunks with gear rolling hash,
+    boundaries are normalized around `avg_size` as in FastCDC. Same
+    data gives the same chunks regardless of its offset in stream.
+
+    Boundaries are searched with numpy if it's installed, otherwise
+    by pure Python loop, which is much slower. Chunks are the same.
+    """
+    min_size = min_size or avg_size // 4
+    max_size = max_size or avg_size * 4
+    bits = avg_size.bit_length() - 1
+    # top bits of 32-bit gear hash depend on last 32 bytes
+    mask_small = ((1 << (bits + 1)) - 1) << (32 - bits - 1)
+    mask_large = ((1 << (bits - 1)) - 1) << (32 - bits + 1)
+    gear = CDC_GEAR
+    buf = b''
+    eof = False
+    while buf or not eof:
+        while not eof and len(buf) < max_size:
+            data = stream.read(max_size)
+            if data:
+                buf += data
             else:
-                if v_service:
-                    raise ValueError("Unknown vault service `%s`" % v_service)
-                else:
-                    raise ValueError("Key `service` is missing for vault `%s`" % k)
-            vaults[k] = vault_cls(
-                self,
-                settings=deepcopy(conf),
-                environ=deepcopy(environ)
-            )
-        return vaults
+                eof = True
+        size = len(buf)
+        if size <= min_size:
+            cut = size
+        elif numpy is not None:
+            cut = (_find_cdc_cut(buf, min_size, min(size, avg_size),
+                                 mask_small) or
+                   _find_cdc_cut(buf, min(size, avg_size),
+                                 min(size, max_size), mask_large,
+                                 hash_start=min_size) or
+                   min(size, max_size))
+        else:
+            cut = min(size, max_size)
+            h = 0
+            i = min_size
+            end = min(size, avg_size)
+            while i < end:
+                h = ((h << 1) + gear[buf[i]]) & 0xFFFFFFFF
+                i += 1
+                if not h & mask_small:
+                    cut = i
+                    break
+            else:
+                end = min(size, max_size)
+                while i < end:
+                    h = ((h << 1) + gear[buf[i]]) & 0xFFFFFFFF
+                    i += 1
+                    if not h & mask_large:
+                        cut = i
+                        break
+        yield buf[:cut]
+        buf = buf[cut:]
 
 
-class BackupSource(object):
-    def __init__(self, backup, settings, environ):
-        self.backup = backup
-        self.settings = settings
-        self.environ = environ
+def _find_cdc_cut(buf, start, end, mask, hash_start=None):
+    """
+    Find chunk boundary in `buf[start:end]` by gear hash with numpy.
+    Hash starts from zero at `hash_start` (chunk's `min_size`), as
+    in pure Python loop of :func:`iter_cdc_chunks()`. Return cut
+    position or `None` if there's no boundary.
+    """
+    if hash_start is None:
+        hash_start = start
+    gear = CDC_GEAR_ARRAY
+    for block_start in range(start, end, CDC_BLOCK_SIZE):
+        block_end = min(block_start + CDC_BLOCK_SIZE, end)
+        # hash at position depends on up to 31 previous bytes
+        lo = max(hash_start, block_start - 31)
+        values = gear[numpy.frombuffer(buf, numpy.uint8,
+                                       count=block_end - lo, offset=lo)]
+        # sum of `gear[byte] << distance` for last 32 bytes by doubling
+        hashes = values
+        for shift in (1, 2, 4, 8, 16):
+            hashes = hashes.copy()
+            hashes[shift:] += hashes[:-shift] << numpy.uint32(shift)
+        found = numpy.flatnonzero(
+            (hashes[block_start - lo:] & numpy.uint32(mask)) == 0)
+        if len(found):
+            return block_start + int(found[0]) + 1
 
-    def expand_setting(self, key, default=None):
-        value = self.settings.get(key, default)
-        params = {}
-        if value:
-            now = datetime.datetime.now()
-            params = {
-                'env': self.environ,
-                'tags': self.settings.get('tags', ''),
-                'yyyy': now.year,
-                'mm': '%02d' % now.month,
-                'dd': '%02d' % now.day,
-                'HH': '%02d' % now.hour,
-                'MM': '%02d' % now.minute,
-                'SS': '%02d' % now.second,
-                'UU': now.microsecond,
-            }
-        return expand_value(value, params)
 
-    def archive(self, temp_dir):
+class CompressedWriter(io.RawIOBase):
+    """
+    Write-only file object, which compresses data with compressor
+    from `STREAM_CODECS` to underlying file object.
+    """
+    def __init__(self, fp, compressor):
+        self._fp = fp
+        self._compressor = compressor
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        data = self._compressor.compress(bytes(b))
+        if data:
+            self._fp.write(data)
+        return len(b)
+
+    def finish(self):
+        """Write compressed data remaining in compressor."""
+        self._fp.write(self._compressor.flush())
+
+
+# Archive formats supported by :func:`write_archive()`
+TAR_MODES = {
+    'tar': 'w',
+    'gztar': 'w:gz',
+    'bztar': 'w:bz2',
+    'xztar': 'w:xz',
+}
+
+# Tar archive formats compressed with codecs from `STREAM_CODECS`
+TAR_CODECS = {
+    'zsttar': 'zst',
+    'lz4tar': 'lz4',
+}
+
+
+@contextmanager
+def open_tar(arch_path, format, level=None, threads=None):
+    """
+    Open tar archive for writing with optional compression level and
+    number of compression threads (used by zstd only).
+    """
+    if format in TAR_CODECS:
+        codec = STREAM_CODECS[TAR_CODECS[format]]
+        with open(arch_path, 'wb') as fp:
+            writer = CompressedWriter(fp, codec(level, threads))
+            with tarfile.open(fileobj=writer, mode='w|') as tf:
+                yield tf
+            writer.finish()
+    else:
+        kwargs = {}
+        if level is not None and format == 'xztar':
+            kwargs['preset'] = level
+        elif level is not None and format != 'tar':
+            kwargs['compresslevel'] = level
+        with tarfile.open(arch_path, TAR_MODES[format], **kwargs) as tf:
+            yield tf
+
+
+class FilesReader(object):
+    """
+    Open files for archiving and count bytes read from them, so size
+    of archived data is known without walking directory again. If
+    `hash` is enabled, SHA-256 of files is calculated while they're
+    archived, `digests` dict maps archive names to hex digests.
+    """
+    def __init__(self, hash=False):
+        self.bytes_read = 0
+        self.digests = {} if hash else None
+
+    @contextmanager
+    def open(self, path, name):
+        """Open file by `path` added to archive as `name` for reading."""
+        digest = hashlib.sha256() if self.digests is not None else None
+        with open(path, 'rb') as fp:
+            yield ReadFile(fp, self, digest)
+        if digest is not None:
+            self.digests[name] = digest.hexdigest()
+
+
+class ReadFile(object):
+    """File opened by :class:`FilesReader`, only `read()` is supported."""
+    def __init__(self, fp, reader, digest=None):
+        self._fp = fp
+        self._reader = reader
+        self._digest = digest
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self._reader.bytes_read += len(data)
+        if self._digest is not None:
+            self._digest.update(data)
+        return data
+
+
+def iter_dir_tree(root_dir, base_dir):
+    """
+    Walk `base_dir` relative to `root_dir` and yield 2-tuples: (path,
+    archive name) for the directory itself, subdirectories and files
+    sorted by name. Symlinks to directories are not followed.
+    """
+    top = os.path.join(root_dir, base_dir)
+    yield top, os.path.normpath(base_dir)
+    for dir_path, dir_names, file_names in os.walk(top):
+        dir_names.sort()
+        arc_dir = os.path.normpath(os.path.join(
+            base_dir, os.path.relpath(dir_path, top)))
+        for name in sorted(dir_names + file_names):
+            yield (os.path.join(dir_path, name),
+                   os.path.normpath(os.path.join(arc_dir, name)))
+
+
+# Before Python 3.10.6 `shutil.make_archive()` changes current
+# directory, so concurrent archiving has to be serialized
+_ARCHIVE_CHDIR_LOCK = threading.Lock()
+
+
+def make_archive(base_name, format, root_dir=None, base_dir=None,
+                 level=None, threads=None, reader=None):
+    """
+    Thread-safe `shutil.make_archive()` shortcut. Zip and tar formats
+    are written by coverme itself, files are opened by `reader`, e.g.
+    :class:`FilesReader` to count archived bytes. Files removed while
+    archiving are skipped.
+    """
+    reader = reader or FilesReader()
+    base_dir = base_dir or os.curdir
+    arch_path = base_name + ARCHIVE_EXTENSIONS.get(format, '')
+    if format == 'zip':
+        with zipfile.ZipFile(arch_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for path, name in iter_dir_tree(root_dir, base_dir):
+                if name == os.curdir:
+                    continue
+                try:
+                    if os.path.isdir(path):
+                        zf.write(path, name)
+                    elif os.path.isfile(path):
+                        info = zipfile.ZipInfo.from_file(path, name)
+                        info.compress_type = zipfile.ZIP_DEFLATED
+                        with reader.open(path, name) as src, \
+                                zf.open(info, 'w') as dst:
+                            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                except FileNotFoundError:
+                    LOGS.warning("*** file removed: %s" % path)
+        return arch_path
+    if format in TAR_MODES or format in TAR_CODECS:
+        with open_tar(arch_path, format, level, threads) as tf:
+            for path, name in iter_dir_tree(root_dir, base_dir):
+                try:
+                    info = tf.gettarinfo(path, name)
+                    if info is None:
+                        continue
+                    if info.isreg():
+                        with reader.open(path, name) as fp:
+                            tf.addfile(info, fp)
+                    else:
+                        tf.addfile(info)
+                except FileNotFoundError:
+                    LOGS.warning("*** file removed: %s" % path)
+        return arch_path
+    # Formats registered with `shutil.register_archive_format()`, files
+    # are read separately only if they have to be hashed
+    if reader.digests is None:
+        reader.bytes_read += _dir_size(os.path.join(root_dir, base_dir))
+    else:
+        for path, name in iter_dir_tree(root_dir, base_dir):
+            if os.path.isfile(path) and not os.path.islink(path):
+                with reader.open(path, name) as fp:
+                    while fp.read(CHUNK_SIZE):
+                        pass
+    if sys.version_info >= (3, 10, 6):
+        return shutil.make_archive(base_name, format,
+                                   root_dir=root_dir, base_dir=base_dir)
+    with _ARCHIVE_CHDIR_LOCK:
+        return shutil.make_archive(base_name, format,
+                                   root_dir=root_dir, base_dir=base_dir)
+
+
+def write_archive(base_name, format, root_dir, paths, extra=None,
+                  level=None, threads=None):
+    """
+    Make archive of files list. Unlike `shutil.make_archive()` only
+    specified `paths` relative to `root_dir` are added, and `extra`
+    dict of names and bytes is added as files. Files removed while
+    archiving are skipped. Return archive path.
+    """
+    if (format != 'zip' and format not in TAR_MODES and
+            format not in TAR_CODECS):
+        raise ValueError("Archive format `%s` is not supported "
+                         "for files list" % format)
+    arch_path = base_name + ARCHIVE_EXTENSIONS[format]
+    extra = extra or {}
+    if format == 'zip':
+        with zipfile.ZipFile(arch_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for rel_path in paths:
+                try:
+                    zf.write(os.path.join(root_dir, rel_path), rel_path)
+                except FileNotFoundError:
+                    LOGS.warning("*** file removed: %s" % rel_path)
+            for name, data in extra.items():
+                zf.writestr(name, data)
+    else:
+        with open_tar(arch_path, format, level, threads) as tf:
+            for rel_path in paths:
+                try:
+                    tf.add(os.path.join(root_dir, rel_path), rel_path,
+                           recursive=False)
+                except FileNotFoundError:
+                    LOGS.warning("*** file removed: %s" % rel_path)
+            for name, data in extra.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = time.time()
+                tf.addfile(info, io.BytesIO(data))
+    return arch_path
+
+
+def get_archive_format_by_name(name):
+    """Get archive format by name extension, `raw` if it's unknown."""
+    for aformat, ext in sorted(ARCHIVE_EXTENSIONS.items(),
+                               key=lambda item: -len(item[1])):
+        if ext and name.endswith(ext):
+            return aformat
+    return 'raw'
+
+
+def strip_archive_extension(name):
+    """Get name without archive extension."""
+    ext = ARCHIVE_EXTENSIONS[get_archive_format_by_name(name)]
+    return name[:-len(ext)] if ext else name
+
+
+@contextmanager
+def open_tar_stream(stream, aformat):
+    """Open tar archive of any tar format for sequential reading."""
+    if aformat in TAR_CODECS:
+        decoder = STREAM_DECODERS[TAR_CODECS[aformat]]()
+        stream = io.BufferedReader(IterStream(
+            iter_decompress(iter_chunks(stream), decoder)), CHUNK_SIZE)
+        mode = 'r|'
+    else:
+        mode = TAR_MODES[aformat].replace('w', 'r|').replace(':', '')
+    with tarfile.open(fileobj=stream, mode=mode) as tar:
+        yield tar
+
+
+def extract_archive(stream, name, to_dir, temp_dir):
+    """
+    Extract archive from stream to directory, archive format is found
+    by name. Tar archives are extracted while reading, zip archive is
+    saved to temp dir first, as it can't be read sequentially.
+    """
+    aformat = get_archive_format_by_name(name)
+    _smakedirs(to_dir)
+    if aformat == 'zip':
+        path = os.path.join(temp_dir, os.path.basename(name))
+        with open(path, 'wb') as fp:
+            shutil.copyfileobj(stream, fp, CHUNK_SIZE)
+        with zipfile.ZipFile(path) as arch:
+            arch.extractall(to_dir)
+        os.unlink(path)
+    elif aformat in TAR_MODES or aformat in TAR_CODECS:
+        with open_tar_stream(stream, aformat) as tar:
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(to_dir, filter='data')
+            else:
+                tar.extractall(to_dir)
+    else:
+        path = os.path.join(to_dir, os.path.basename(
+            strip_archive_extension(name)))
+        with open(path, 'wb') as fp:
+            for chunk in iter_decoded(stream, aformat):
+                fp.write(chunk)
+
+
+def iter_archive_files(stream, name, temp_dir):
+    """
+    Iterate over files in archive from stream, yield 2-tuples: (name,
+    file object). Compressed file which is not archive is yielded as
+    single file with name without extension.
+    """
+    aformat = get_archive_format_by_name(name)
+    if aformat == 'zip':
+        path = os.path.join(temp_dir, os.path.basename(name))
+        with open(path, 'wb') as fp:
+            shutil.copyfileobj(stream, fp, CHUNK_SIZE)
+        with zipfile.ZipFile(path) as arch:
+            for info in arch.infolist():
+                if not info.is_dir():
+                    with arch.open(info) as fp:
+                        yield info.filename, fp
+        os.unlink(path)
+    elif aformat in TAR_MODES or aformat in TAR_CODECS:
+        with open_tar_stream(stream, aformat) as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member)
+    else:
+        yield (strip_archive_extension(name),
+               IterStream(iter_decoded(stream, aformat)))
+
+
+def iter_decoded(stream, aformat):
+    """Iterate over decompressed chunks of stream in `aformat`."""
+    chunks = iter_chunks(stream)
+    factory = STREAM_DECODERS.get(aformat)
+    return iter_decompress(chunks, factory()) if factory else chunks
+
+
+def register_archive_extension(archive_type, ext):
+    """Register new archive type file name extension, e.g.
+    register_archive_extension('7z', '.7z')
+
+    This should be used together with `shutil.register_archive_format()`
+    to properly construct archive names for uploads.
+    """
+    return ARCHIVE_EXTENSIONS.setdefault(archive_type, ext)
+
+
+class Metrics(object):
+    """
+    Timing and bytes counters of backup stages. Every stage record is
+    a dict with keys: `source`, `key`, `stage`, `vault`, `started`,
+    `duration`, `bytes_in`, `bytes_out`, `ratio`, `throughput`,
+    `success`. Records are passed to hooks and appended to JSON lines
+    file, and Prometheus text file with latest record per source stage
+    is written with :meth:`.export()`.
+    """
+    def __init__(self, settings=None):
+        settings = settings or {}
+        self.jsonl_path = settings.get('jsonl')
+        self.prometheus_path = settings.get('prometheus')
+        self.records = {}
+        self.hooks = [_import_object(path)
+                      for path in settings.get('hooks') or []]
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Add callback to be called with every stage record."""
+        self.hooks.append(hook)
+
+    @contextmanager
+    def measure(self, stage, source=None, vault=None):
+        """
+        Context manager to measure stage, bytes counters of yielded
+        record should be set within context.
+        """
+        record = {
+            'source': str(source) if source else None,
+            'key': source.get_key() if source else None,
+            'stage': stage,
+            'vault': vault,
+            'started': time.time(),
+            'bytes_in': None,
+            'bytes_out': None,
+            'success': True,
+        }
+        started = time.monotonic()
+        try:
+            yield record
+        except Exception:
+            record['success'] = False
+            raise
+        finally:
+            record['duration'] = time.monotonic() - started
+            self.add(record)
+
+    def add(self, record):
+        """Add stage record, calculate ratio and throughput."""
+        bytes_in, bytes_out = record['bytes_in'], record['bytes_out']
+        record['ratio'] = (bytes_in / bytes_out
+                           if bytes_in and bytes_out else None)
+        size = bytes_out if bytes_out is not None else bytes_in
+        record['throughput'] = (size / record['duration']
+                                if size and record['duration'] else None)
+        with self._lock:
+            self.records[(record['key'], record['stage'],
+                          record['vault'])] = record
+            if self.jsonl_path:
+                _smakedirs(os.path.dirname(self.jsonl_path))
+                with open(self.jsonl_path, 'a') as fp:
+                    fp.write(json.dumps(record) + '\n')
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                LOGS.warning("*** metrics hook %s failed: %s" % (hook, e))
+
+    def export(self):
+        """Write Prometheus text file with latest records."""
+        if not self.prometheus_path:
+            return
+        metrics = [
+            ('duration_seconds', 'duration'),
+            ('bytes_in', 'bytes_in'),
+            ('bytes_out', 'bytes_out'),
+            ('throughput_bytes_per_second', 'throughput'),
+            ('success', 'success'),
+        ]
+        lines = []
+        with self._lock:
+            records = list(self.records.values())
+        for name, key in metrics:
+            lines.append('# TYPE coverme_stage_%s gauge' % name)
+            for record in records:
+                if record[key] is None:
+                    continue
+                labels = ','.join('%s="%s"' % (label, _prometheus_escape(
+                    record[label] or '')) for label in
+                    ('source', 'key', 'stage', 'vault'))
+                lines.append('coverme_stage_%s{%s} %s' % (
+                    name, labels, float(record[key])))
+        lines.append('# TYPE coverme_last_run_timestamp_seconds gauge')
+        lines.append('coverme_last_run_timestamp_seconds %s' % time.time())
+        _smakedirs(os.path.dirname(self.prometheus_path))
+        temp_path = self.prometheus_path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.prometheus_path)
+
+
+class CronSchedule(object):
+    """
+    Cron expression schedule with 5 fields: minute, hour, day of month,
+    month and day of week. Supports `*`, lists, ranges, steps, e.g.
+    `*/15 2-4 * * 1,3` and `@hourly`, `@daily`, `@weekly`, `@monthly`.
+    """
+    aliases = {
+        '@hourly': '0 * * * *',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@weekly': '0 0 * * 0',
+        '@monthly': '0 0 1 * *',
+    }
+    ranges = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expr):
+        self.expr = expr
+        fields = self.aliases.get(expr.strip(), expr).split()
+        if len(fields) != 5:
+            raise ValueError("Invalid cron expression `%s`" % expr)
+        (self.minutes, self.hours, self.days, self.months,
+         weekdays) = [self._parse(field, low, high) for field, (low, high)
+                      in zip(fields, self.ranges)]
+        # Both 0 and 7 are Sunday
+        self.weekdays = set(day % 7 for day in weekdays)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def __str__(self):
+        return self.expr
+
+    def next_after(self, dt):
+        """Get next time matching schedule after `dt`."""
+        dt = dt.replace(second=0, microsecond=0) + \
+            datetime.timedelta(minutes=1)
+        limit = dt + datetime.timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                month = dt.month % 12 + 1
+                dt = dt.replace(year=dt.year + (month == 1), month=month,
+                                day=1, hour=0, minute=0)
+            elif not self._match_day(dt):
+                dt = dt.replace(hour=0, minute=0) + \
+                    datetime.timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError("No matching time for cron expression `%s`" %
+                         self.expr)
+
+    def _match_day(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day and self.any_weekday:
+            return True
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def _parse(self, field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(value) for value in part.split('-', 1)]
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError("Invalid cron expression `%s`" % self.expr)
+            values.update(range(start, end + 1, step))
+        return values
+
+
+class IntervalSchedule(object):
+    """Schedule to run every `seconds` after previous run."""
+    def __init__(self, seconds):
+        self.seconds = parse_duration(seconds)
+        if not self.seconds or self.seconds <= 0:
+            raise ValueError("Invalid interval `%s`" % seconds)
+
+    def __str__(self):
+        return 'every %ss' % self.seconds
+
+    def next_after(self, dt):
+        return dt + datetime.timedelta(seconds=self.seconds)
+
+
+class RetentionPolicy(object):
+    """
+    Backups retention policy, e.g. {'daily': 7, 'weekly': 4,
+    'monthly': 12}. The latest backup of every period is kept for the
+    number of latest periods with backups, and `last` backups are kept
+    regardless of periods, default is 1.
+    """
+    periods = [
+        ('hourly', '%Y-%m-%d %H'),
+        ('daily', '%Y-%m-%d'),
+        ('weekly', '%G-%V'),
+        ('monthly', '%Y-%m'),
+        ('yearly', '%Y'),
+    ]
+
+    def __init__(self, settings):
+        unknown = set(settings) - set(dict(self.periods)) - {'last'}
+        if unknown:
+            raise ValueError("Unknown retention periods: %s" %
+                             ', '.join(sorted(unknown)))
+        self.counts = dict((key, int(value))
+                           for key, value in settings.items())
+        self.last = max(1, self.counts.pop('last', 1))
+
+    def __str__(self):
+        return ', '.join(['last %s' % self.last] + [
+            '%s %s' % (self.counts[key], key)
+            for key, _ in self.periods if key in self.counts])
+
+    def select(self, backups):
+        """
+        Select backups to keep from list of 2-tuples: (datetime, name).
+        Return set of names.
+        """
+        ordered = sorted(backups, reverse=True)
+        keep = set(name for _, name in ordered[:self.last])
+        for key, fmt in self.periods:
+            count = self.counts.get(key)
+            if not count:
+                continue
+            seen = set()
+            for timestamp, name in ordered:
+                period = timestamp.strftime(fmt)
+                if period in seen:
+                    continue
+                seen.add(period)
+                keep.add(name)
+                if len(seen) >= count:
+                    break
+        return keep
+
+
+def parse_tags(value):
+    """Parse tags from comma separated str or list. Return set."""
+    if not value:
+        return set()
+    if isinstance(value, str):
+        value = value.split(',')
+    return set(str(tag).strip() for tag in value if str(tag).strip())
+
+
+class SourceFilter(object):
+    """
+    Select sources configs by tags and `id`, name pattern, path or URL.
+    Source matches if it has any of `tags`, none of `exclude_tags` and
+    matches any of `names`, empty conditions match everything.
+    """
+    def __init__(self, tags=None, exclude_tags=None, names=None):
+        self.tags = parse_tags(tags)
+        self.exclude_tags = parse_tags(exclude_tags)
+        self.names = set(names or [])
+
+    def __bool__(self):
+        return bool(self.tags or self.exclude_tags or self.names)
+
+    def match(self, conf):
+        """Check if source config matches filter."""
+        tags = parse_tags(conf.get('tags'))
+        if self.tags and not tags & self.tags:
+            return False
+        if tags & self.exclude_tags:
+            return False
+        if self.names:
+            idents = set(str(conf[k]) for k in ('id', 'name', 'path', 'url')
+                         if conf.get(k))
+            if not idents & self.names:
+                return False
+        return True
+
+
+class Planner(object):
+    """
+    Plan order of sources, the longest first, so concurrent workers
+    finish at about the same time. Duration is estimated by size of
+    source and throughput of its last run, which is saved in
+    `statedir`, or by `plan_throughput` setting (default: 50M per
+    second) for sources without history.
+    """
+    default_throughput = 50 * 1024 * 1024
+
+    def __init__(self, path, throughput=None):
+        self.path = path
+        self.throughput = parse_size(throughput) or self.default_throughput
+        self._lock = threading.Lock()
+
+    def estimate(self, source, size):
+        """Estimate seconds to backup source, `None` if unknown."""
+        last = _load_json(self.path, {}).get(source.get_key())
+        if last and size is None:
+            return last['seconds']
+        if size is None:
+            return None
+        throughput = self.throughput
+        if last and last['size'] and last['seconds']:
+            throughput = last['size'] / last['seconds']
+        return size / throughput
+
+    def plan(self, sources):
+        """
+        Get list of 3-tuples: (source, size, seconds) ordered by
+        estimated duration, sources with unknown one are the last.
+        """
+        items = []
+        for source in sources:
+            size = source.estimate_size()
+            items.append((source, size, self.estimate(source, size)))
+        return sorted(items, key=lambda item: (item[2] is None,
+                                               -(item[2] or 0)))
+
+    def record(self, source, size, seconds):
+        """Save size and duration of source run."""
+        with self._lock:
+            history = _load_json(self.path, {})
+            history[source.get_key()] = {'size': size, 'seconds': seconds}
+            _save_json(self.path, history)
+
+    @staticmethod
+    def wall_time(plan, workers):
+        """Estimate total time to run plan by `workers` concurrently."""
+        finish = [0.0] * max(1, workers)
+        for _, _, seconds in plan:
+            heapq.heapreplace(finish, finish[0] + (seconds or 0))
+        return max(finish)
+
+
+class StageLimits(object):
+    """
+    Concurrency limits for backup stages, e.g. {'dump': 2, 'upload': 4}.
+    Stage without limit is not restricted. Optional key is used to
+    limit stage per resource, e.g. dumps per database host.
+    """
+    def __init__(self, limits):
+        self.limits = limits or {}
+        self._lock = threading.Lock()
+        self._reserve_lock = threading.Lock()
+        self._semaphores = {}
+
+    def get_limit(self, stage):
+        """Get limit of stage, `None` if it's not limited."""
+        limit = self.limits.get(stage)
+        return int(limit) if limit else None
+
+    def _get_semaphore(self, stage, key):
+        limit = self.get_limit(stage)
+        if not limit:
+            return None
+        with self._lock:
+            semaphore = self._semaphores.get((stage, key))
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(limit)
+                self._semaphores[(stage, key)] = semaphore
+            return semaphore
+
+    @contextmanager
+    def acquire(self, stage, key=None):
+        """Context manager to hold a slot for stage while running."""
+        semaphore = self._get_semaphore(stage, key)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+    def update(self, limits):
+        """
+        Set new limits, e.g. on config reload. Slots of stages with
+        changed limit held by running processes are released to the
+        previous semaphores, so such stages could briefly exceed it.
+        """
+        limits = limits or {}
+        with self._lock:
+            for stage, key in list(self._semaphores):
+                if limits.get(stage) != self.limits.get(stage):
+                    del self._semaphores[(stage, key)]
+            self.limits = limits
+
+    def reserve(self, stage, count, key=None):
+        """
+        Take `count` slots of stage at once for processes which must
+        run together, `count` must not exceed the limit. Reservations
+        are made in turn, so callers holding part of slots don't wait
+        for each other. Return list of callables, every one releases
+        one slot.
+        """
+        semaphore = self._get_semaphore(stage, key)
+        if semaphore is None:
+            return [lambda: None for _ in range(count)]
+        if count > self.get_limit(stage):
+            raise ValueError("Can't reserve %s slots of `%s`, limit is "
+                             "%s" % (count, stage, self.get_limit(stage)))
+        releases = []
+        with self._reserve_lock:
+            for _ in range(count):
+                semaphore.acquire()
+                releases.append(semaphore.release)
+        return releases
+
+
+class RateLimiter(object):
+    """
+    Token bucket to limit rate in bytes per second. Rate is a size,
+    e.g. `5M`, or time of day profile: dict of ranges to sizes, e.g.
+    {'08:00-20:00': '5M', '20:00-08:00': '50M'}. Zero rate or time out
+    of ranges is unlimited. Bucket holds up to `burst` seconds of rate.
+    """
+    def __init__(self, rate, burst=1.0):
+        self.profile = []
+        if isinstance(rate, dict):
+            for period, value in rate.items():
+                start, end = [self._parse_time(t)
+                              for t in str(period).split('-')]
+                self.profile.append((start, end, parse_size(value) or 0))
+        else:
+            self.profile.append((0, 24 * 60, parse_size(rate) or 0))
+        self.burst = float(burst)
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._updated = None
+
+    @staticmethod
+    def _parse_time(value):
+        hours, minutes = value.strip().split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def get_rate(self, now=None):
+        """Get rate for time of day, `0` means unlimited."""
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.profile:
+            if start <= minute < end or (
+                    end <= start and (minute >= start or minute < end)):
+                return rate
+        return 0
+
+    def reserve(self, size):
+        """
+        Take `size` tokens from bucket. Return seconds to wait until
+        they are available, concurrent callers wait in turn.
+        """
+        rate = self.get_rate()
+        with self._lock:
+            now = time.monotonic()
+            if not rate:
+                self._tokens = None
+                return 0
+            capacity = rate * self.burst
+            if self._tokens is None:
+                self._tokens = capacity
+            else:
+                self._tokens = min(capacity, self._tokens +
+                                   (now - self._updated) * rate)
+            self._updated = now
+            self._tokens -= size
+            return max(0, -self._tokens / rate)
+
+
+class ThrottledBody(io.BytesIO):
+    """
+    Upload body, which takes bandwidth tokens by blocks while it's
+    read for sending, so part is sent at limited rate instead of line
+    speed. Reads before sending, e.g. for payload hash, are not
+    throttled: body is armed by `before-send` event handler.
+    """
+    block_size = 64 * 1024
+
+    def __init__(self, data, throttle):
+        super().__init__(data)
+        self.armed = False
+        self._throttle = throttle
+        self._pending = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        if self.armed:
+            self._pending += len(data)
+            if self._pending >= self.block_size or not data:
+                self._throttle(self._pending)
+                self._pending = 0
+        return data
+
+
+def _arm_throttled_body(request=None, **kwargs):
+    """Arm :class:`ThrottledBody` of request, which is about to be sent."""
+    body = getattr(request, 'body', None)
+    while body is not None:
+        if isinstance(body, ThrottledBody):
+            body.armed = True
+            return
+        # checksum wrappers keep original body as `_raw`
+        body = getattr(body, '_raw', None)
+
+
+class TempSpace(object):
+    """
+    Temp directories of backup sources within disk budget. Estimated
+    temp size of source is reserved before it starts, source which
+    doesn't fit `budget` or free disk space waits for running ones,
+    source larger than budget runs alone. Free space is checked only
+    if `budget` or `min_free` is set, as estimates are upper bounds,
+    otherwise it's just reported. Temp directory is removed when
+    source is finished.
+    """
+    # Prefix of temp directories, used to find stale ones
+    prefix = 'coverme-'
+
+    # Lock file with owner PID, it's locked while directory is in use
+    lock_name = '.coverme.lock'
+
+    def __init__(self, base_dir, budget=None, min_free=None):
+        self.base_dir = base_dir
+        self.budget = budget
+        self.min_free = min_free or 0
+        self.check_free = budget is not None or min_free is not None
+        self.reserved = 0
+        self.running = 0
+        self._cond = threading.Condition()
+        self._kept = set()
+
+    def update(self, budget=None, min_free=None):
+        """
+        Set new limits, e.g. on config reload, waiting sources check
+        them again. Space reserved by running sources is kept.
+        """
+        with self._cond:
+            self.budget = budget
+            self.min_free = min_free or 0
+            self.check_free = budget is not None or min_free is not None
+            self._cond.notify_all()
+
+    @contextmanager
+    def temp_dir(self, size=None, path=None):
+        """
+        Context manager to reserve `size` bytes and make temp directory
+        or reuse existing one by `path`. Directory is removed on exit
+        even if backup has failed, unless it's marked by :meth:`keep()`.
+        """
+        size = size or 0
+        with self.reserve(size):
+            temp_dir = path or _smaketemp(self.base_dir, prefix=self.prefix)
+            lock = self._lock(temp_dir)
+            try:
+                yield temp_dir
+            finally:
+                if temp_dir in self._kept:
+                    self._kept.discard(temp_dir)
+                else:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                lock.close()
+
+    def keep(self, path):
+        """
+        Keep temp directory on exit, e.g. to resume failed upload, it's
+        removed by :meth:`cleanup()` when expired.
+        """
+        self._kept.add(path)
+
+    @contextmanager
+    def reserve(self, size):
+        """Context manager to hold `size` bytes of temp space."""
+        if not self.check_free and size:
+            _smakedirs(self.base_dir)
+            free = shutil.disk_usage(self.base_dir).free
+            if size > free:
+                echo("*** estimated temp size %s bytes exceeds free space "
+                     "%s bytes in %s" % (size, free, self.base_dir))
+        with self._cond:
+            while not self._fits(size):
+                if not self.running:
+                    raise RuntimeError(
+                        "Not enough free space in %s for %s bytes" % (
+                            self.base_dir, size))
+                self._cond.wait()
+            self.reserved += size
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.reserved -= size
+                self.running -= 1
+                self._cond.notify_all()
+
+    def cleanup(self, max_age):
+        """
+        Remove temp directories older than `max_age` seconds, which are
+        not in use by this or another running process.
+        """
+        if not os.path.isdir(self.base_dir):
+            return
+        expired = time.time() - max_age
+        for name in os.listdir(self.base_dir):
+            path = os.path.join(self.base_dir, name)
+            if (name.startswith(self.prefix) and os.path.isdir(path) and
+                    os.path.getmtime(path) < expired and
+                    not self._is_locked(path)):
+                echo("... remove stale temp dir %s" % path)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _lock(self, path):
+        """
+        Write PID to lock file in directory and lock it, lock is held
+        until returned file is closed.
+        """
+        fp = open(os.path.join(path, self.lock_name), 'a+')
+        if fcntl is not None:
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                fp.close()
+                raise RuntimeError("Temp dir %s is already in use" % path)
+        fp.seek(0)
+        fp.truncate()
+        fp.write(str(os.getpid()))
+        fp.flush()
+        return fp
+
+    def _is_locked(self, path):
+        """
+        Check if directory is in use: its lock file is locked, or it's
+        owned by this process where file locks are not available.
+        """
+        try:
+            with open(os.path.join(path, self.lock_name)) as fp:
+                if fcntl is None:
+                    return fp.read().strip() == str(os.getpid())
+                try:
+                    fcntl.flock(fp, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    return True
+        except IOError:
+            pass
+        return False
+
+    def _fits(self, size):
+        if (self.budget and self.running and
+                self.reserved + size > self.budget):
+            return False
+        if not self.check_free:
+            return True
+        _smakedirs(self.base_dir)
+        free = shutil.disk_usage(self.base_dir).free
+        # Running sources may have not used reserved space yet
+        return free - self.reserved - size >= self.min_free
+
+
+class RunJournal(object):
+    """
+    Persistent journal of sources runs: archived files in temp
+    directory and vaults they are uploaded to. Entry of source is
+    removed when it's uploaded to all vaults, so failed run could be
+    resumed with only missing uploads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get journal entry of source by key."""
+        with self._lock:
+            return _load_json(self.path, {}).get(key)
+
+    def update(self, key, **fields):
+        """Update journal entry of source with fields."""
+        with self._lock:
+            journal = _load_json(self.path, {})
+            journal.setdefault(key, {}).update(fields)
+            _save_json(self.path, journal)
+
+    def add_upload(self, key, name, vault_key, data):
+        """Record upload of file `name` to vault."""
+        with self._lock:
+            journal = _load_json(self.path, {})
+            uploads = journal.setdefault(key, {}).setdefault('uploads', {})
+            uploads.setdefault(name, {})[vault_key] = data
+            _save_json(self.path, journal)
+
+    def remove(self, key):
+        """Remove journal entry of source."""
+        with self._lock:
+            journal = _load_json(self.path, {})
+            if journal.pop(key, None) is not None:
+                _save_json(self.path, journal)
+
+
+class ClientPool(object):
+    """
+    Shared boto3 clients for vaults, one per service, credentials,
+    region and endpoint. Low-level clients are thread-safe, so they
+    are shared by all vaults with the same settings along with their
+    connections pool, while boto3 resources are not and aren't used.
+    boto3 is imported on first use, so config validation doesn't load
+    it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._clients = {}
+
+    def client(self, service, profile=None, region=None,
+               access_key_id=None, secret_access_key=None,
+               endpoint_url=None, max_pool_connections=None,
+               tcp_keepalive=None):
+        """Get shared boto3 client, create it on first call."""
+        key = (service, profile, region, access_key_id, secret_access_key,
+               endpoint_url, max_pool_connections, tcp_keepalive)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                import boto3.session
+                import botocore.config
+                session_key = (profile, access_key_id, secret_access_key)
+                session = self._sessions.get(session_key)
+                if session is None:
+                    session = boto3.session.Session(
+                        profile_name=profile,
+                        aws_access_key_id=access_key_id,
+                        aws_secret_access_key=secret_access_key,
+                    )
+                    self._sessions[session_key] = session
+                options = {}
+                if max_pool_connections:
+                    options['max_pool_connections'] = int(
+                        max_pool_connections)
+                if tcp_keepalive is not None:
+                    options['tcp_keepalive'] = bool(tcp_keepalive)
+                client = session.client(
+                    service,
+                    region_name=region,
+                    endpoint_url=endpoint_url,
+                    config=botocore.config.Config(**options)
+                )
+                self._clients[key] = client
+            return client
+
+
+class Backup(object):
+    def __init__(self, settings, environ, source_filter=None):
+        self.defaults = settings.get('defaults', {})
+        self.clients = ClientPool()
+        configs = settings['backups']
+        vaults = settings['vaults']
+        if source_filter:
+            # Only sources to run and their vaults are created
+            configs = [conf for conf in configs if source_filter.match(conf)]
+            vault_keys = set()
+            for conf in configs:
+                keys = conf.get('to') or ['*']
+                vault_keys.update(vaults if keys[0] == '*' else keys)
+            vaults = dict((k, v) for k, v in vaults.items()
+                          if k in vault_keys)
+        self.sources = self._make_sources(configs, environ)
+        self.vaults = self._make_vaults(vaults, environ)
+        limits = dict(self.defaults.get('limits') or {})
+        if self.defaults.get('max_parallel'):
+            limits.setdefault('table', self.defaults['max_parallel'])
+        self.limits = StageLimits(limits)
+        self.metrics = Metrics(self.defaults.get('metrics'))
+        self.temp_space = TempSpace(
+            self.get_temp_dir(),
+            budget=parse_size(self.defaults.get('tmp_budget')),
+            min_free=parse_size(self.defaults.get('tmp_min_free')))
+        self.bandwidth = (RateLimiter(self.defaults['bandwidth'])
+                          if self.defaults.get('bandwidth') else None)
+        self.journal = RunJournal(os.path.join(self.get_state_dir(),
+                                               'journal.json'))
+        self._waits = threading.local()
+        self.planner = Planner(os.path.join(self.get_state_dir(),
+                                            'plan.json'),
+                               self.defaults.get('plan_throughput'))
+        self._local_vaults = {}
+        self._local_lock = threading.Lock()
+        self.resume = False
+
+    def keep_shared(self, prev):
+        """
+        Share clients, stage limits, temp space and journal with
+        previous instance on config reload, so sources still running
+        by it are accounted with new ones.
+        """
+        self.clients = prev.clients
+        prev.limits.update(self.limits.limits)
+        self.limits = prev.limits
+        if prev.temp_space.base_dir == self.temp_space.base_dir:
+            prev.temp_space.update(
+                parse_size(self.defaults.get('tmp_budget')),
+                parse_size(self.defaults.get('tmp_min_free')))
+            self.temp_space = prev.temp_space
+        if prev.journal.path == self.journal.path:
+            self.journal = prev.journal
+
+    @classmethod
+    def create_with_config(cls, environ, path=None,
+                           stream=None, file_format=None,
+                           source_filter=None):
+        """
+        Read config and create backup instance with config, only
+        sources matching `source_filter` are created if it's provided.
+        Return 2-tuple: (instance, errors)
+
+        If configuration contais errors, `instance` is not created,
+        and `errors` is a dict with error keys and readable
+        descriptions.
+        """
+        if path:
+            _, ext = os.path.splitext(path)
+            if not file_format:
+                if ext in ('.json',):
+                    file_format = 'json'
+                else:
+                    file_format = 'yaml'
+
+            load = yaml.safe_load if file_format == 'yaml' else json.loads
+
+            try:
+                with open(path) as fp:
+                    settings = load(fp)
+                    echo("... reading config from %s" % path)
+            except IOError:
+                return None, {'path': path, '': "No config file found"}
+        elif stream:
+            echo("Reading config from stdin")
+            text = '\n'.join([line for line in stream])
+            if text.startswith('---'):
+                settings = yaml.safe_load(text)
+            else:
+                settings = json.loads(text)
+        else:
+            raise Exception("Either config path or stream must be provided.")
+
+        errors = cls.validate(settings)
+        if not errors and source_filter and not any(
+                source_filter.match(conf) for conf in settings['backups']):
+            errors['backups'] = "No sources match filters"
+        if not errors:
+            try:
+                return cls(settings=settings, environ=environ,
+                           source_filter=source_filter), None
+            except Exception as e:
+                errors = {'': e}
+
+        errors['path'] = path
+        return None, errors
+
+    @classmethod
+    def validate(cls, settings):
+        """Validate settings and show human readable errors."""
+        errors = {}
+        if not settings.get('backups'):
+            errors['backups'] = "Section `backups` is empty"
+        if not settings.get('vaults'):
+            errors['vaults'] = "Section `vaults` is empty"
+        return errors
+
+    def run(self, resume=False):
+        """
+        Run backup for all sources. If `workers` setting is greater
+        than 1, sources are processed concurrently, so dump, archive
+        and upload stages of different sources overlap within
+        `limits` per stage. With `resume` sources with unfinished
+        uploads in journal are uploaded only to vaults missing them.
+        """
+        echo("... started at [%s]" % datetime.datetime.now())
+        self.resume = resume
+        self.set_priority()
+        self.temp_space.cleanup(
+            float(self.defaults.get('tmp_max_age', 24)) * 3600)
+        workers = int(self.defaults.get('workers') or 1)
+        plan = self.plan()
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(lambda item: self._run_planned(*item), plan))
+        else:
+            for item in plan:
+                self._run_planned(*item)
+        self.metrics.export()
+        echo("... completed at [%s]" % datetime.datetime.now())
+
+    def plan(self):
+        """
+        Get sources in order to run: list of 3-tuples (source, size,
+        seconds) with estimated size and duration, the longest first.
+        """
+        return self.planner.plan(self.sources)
+
+    def _run_planned(self, source, size, seconds):
+        """
+        Run source and save its duration for next plans, resumed runs
+        are not saved as they don't take full time. Estimated `size`
+        is reused for temp space reservation.
+        """
+        resumed = self.resume and self.journal.get(source.get_key())
+        self._waits.seconds = 0
+        started = time.time()
+        if self._run_source(source, size) and size and not resumed:
+            self.planner.record(source, size, time.time() - started -
+                                self._waits.seconds)
+
+    def _add_wait(self, seconds):
+        """
+        Count seconds source waited for stage limits or temp space in
+        current thread, they're not included in recorded duration.
+        """
+        self._waits.seconds = getattr(self._waits, 'seconds', 0) + seconds
+
+    def set_priority(self):
+        """
+        Lower priority of the process with `nice` and `ionice` settings
+        in defaults, so dumps and compression don't slow down other
+        processes on the host.
+        """
+        try:
+            set_priority(self.defaults.get('nice'),
+                         self.defaults.get('ionice'))
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            echo("*** can't set priority: %s" % e)
+
+    @contextmanager
+    def stage(self, name, key=None, source=None):
+        """
+        Context manager to run backup stage within concurrency limits,
+        stage name is one of: 'dump', 'archive', 'upload' and 'table'
+        for per-table dump processes. If `source` is provided, stage
+        is measured and metrics record is yielded.
+        """
+        started = time.time()
+        with self.limits.acquire(name, key):
+            self._add_wait(time.time() - started)
+            if source is None:
+                yield None
+            else:
+                with self.metrics.measure(name, source) as record:
+                    yield record
+
+    def reserve_stage(self, name, count, key=None):
+        """
+        Reserve `count` slots of stage at once for processes which must
+        start together, e.g. dumps in one consistent snapshot. Return
+        list of callables, every one releases one slot.
+        """
+        started = time.time()
+        releases = self.limits.reserve(name, count, key)
+        self._add_wait(time.time() - started)
+        return releases
+
+    def _run_source(self, source, size=None):
+        """
+        Run backup for single source, errors are reported only. Source
+        `size` is estimated if it's not provided. Return `True` if
+        source is finished without errors.
+        """
+        source.timestamp = datetime.datetime.now()
+        try:
+            entry = self.journal.get(source.get_key())
+            if entry and self.resume and self._can_resume(source, entry):
+                echo("... resume %s from %s" % (source, entry['temp_dir']))
+                with self.temp_space.temp_dir(
+                        path=entry['temp_dir']) as temp_dir:
+                    self._resume(source, entry, temp_dir)
+                return True
+            if entry:
+                self._discard_journal(source, entry)
+            temp_size = source.estimate_temp_size(size)
+            if temp_size:
+                echo("... reserve %s bytes of temp space for %s" % (
+                    temp_size, source))
+            started = time.time()
+            with self.temp_space.temp_dir(temp_size) as temp_dir:
+                self._add_wait(time.time() - started)
+                self._run_with_temp_dir(source, temp_dir, size)
+            return True
+        except Exception as e:
+            echo('*** error in %s: %s' % (source, e))
+            return False
+
+    def get_temp_dir(self):
+        """Get base temp directory path."""
+        return os.path.realpath(self.defaults.get('tmpdir', '/tmp'))
+
+    def get_local_dir(self):
+        """Get directory path for local backups."""
+        localdir = self.defaults.get('localdir')
+        if localdir:
+            return os.path.realpath(localdir)
+
+    def get_state_dir(self):
+        """
+        Get directory path for state persistent between runs, e.g.
+        unfinished uploads info.
+        """
+        statedir = self.defaults.get('statedir') or '~/.coverme'
+        return os.path.realpath(os.path.expanduser(statedir))
+
+    def _run_with_temp_dir(self, source, temp_dir, size=None):
+        """
+        Run backup for source within temp directory, estimated `size`
+        of source is used by streaming uploads to choose part size.
+        """
+        if source.is_streaming():
+            return self._run_streaming(source, temp_dir, size)
+        if source.is_sharded():
+            return self._run_sharded(source, temp_dir)
+        arch_path = source.archive(temp_dir)
+        if arch_path:
+            upload_name = source.get_archive_fullname()
+            files = [(arch_path, upload_name)] + source.get_attachments()
+            self.journal.update(
+                source.get_key(), name=upload_name, temp_dir=temp_dir,
+                timestamp=source.timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                state=source.get_state(), uploads={},
+                files=[[path, name, os.path.getsize(path), None]
+                       for path, name in files])
+            self._upload_files(source, temp_dir, upload_name, files, {})
+        else:
+            echo("*** nothing to upload from source %s" % source)
+
+    def _upload_files(self, source, temp_dir, upload_name, files, uploaded):
+        """
+        Upload archive and attachments files, skip vaults which are in
+        `uploaded` dict by files names. All files are encrypted if
+        source has `encryption_key`. Every upload is recorded in
+        journal. If some uploads fail, temp directory is kept and files
+        checksums are saved to journal to resume later.
+        """
+        key = source.get_key()
+        results = {}
+        for path, name in files:
+            done = uploaded.get(name, {})
+            results[name] = dict((k, (True, data))
+                                 for k, data in done.items())
+            vault_keys = [k for k in self._get_vault_keys(source)
+                          if k not in done]
+            if vault_keys:
+                content_hash = None
+                if name == upload_name:
+                    content_hash = source.content_hash
+                results[name].update(self._upload_file(
+                    source, path, name, encrypt=True,
+                    content_hash=content_hash, vault_keys=vault_keys))
+            for k, (success, data) in results[name].items():
+                if success and k not in done:
+                    self.journal.add_upload(key, name, k, data)
+        source.after_upload(results)
+        self._prune_uploaded(source, results[upload_name])
+        if all(success for vaults in results.values()
+               for success, _ in vaults.values()):
+            self.journal.remove(key)
+        else:
+            self.journal.update(key, files=[
+                [path, name, os.path.getsize(path), _file_digest(path)]
+                for path, name in files])
+            self.temp_space.keep(temp_dir)
+            echo("*** upload of %s is incomplete, run `coverme backup "
+                 "--resume` to retry" % upload_name)
+
+    def _can_resume(self, source, entry):
+        """Check that files of journal entry are intact."""
+        for path, name, size, digest in entry['files']:
+            if (not os.path.isfile(path) or os.path.getsize(path) != size or
+                    (digest and _file_digest(path) != digest)):
+                echo("*** can't resume %s, file %s is changed" % (
+                    source, path))
+                return False
+        return True
+
+    def _resume(self, source, entry, temp_dir):
+        """Upload files from journal entry to vaults missing them."""
+        source.timestamp = datetime.datetime.strptime(
+            entry['timestamp'], '%Y-%m-%dT%H:%M:%S.%f')
+        source.set_state(entry.get('state') or {})
+        files = [(path, name) for path, name, _, _ in entry['files']]
+        self._upload_files(source, temp_dir, entry['name'], files,
+                           entry.get('uploads') or {})
+
+    def _discard_journal(self, source, entry):
+        """Remove unfinished run of source and its kept temp directory."""
+        temp_dir = entry.get('temp_dir')
+        if temp_dir and os.path.basename(temp_dir).startswith(
+                self.temp_space.prefix):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.journal.remove(source.get_key())
+
+    def _get_vault_keys(self, source):
+        """Get keys of vaults of source, local backups dir is the last."""
+        vault_keys = source.get_vault_keys()
+        if vault_keys[0] == '*':
+            vault_keys = list(self.vaults.keys())
+        if source.get_local_dir():
+            vault_keys = list(vault_keys) + [LOCAL_VAULT_KEY]
+        return vault_keys
+
+    def _get_vault(self, source, vault_key):
+        """Get vault by key, `localdir` is local backups dir of source."""
+        if vault_key == LOCAL_VAULT_KEY:
+            if not source.get_local_dir():
+                raise ValueError("No `localdir` is set for %s" % source)
+            return self.get_local_vault(source.get_local_dir())
+        return self.vaults[vault_key]
+
+    def get_local_vault(self, path):
+        """Get vault for local backups directory."""
+        with self._local_lock:
+            vault = self._local_vaults.get(path)
+            if vault is None:
+                vault = LocalVault(self, {'service': 'local', 'path': path},
+                                   {})
+                self._local_vaults[path] = vault
+            return vault
+
+    def _run_sharded(self, source, temp_dir):
+        """
+        Run backup for source in sharded mode: shards are archived in
+        process pool and every shard is uploaded as soon as it's ready,
+        up to `shard_uploads` at once. Shards and manifest are encrypted
+        if source has `encryption_key`. Manifest of shards is uploaded
+        last, only to vaults where all shards are uploaded. Upload to
+        vault succeeds only if all shards and manifest are uploaded.
+        """
+        upload_name = source.get_archive_fullname()
+        files = []
+        results = {}
+
+        def upload(path, name):
+            results[name] = self._upload_file(source, path, name,
+                                              encrypt=True)
+            os.unlink(path)
+
+        with ThreadPoolExecutor(
+                max_workers=source.get_shard_uploads()) as pool:
+            futures = []
+            for path, name in source.iter_shards(temp_dir):
+                files.append((path, name))
+                futures.append(pool.submit(upload, path, name))
+            for future in futures:
+                future.result()
+        merged = {}
+        for vaults in results.values():
+            for k, (success, data) in vaults.items():
+                if not success and k not in merged:
+                    merged[k] = (success, data)
+        vault_keys = [k for k in self._get_vault_keys(source)
+                      if k not in merged]
+        for k in merged:
+            echo("*** shards manifest is not uploaded to %s" % (
+                self._get_vault(source, k)))
+        attachments = source.get_attachments()
+        # Vaults without failed shards succeed by the manifest upload,
+        # or by shards alone if there's nothing to attach
+        last = dict((k, (True, {})) for k in vault_keys)
+        for path, name in attachments:
+            if vault_keys:
+                last = self._upload_file(source, path, name, encrypt=True,
+                                         vault_keys=vault_keys)
+            else:
+                last = {}
+            results[name] = last
+        for k, result in last.items():
+            merged.setdefault(k, result)
+        echo("... uploaded %s shards of %s" % (len(files), upload_name))
+        source.after_upload(results)
+        self._prune_uploaded(source, merged)
+
+    def _upload_file(self, source, path, name, content_hash=None,
+                     encrypt=False, vault_keys=None):
+        """
+        Upload file with :meth:`_upload()`. If `encrypt` is enabled and
+        source has `encryption_key`, file is encrypted while reading.
+        """
+        key = source.get_encryption_key() if encrypt else None
+        size = os.path.getsize(path)
+        with open(path, 'rb') as stream:
+            if key:
+                # Vaults read encrypted stream, not archive file
+                stream = IterStream(iter_encrypt(iter_chunks(stream), key))
+                path = None
+                size = encrypted_size(size)
+                if content_hash:
+                    content_hash = hmac.new(
+                        key, content_hash.encode(), hashlib.sha256
+                    ).hexdigest()
+            return self._upload(source, stream, name, arch_path=path,
+                                content_hash=content_hash,
+                                vault_keys=vault_keys, size=size)
+
+    def _run_streaming(self, source, temp_dir, size=None):
+        """
+        Run backup for source in streaming mode: dump output is piped
+        through compressor directly to vaults, temp directory is used
+        only by sources which can't dump to stdout. Size of source data
+        is estimated if it's not provided, compressed stream is assumed
+        to be not larger.
+        """
+        upload_name = source.get_archive_fullname()
+        key = source.get_encryption_key()
+        if size is None:
+            size = source.estimate_size()
+        with self.stage('dump', source.get_host(), source) as record, \
+                source.open_stream(temp_dir) as stream:
+            output = stream
+            if key:
+                output = IterStream(iter_encrypt(iter_chunks(stream), key))
+                if size is not None:
+                    size = encrypted_size(size)
+            results = self._upload(source, output, upload_name, size=size)
+            record['bytes_in'] = getattr(stream.source, 'bytes_read', None)
+            record['bytes_out'] = output.bytes_read
+        self._prune_uploaded(source, results)
+
+    def _upload(self, source, stream, upload_name, arch_path=None,
+                content_hash=None, vault_keys=None, size=None):
+        """
+        Upload stream to all source vaults concurrently, the stream is
+        read only once. Vaults without streaming support read archive
+        file by `arch_path` if provided. If `content_hash` is provided,
+        vaults where last upload of source has the same hash reuse it
+        instead of upload. Return dict of 2-tuples per vault key:
+        ((bool) success, (dict) archive data or error). Upload could
+        be limited to `vault_keys` of source. Expected stream `size`
+        is used to choose multipart upload part size. Failed uploads of
+        archive file by `arch_path` could be resumed.
+        """
+        vault_keys = vault_keys or self._get_vault_keys(source)
+        vaults = dict((k, self._get_vault(source, k)) for k in vault_keys)
+        streamed = [k for k in vault_keys
+                    if not arch_path or not vaults[k].reads_file(arch_path)]
+        fanout = FanOut(stream, len(streamed))
+        readers = dict(zip(streamed, fanout.readers))
+        results = {}
+
+        def upload(k):
+            vault = vaults[k]
+            reader = readers.get(k)
+            metadata = {'content-sha256': content_hash} if content_hash else {}
+            with self.metrics.measure('upload', source, k) as record:
+                try:
+                    results[k] = None
+                    if content_hash:
+                        results[k] = vault.upload_unchanged(
+                            source.get_key(), content_hash, upload_name)
+                    if results[k]:
+                        record['bytes_in'] = 0
+                    elif reader:
+                        results[k] = vault.upload_stream(
+                            reader, upload_name, metadata=metadata,
+                            size=size, resumable=bool(arch_path))
+                    else:
+                        results[k] = vault.upload(
+                            arch_path, upload_name=upload_name,
+                            metadata=metadata)
+                    if content_hash and results[k][0]:
+                        vault.save_content_hash(source.get_key(), content_hash,
+                                                upload_name, results[k][1])
+                except Exception as e:
+                    results[k] = (False, e)
+                finally:
+                    if reader:
+                        reader.detach()
+                record['success'] = results[k][0]
+                if record['bytes_in'] is None:
+                    record['bytes_in'] = (reader.bytes_read if reader
+                                          else os.path.getsize(arch_path))
+            if results[k][0]:
+                echo("+++ uploaded to %s: %s" % (vault, results[k][1]))
+            else:
+                echo("*** not uploaded to %s: %s" % (vault, results[k][1]))
+
+        with self.stage('upload'):
+            with ThreadPoolExecutor(max_workers=len(vault_keys)) as pool:
+                futures = [pool.submit(upload, k) for k in vault_keys]
+                if streamed:
+                    fanout.run()
+                for future in futures:
+                    future.result()
+
+        succeeded = sum(1 for k in vault_keys if results[k][0])
+        echo("... uploaded %s to %s of %s vaults" % (
+            upload_name, succeeded, len(vault_keys)))
+        return results
+
+    def prune(self, source, vault_keys=None, dry_run=False):
+        """
+        Delete backups of source from vaults according to `keep`
+        retention policy. Backups are found by listing vaults with
+        source name pattern. Return number of deleted objects.
+        """
+        if vault_keys is None:
+            vault_keys = self._get_vault_keys(source)
+        deleted = 0
+        for k in vault_keys:
+            policy = source.get_retention(k)
+            if not policy:
+                continue
+            vault = self._get_vault(source, k)
+            with self.metrics.measure('prune', source, k) as record:
+                groups = self.find_backups(source, vault)
+                keep = policy.select([(group['time'], name)
+                                      for name, group in groups.items()])
+                if source.is_incremental():
+                    keep = self._keep_chains(source, vault, groups, keep)
+                delete = [entry for name, group in groups.items()
+                          if name not in keep for entry in group['entries']]
+                echo("... keep %s of %s backups of %s in %s (%s)%s" % (
+                    len(keep), len(groups), source, vault, policy,
+                    ', dry run' if dry_run else ''))
+                for entry in delete:
+                    echo("... %s %s" % ('would delete' if dry_run
+                                         else 'delete', entry['key']))
+                if delete and not dry_run:
+                    vault.delete_archives(delete)
+                    echo("+++ deleted %s objects from %s" % (
+                        len(delete), vault))
+                    deleted += len(delete)
+                record['bytes_in'] = sum(entry.get('size') or 0
+                                         for entry in delete)
+        return deleted
+
+    def find_backups(self, source, vault):
+        """
+        Find backups of source in vault by listing with source name
+        pattern. Return dict by backup name: {'time': datetime,
+        'entries': list of archive, manifest and index entries}.
+        """
+        pattern, prefix = source.get_name_pattern()
+        groups = {}
+        for entry in vault.list_archives(prefix):
+            match = pattern.match(entry['key'])
+            if not match:
+                continue
+            group = groups.setdefault(match.group('name'), {
+                'time': source.get_backup_time(match, entry['modified']),
+                'entries': [],
+            })
+            group['entries'].append(entry)
+        return groups
+
+    def find_source(self, query):
+        """Find source by `id`, key, name pattern, path or URL."""
+        for source in self.sources:
+            if query in (source.get_key(), str(source),
+                         source.settings.get('name'),
+                         source.settings.get('path'),
+                         source.settings.get('url')):
+                return source
+        raise ValueError("Source `%s` is not found" % query)
+
+    def restore(self, source, vault_key=None, date=None, to_dir=None,
+                load=False):
+        """
+        Restore latest backup of source made before `date` (latest at
+        all by default) from vault: extract to `to_dir` or load to
+        database with `load`. Archive is downloaded and extracted as
+        stream. For incremental archives full archive and following
+        ones are extracted in order, sharded archive is extracted by
+        shards listed in its manifest.
+        """
+        vault_key = vault_key or self._get_vault_keys(source)[0]
+        vault = self._get_vault(source, vault_key)
+        groups = self.find_backups(source, vault)
+        names = sorted((group['time'], name) for name, group in groups.items()
+                       if date is None or group['time'] <= date)
+        if not names:
+            raise ValueError("No backups of %s found in %s" % (source, vault))
+        name = names[-1][1]
+        chain = [name]
+        if source.is_incremental():
+            base = self._get_base(source, vault, groups, name)
+            chain = [other for _, other in names
+                     if groups[other]['time'] >= groups[base]['time'] and
+                     self._get_base(source, vault, groups, other) == base]
+        for name in chain:
+            entries = groups[name]['entries']
+            echo("... restore %s from %s" % (name, vault))
+            keys = [name]
+            shards = self._find_entry(entries, name + '.shards.json')
+            if shards:
+                with self._open_entry(source, vault, shards, name) as stream:
+                    manifest = json.loads(stream.read())
+                keys = [shard['name'] for shard in manifest['shards']]
+            for key in keys:
+                entry = self._find_entry(entries, key)
+                if not entry:
+                    raise ValueError("Archive %s is not found in %s" % (
+                        key, vault))
+                self._restore_archive(source, vault, entry, name,
+                                      to_dir, load)
+            if not load:
+                source.after_extract(to_dir)
+            echo("+++ restored %s" % name)
+        return chain
+
+    def _restore_archive(self, source, vault, entry, name, to_dir, load):
+        """
+        Download archive entry from vault and extract it or load to
+        source, archive format is found by backup `name`.
+        """
+        with self.stage('restore', source=source) as record, \
+                self.temp_space.temp_dir() as temp_dir:
+            stream = self._open_entry(source, vault, entry, name)
+            if name.endswith(ENCRYPTION_EXTENSION):
+                name = name[:-len(ENCRYPTION_EXTENSION)]
+            try:
+                if load:
+                    source.load(iter_archive_files(stream, name, temp_dir),
+                                temp_dir)
+                else:
+                    extract_archive(stream, name, to_dir, temp_dir)
+            finally:
+                stream.close()
+            record['bytes_in'] = stream.bytes_read
+
+    def _open_entry(self, source, vault, entry, name):
+        """
+        Open archive or manifest entry of backup `name` from vault as
+        stream, it's decrypted if backup is encrypted.
+        """
+        key = None
+        if name.endswith(ENCRYPTION_EXTENSION):
+            key = self._get_key(source, name)
+        stream = vault.open_archive(entry)
+        if key:
+            stream = IterStream(iter_decrypt(iter_chunks(stream), key),
+                                source=stream)
+        return stream
+
+    def _find_entry(self, entries, key):
+        """Find archive entry by key, dedup index of key is matched too."""
+        for entry in entries:
+            if entry['key'] in (key, key + '.cdc.json'):
+                return entry
+
+    def _get_key(self, source, name):
+        key = source.get_encryption_key()
+        if not key:
+            raise ValueError("Archive %s is encrypted, `encryption_key` "
+                             "is required" % name)
+        return key
+
+    def _get_base(self, source, vault, groups, name):
+        """
+        Get full archive name of incremental archive by `base` field of
+        its manifest. Manifest head is read once and cached, head of
+        encrypted manifest is its first decrypted chunk.
+        """
+        group = groups[name]
+        if 'base' not in group:
+            group['base'] = name
+            for entry in group['entries']:
+                if '.manifest.json' not in entry['key']:
+                    continue
+                if name.endswith(ENCRYPTION_EXTENSION):
+                    with self._open_entry(source, vault, entry,
+                                          name) as stream:
+                        head = stream.read(4096).decode('utf-8', 'replace')
+                else:
+                    head = vault.read_head(entry)
+                match = re.search(r'"base": "((?:[^"\\]|\\.)*)"', head)
+                if match:
+                    group['base'] = json.loads('"%s"' % match.group(1))
+        return group['base']
+
+    def _keep_chains(self, source, vault, groups, keep):
+        """
+        Keep incremental archives chains entirely: full archive with
+        all following incremental ones are kept if any of them is kept.
+        Chain is found by `base` field of manifests.
+        """
+        def get_base(name):
+            return self._get_base(source, vault, groups, name)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            bases = dict(zip(groups, pool.map(get_base, list(groups))))
+        kept_bases = set(bases[name] for name in keep)
+        return set(name for name, base in bases.items()
+                   if name in keep or base in kept_bases)
+
+    def _prune_uploaded(self, source, results):
+        """Prune backups of source in vaults it's uploaded to."""
+        if not any(source.get_retention(k) for k in results):
+            return
+        try:
+            self.prune(source, [k for k, (success, _) in results.items()
+                                if success])
+        except Exception as e:
+            echo("*** prune failed for %s: %s" % (source, e))
+
+    def _make_sources(self, config_list, environ):
+        """
+        Create new sources by list of dicts. Return list
+        of `BackupSource` objects.
+        """
+        sources = []
+        environ = deepcopy(environ)
+        for conf in config_list:
+            source_type = conf.get('type')
+            if source_type == 'database':
+                source_url = conf['url']
+                scheme, _ = source_url.split('://', 1)
+                if scheme == 'postgres':
+                    source_cls = PostgresqlBackupSource
+                elif scheme == 'mysql':
+                    source_cls = MySQLBackupSource
+                else:
+                    raise ValueError(
+                        "Unknown scheme in URL `%s`" % source_url
+                    )
+            elif source_type == 'dir':
+                source_cls = DirBackupSource
+            else:
+                raise ValueError("Unknown source type `%s`" % source_type)
+            sources.append(source_cls(
+                self,
+                settings=deepcopy(conf),
+                environ=environ
+            ))
+        return sources
+
+    def _make_vaults(self, config_dict, environ):
+        """
+        Create new vaults by dict. Return dict of `BaseVault` objects.
+        """
+        vaults = {}
+        for k, conf in config_dict.items():
+            if k == LOCAL_VAULT_KEY:
+                raise ValueError("Vault key `%s` is reserved for local "
+                                 "backups" % k)
+            v_service = conf.get('service')
+            if v_service == 'glacier':
+                vault_cls = GlacierVault
+            elif v_service == 's3':
+                vault_cls = S3Bucket
+            else:
+                if v_service:
+                    raise ValueError("Unknown vault service `%s`" % v_service)
+                else:
+                    raise ValueError("Key `service` is missing for vault `%s`" % k)
+            vaults[k] = vault_cls(
+                self,
+                settings=deepcopy(conf),
+                environ=deepcopy(environ)
+            )
+        return vaults
+
+
+class Daemon(object):
+    """
+    Long-running scheduler, every source runs on its own `schedule`
+    (cron expression) or `every` interval after previous run, start is
+    delayed by random `jitter`. At most `max_jobs` sources run at once
+    and source is never run concurrently with itself. Config file is
+    reloaded on change, vaults clients, stage limits and temp space
+    are kept between runs.
+    """
+    def __init__(self, environ, path, poll_interval=10):
+        self.environ = environ
+        self.path = path
+        self.poll_interval = poll_interval
+        self.backup = None
+        self.jobs = {}
+        self.running = {}
+        self._mtime = None
+        self._pool = None
+        self._old_pools = []
+        self._max_jobs = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+
+    def run(self):
+        """Run scheduler until stopped by SIGTERM or SIGINT."""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: self.stop())
+            signal.signal(signal.SIGINT, lambda *args: self.stop())
+        if not self.reload():
+            raise RuntimeError("Can't load config `%s`" % self.path)
+        echo("... daemon started at [%s]" % datetime.datetime.now())
+        self.backup.set_priority()
+        self.backup.temp_space.cleanup(
+            float(self.backup.defaults.get('tmp_max_age', 24)) * 3600)
+        while not self._stop.is_set():
+            self.reload()
+            self.tick(datetime.datetime.now())
+            self._wakeup.wait(self._get_wait(datetime.datetime.now()))
+            self._wakeup.clear()
+        echo("... daemon stopping, waiting for %s jobs" % len(self.running))
+        for pool in self._old_pools + [self._pool]:
+            pool.shutdown(wait=True)
+        self._old_pools = []
+        echo("... daemon stopped at [%s]" % datetime.datetime.now())
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def reload(self):
+        """
+        Reload config if file is changed. Return `False` if config has
+        errors, previous config is kept then.
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            echo("*** can't read config: %s" % e)
+            return False
+        if mtime == self._mtime:
+            return True
+        self._mtime = mtime
+        backup, errors = Backup.create_with_config(self.environ,
+                                                   path=self.path)
+        if errors:
+            for k, v in errors.items():
+                echo("*** config error %s %s" % (k, v))
+            return False
+        if self.backup:
+            backup.keep_shared(self.backup)
+            echo("... config reloaded")
+        self.backup = backup
+        max_jobs = int(backup.defaults.get('max_jobs') or 1)
+        if max_jobs != self._max_jobs:
+            if self._pool:
+                # Running jobs are finished by previous pool
+                self._pool.shutdown(wait=False)
+                self._old_pools.append(self._pool)
+            self._pool = ThreadPoolExecutor(max_workers=max_jobs)
+            self._max_jobs = max_jobs
+        self._schedule_jobs()
+        return True
+
+    def tick(self, now):
+        """
+        Start jobs which are due at `now`. Slot of job is reserved
+        before it's submitted, as job could finish before submit
+        returns.
+        """
+        for key, job in sorted(self.jobs.items(), key=lambda x: x[1]['next']):
+            with self._lock:
+                if len(self.running) >= self._max_jobs:
+                    break
+                if key in self.running or job['next'] > now:
+                    continue
+                self.running[key] = job
+            try:
+                self._pool.submit(self._run_job, key, job)
+            except Exception:
+                with self._lock:
+                    self.running.pop(key, None)
+                raise
+
+    def _run_job(self, key, job):
+        source = job['source']
+        started = datetime.datetime.now()
+        try:
+            source.backup._run_source(source)
+            source.backup.metrics.export()
+        finally:
+            with self._lock:
+                last_runs = self._load_last_runs()
+                last_runs[key] = started.strftime('%Y-%m-%dT%H:%M:%S')
+                _save_json(self._last_runs_path(), last_runs)
+            job['next'] = self._next_time(job, started)
+            echo("... next run of %s at [%s]" % (source, job['next']))
+            with self._lock:
+                self.running.pop(key, None)
+            self._wakeup.set()
+
+    def _schedule_jobs(self):
+        last_runs = self._load_last_runs()
+        now = datetime.datetime.now()
+        jobs = {}
+        for source in self.backup.sources:
+            key = source.get_key()
+            try:
+                schedule = source.get_schedule()
+            except ValueError as e:
+                echo("*** invalid schedule for %s: %s" % (source, e))
+                continue
+            if not schedule:
+                echo("*** no schedule for %s, skipped" % source)
+                continue
+            jitter = parse_duration(source.settings.get(
+                'jitter', self.backup.defaults.get('jitter'))) or 0
+            job = self.jobs.get(key)
+            if job and str(job['schedule']) == str(schedule):
+                # Keep next run time of unchanged schedule
+                job.update(source=source, jitter=jitter)
+                jobs[key] = job
+                continue
+            job = {'source': source, 'schedule': schedule, 'jitter': jitter}
+            if not isinstance(schedule, IntervalSchedule):
+                job['next'] = self._next_time(job, now)
+            elif key in last_runs:
+                job['next'] = self._next_time(
+                    job, datetime.datetime.strptime(
+                        last_runs[key], '%Y-%m-%dT%H:%M:%S'))
+            else:
+                job['next'] = now
+            jobs[key] = job
+            echo("... scheduled %s %s, next run at [%s]" % (
+                source, schedule, job['next']))
+        self.jobs = jobs
+
+    def _next_time(self, job, after):
+        return job['schedule'].next_after(after) + datetime.timedelta(
+            seconds=random.uniform(0, job['jitter']))
+
+    def _get_wait(self, now):
+        waits = [(job['next'] - now).total_seconds()
+                 for key, job in self.jobs.items() if key not in self.running]
+        return max(0.1, min(waits + [self.poll_interval]))
+
+    def _last_runs_path(self):
+        return os.path.join(self.backup.get_state_dir(), 'schedule.json')
+
+    def _load_last_runs(self):
+        return _load_json(self._last_runs_path(), {})
+
+
+class BackupSource(object):
+    def __init__(self, backup, settings, environ):
+        self.backup = backup
+        self.settings = settings
+        self.environ = environ
+        # Time of current run, so all names are expanded consistently
+        self.timestamp = None
+        # Hash of archived data, if `skip_unchanged` is enabled
+        self.content_hash = None
+
+    def expand_setting(self, key, default=None):
+        value = self.settings.get(key, default)
+        params = {}
+        if value:
+            now = self.timestamp or datetime.datetime.now()
+            params = {
+                'env': self.environ,
+                'tags': self.settings.get('tags', ''),
+                'yyyy': now.year,
+                'mm': '%02d' % now.month,
+                'dd': '%02d' % now.day,
+                'HH': '%02d' % now.hour,
+                'MM': '%02d' % now.minute,
+                'SS': '%02d' % now.second,
+                'UU': now.microsecond,
+            }
+        return expand_value(value, params)
+
+    def archive(self, temp_dir):
+        """
+        Copy data from source and make archive within temp directory.
+        """
+        data_dir = self._prepare_data_path(temp_dir)
+        self.content_hash = None
+        with self.backup.stage('dump', self.get_host(), self) as record:
+            not_empty = self.copy_data(data_dir)
+            record['bytes_out'] = _dir_size(data_dir)
+        if not_empty:
+            with self.backup.stage('archive', source=self) as record:
+                reader = FilesReader(hash=self.is_skip_unchanged())
+                arch_path = self._make_archive(data_dir, reader)
+                record['bytes_in'] = reader.bytes_read
+                record['bytes_out'] = os.path.getsize(arch_path)
+            if reader.digests is not None:
+                self.content_hash = self._content_digest(
+                    digest for _, digest in sorted(reader.digests.items()))
+            echo("... archived %s" % arch_path)
+        else:
+            arch_path = None
+        return arch_path
+
+    def copy_data(self, data_dir):
+        """Copy backup data to temp directory."""
+        raise NotImplementedError
+
+    def get_key(self):
+        """
+        Get source key to store state between runs, it's `id` setting
+        or a hash of source type, address and name pattern.
+        """
+        if self.settings.get('id'):
+            return str(self.settings['id'])
+        ident = '%(type)s|%(url)s|%(path)s|%(name)s' % {
+            'type': self.settings.get('type'),
+            'url': self.settings.get('url', ''),
+            'path': self.settings.get('path', ''),
+            'name': self.settings.get('name'),
+        }
+        return hashlib.sha1(ident.encode()).hexdigest()[:16]
+
+    def get_attachments(self):
+        """
+        Get list of 2-tuples: (path, upload name) for extra files to
+        upload with archive, e.g. manifest.
+        """
+        return []
+
+    def after_upload(self, results):
+        """
+        Called after archive and attachments are uploaded, `results` is
+        a dict of :meth:`Backup._upload()` results by upload name.
+        """
+        pass
+
+    def get_host(self):
+        """Get host name of source data, used to limit dumps per host."""
+        return None
+
+    def load(self, files, temp_dir):
+        """
+        Load restored data to source, `files` is iterable of 2-tuples:
+        (name, file object) of archive files.
+        """
+        raise ValueError("Backup of %s can't be loaded, extract it to "
+                         "directory instead" % self)
+
+    def after_extract(self, to_dir):
+        """Called after archive is extracted to `to_dir`."""
+        pass
+
+    def get_retention(self, vault_key=None):
+        """
+        Get retention policy from `keep` setting of source or defaults,
+        e.g. {'daily': 7, 'weekly': 4, 'monthly': 12}. For local backups
+        `local_keep` setting is used if it's set.
+        """
+        keep = self.settings.get('keep', self.backup.defaults.get('keep'))
+        if vault_key == LOCAL_VAULT_KEY:
+            keep = self.settings.get(
+                'local_keep', self.backup.defaults.get('local_keep', keep))
+        if keep:
+            return RetentionPolicy(keep)
+
+    def is_incremental(self):
+        """Check if archives depend on previous ones of source."""
+        return False
+
+    def is_sharded(self):
+        """Check if source is archived by shards in parallel."""
+        return False
+
+    def get_state(self):
+        """Get state of archived data, saved to journal to resume."""
+        return {'content_hash': self.content_hash}
+
+    def set_state(self, state):
+        """Restore state of archived data from journal."""
+        self.content_hash = state.get('content_hash')
+
+    def get_name_pattern(self):
+        """
+        Get 2-tuple: (regex, listing prefix) to find backups of source
+        by `name` pattern. Regex group `name` is backup name with any
+        archive extension, manifests and dedup indexes are matched too.
+        """
+        groups = {
+            'yyyy': r'\d{4}', 'mm': r'\d{2}', 'dd': r'\d{2}',
+            'HH': r'\d{2}', 'MM': r'\d{2}', 'SS': r'\d{2}', 'UU': r'\d+',
+        }
+        params = dict((key, '\0%s\0' % key) for key in groups)
+        params.update(env=self.environ, tags=self.settings.get('tags', ''))
+        name = expand_value(self.settings.get('name'), params)
+        prefix = name.split('\0', 1)[0]
+        regex = re.escape(name)
+        for key, group in groups.items():
+            token = re.escape('\0%s\0' % key)
+            if token in regex:
+                regex = regex.replace(token, '(?P<%s>%s)' % (key, group), 1)
+                regex = regex.replace(token, '(?P=%s)' % key)
+        exts = sorted(set(ARCHIVE_EXTENSIONS.values()), key=len, reverse=True)
+        regex = (r'^(?P<name>%s(?:%s)(?:%s)?)(?:\.shard-\d+|\.shards\.json)?'
+                 r'(?:\.manifest\.json)?(?:\.cdc\.json)?$') % (
+            regex, '|'.join(re.escape(ext) for ext in exts),
+            re.escape(ENCRYPTION_EXTENSION))
+        return re.compile(regex), prefix
+
+    def get_backup_time(self, match, modified):
+        """
+        Get backup time from name pattern match if name contains date,
+        otherwise it's object modification time.
+        """
+        parts = match.groupdict()
+        if parts.get('yyyy') and parts.get('mm') and parts.get('dd'):
+            return datetime.datetime(*[int(parts.get(key) or 0) for key in
+                                       ('yyyy', 'mm', 'dd', 'HH', 'MM', 'SS')])
+        return modified
+
+    def is_skip_unchanged(self):
+        """
+        Check if `skip_unchanged` is enabled for source or in defaults,
+        then archive with the same content as last upload to vault is
+        not uploaded again.
+        """
+        return bool(self.settings.get(
+            'skip_unchanged', self.backup.defaults.get('skip_unchanged')))
+
+    def _content_digest(self, parts):
+        """
+        Get SHA-256 of archive format and content parts, so archives
+        of different formats are not mixed up.
+        """
+        digest = hashlib.sha256(self.get_archive_format().encode())
+        for part in parts:
+            digest.update(b'\0' + part.encode())
+        return digest.hexdigest()
+
+    def get_schedule(self):
+        """
+        Get schedule for daemon mode, `schedule` setting is a cron
+        expression and `every` is an interval, e.g. `6h`. Default is
+        `schedule` from defaults. Return `None` if not scheduled.
+        """
+        if self.settings.get('every'):
+            return IntervalSchedule(self.settings['every'])
+        expr = self.settings.get('schedule',
+                                 self.backup.defaults.get('schedule'))
+        if expr:
+            return CronSchedule(expr)
+
+    def estimate_size(self):
+        """
+        Estimate size of source data in bytes, `size` setting overrides
+        estimation. Return `None` if size is unknown.
+        """
+        if self.settings.get('size'):
+            return parse_size(self.settings['size'])
+        try:
+            return self._estimate_size()
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            echo("*** can't estimate size of %s: %s" % (self, e))
+
+    def estimate_temp_size(self, size=None):
+        """
+        Estimate temp space for backup: data copy and its archive,
+        streaming backups don't use temp space. Source `size` is
+        estimated if it's not provided.
+        """
+        if self.is_streaming():
+            return 0
+        if size is None:
+            size = self.estimate_size()
+        return None if size is None else size * 2
+
+    def _estimate_size(self):
+        return None
+
+    def is_streaming(self):
+        """
+        Check if source is configured for streaming mode, i.e. `stream`
+        setting is enabled for source or in defaults.
+        """
+        return bool(self.settings.get('stream',
+                                      self.backup.defaults.get('stream')))
+
+    def open_stream(self, temp_dir=None):
+        """
+        Open compressed data stream for source. Return file-like
+        object, which is also a context manager.
+        """
+        raise NotImplementedError
+
+    def get_compression_level(self):
+        """Get compression level, `None` is default for format."""
+        level = self.settings.get('level', self.backup.defaults.get('level'))
+        return None if level is None else int(level)
+
+    def get_compression_threads(self):
+        """
+        Get number of compression threads for zstd, `None` means
+        all available CPUs.
+        """
+        threads = self.settings.get('threads',
+                                    self.backup.defaults.get('threads'))
+        return None if threads is None else int(threads)
+
+    def get_encryption_key(self):
+        """
+        Get key for client-side encryption by `encryption_key` setting
+        of source or defaults, e.g. `{env[BACKUP_KEY]}`. Return `None`
+        if encryption is disabled.
+        """
+        value = self.settings.get(
+            'encryption_key', self.backup.defaults.get('encryption_key'))
+        if value:
+            return parse_key(expand_value(value, {'env': self.environ}))
+
+    def get_priority_args(self):
+        """
+        Get command prefix to run dump processes with `nice` and
+        `ionice` settings of source, e.g. `nice: 10`, `ionice: idle`.
+        Settings in defaults apply to the whole process instead.
+        """
+        return priority_args(self.settings.get('nice'),
+                             self.settings.get('ionice'))
+
+    def get_vault_keys(self):
+        """
+        Get vaults keys to upload archive. If not specified in config,
+        return ['*'] which mean all available vaults.
+        """
+        return self.expand_setting('to', ['*'])
+
+    def get_archive_format(self):
+        """
+        Get archive format. In streaming mode only formats from
+        `STREAM_CODECS` are supported and `gz` is used by default.
+        """
+        default_format = self.backup.defaults.get('format') or 'zip'
+        aformat = self.expand_setting('format') or default_format
+        if self.is_streaming() and aformat not in STREAM_CODECS:
+            aformat = 'gz'
+        return aformat
+
+    def get_archive_basename(self):
+        """
+        Get base name for archive without extension, e.g. for MySQL
+        dump archive it could return `mysql-2016-10-20.sql` and the derived
+        zip-archive will have name `mysql-2016-10-20.sql.zip`.
+        """
+        return self.expand_setting('name')
+
+    def get_archive_fullname(self):
+        """
+        Get archive name with extension, e.g. for MySQL
+        dump archive it could return `mysql-2016-10-20.sql`.
+
+        The name pattern configured as `name` parameter in backup
+        source definition in config.
+        """
+        name = self.get_archive_basename()
+        aformat = self.get_archive_format()
+        ext = ARCHIVE_EXTENSIONS.get(aformat)
+        if ext is None:
+            ext = '.%s' % aformat
+            LOGS.warning("*** archive format `%s` is not registered with"
+                        " `register_archive_extension()`" % aformat)
+        if self.get_encryption_key():
+            ext += ENCRYPTION_EXTENSION
+        return name + ext
+
+    def get_local_dir(self):
+        """Get directory path for local backups."""
+        default = self.backup.get_local_dir()
+        localdir = self.expand_setting('localdir') or default
+        if localdir:
+            return os.path.realpath(localdir)
+
+    def _make_archive(self, dir_name, reader=None):
+        """
+        Make archive of the specified directory near that directory,
+        files are read by `reader` if provided.
+        """
+        return make_archive(dir_name,
+                            root_dir=dir_name,
+                            base_dir=None,
+                            format=self.get_archive_format(),
+                            level=self.get_compression_level(),
+                            threads=self.get_compression_threads(),
+                            reader=reader)
+
+    def _prepare_data_path(self, base_dir):
+        """
+        Join base dir with :meth:`.get_archive_basename()` and create
+        all parent dirs in the resulting tree. Return joined path.
+        """
+        path = os.path.join(base_dir, self.get_archive_basename())
+        _smakedirs(os.path.dirname(path))
+        return path
+
+
+class DbSource(BackupSource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.url = urlparse(self.expand_setting('url'))
+        self.db = self.url.path.strip('/')
+        if not self.db:
+            raise ValueError(
+                "Database is not defined %s" % self.settings
+            )
+
+    def __str__(self):
+        return '%s://%s%s' % (self.url.scheme, self.url.hostname, self.url.path)
+
+    def get_host(self):
+        return self.url.hostname or 'localhost'
+
+    def get_dump_command(self, dump_file=None):
+        """
+        Get 2-tuple: (args, env) for dump command. If `dump_file` is
+        not provided, dump is written to stdout.
+        """
+        raise NotImplementedError
+
+    def get_load_command(self):
+        """Get 2-tuple: (args, env) for command to load dump from stdin."""
+        raise NotImplementedError
+
+    def load(self, files, temp_dir):
+        """Load every dump file from archive to database."""
+        for name, fp in files:
+            self.load_file(name, fp)
+
+    def load_file(self, name, fp):
+        """
+        Pipe dump file to database client, compressed dump is
+        decompressed according to name extension.
+        """
+        aformat = get_archive_format_by_name(name)
+        if STREAM_DECODERS.get(aformat):
+            fp = IterStream(iter_decoded(fp, aformat))
+        args, env = self.get_load_command()
+        echo("... load %s with %s" % (name, args[0]))
+        proc = subprocess.Popen(args, env=env, stdin=subprocess.PIPE)
+        try:
+            shutil.copyfileobj(fp, proc.stdin, CHUNK_SIZE)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        finally:
+            proc.wait()
+        if proc.returncode != 0:
+            raise RuntimeError("%s exited with code %s" % (
+                args[0], proc.returncode))
+
+    def open_stream(self, temp_dir=None):
+        """Start dump process and return compressed output stream."""
+        args, env = self.get_dump_command()
+        echo("... streaming %s" % args[0])
+        proc = subprocess.Popen(self.get_priority_args() + args, env=env,
+                                stdout=subprocess.PIPE)
+        output = DumpOutput(proc)
+        chunks = iter_chunks(output)
+        codec = STREAM_CODECS[self.get_archive_format()]
+        if codec:
+            chunks = iter_compress(chunks, codec(
+                self.get_compression_level(), self.get_compression_threads()))
+        return IterStream(chunks, source=output)
+
+
+class ReadCounter(object):
+    """
+    Counter of bytes read by concurrent readers, e.g. dumps of tables,
+    it could be `source` of :class:`IterStream`.
+    """
+    def __init__(self):
+        self.bytes_read = 0
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        with self._lock:
+            self.bytes_read += size
+
+    def close(self):
+        pass
+
+
+class DumpOutput(object):
+    """
+    Dump process stdout reader. Raise error on EOF if process has
+    failed, so partial dump is never treated as complete upload.
+    """
+    def __init__(self, proc):
+        self.proc = proc
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        self.bytes_read += len(data)
+        if not data:
+            self.proc.stdout.close()
+            if self.proc.wait() != 0:
+                raise RuntimeError("%s exited with code %s" % (
+                    self.proc.args[0], self.proc.returncode))
+        return data
+
+    def close(self):
+        """Stop dump process if output was not read till the end."""
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        if self.proc.stdout:
+            self.proc.stdout.close()
+
+
+def iter_counted(chunks, counter):
+    """Count bytes of chunks iterable in `counter.bytes_read`."""
+    for chunk in chunks:
+        counter.bytes_read += len(chunk)
+        yield chunk
+
+
+def iter_tar_file(path, arcname):
+    """
+    Generate tar archive member for file without reading it to memory,
+    archive end marker :data:`TAR_END` has to be added after members.
+    """
+    stat = os.stat(path)
+    info = tarfile.TarInfo(arcname)
+    info.size = stat.st_size
+    info.mtime = stat.st_mtime
+    info.mode = 0o600
+    yield info.tobuf(tarfile.GNU_FORMAT)
+    with open(path, 'rb') as fp:
+        size = info.size
+        while size > 0:
+            chunk = fp.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise IOError("File %s was truncated" % path)
+            size -= len(chunk)
+            yield chunk
+    if info.size % tarfile.BLOCKSIZE:
+        yield b'\0' * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+
+
+TAR_END = b'\0' * (2 * tarfile.BLOCKSIZE)
+
+
+def iter_dump_dir_tar(proc, dump_dir, arc_dir, poll_interval=1.0):
+    """
+    Generate tar stream of files written by dump process to directory,
+    every file is added when it's closed by process and its children
+    and then removed. Raise error if process has failed.
+
+    Open files are checked via `/proc`, on other systems all files are
+    added after process is finished.
+    """
+    while True:
+        running = proc.poll() is None
+        # Directory is created by dump process, it may not exist yet
+        names = (sorted(os.listdir(dump_dir)) if os.path.isdir(dump_dir)
+                 else [])
+        busy = _open_files(proc.pid) if running else set()
+        if busy is None:
+            proc.wait()
+            continue
+        for name in names:
+            path = os.path.join(dump_dir, name)
+            if path in busy or not os.path.isfile(path):
+                continue
+            for chunk in iter_tar_file(path, '%s/%s' % (arc_dir, name)):
+                yield chunk
+            os.unlink(path)
+        if not running:
+            break
+        time.sleep(poll_interval)
+    if proc.returncode != 0:
+        raise RuntimeError("%s exited with code %s" % (
+            proc.args[0], proc.returncode))
+    yield TAR_END
+
+
+def _open_files(pid):
+    """
+    Get set of files paths open by process and its children. Return
+    `None` if `/proc` file system is not available.
+    """
+    if not os.path.isdir('/proc/%d/fd' % pid):
+        return None
+    parents = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as fp:
+                stat = fp.read()
+        except IOError:
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        parents.setdefault(ppid, []).append(int(name))
+    pids = [pid]
+    paths = set()
+    while pids:
+        current = pids.pop()
+        pids.extend(parents.get(current, []))
+        fd_dir = '/proc/%d/fd' % current
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                paths.add(os.readlink(os.path.join(fd_dir, fd)))
+            except OSError:
+                pass
+    return paths
+
+
+class PostgresqlBackupSource(DbSource):
+    def get_jobs(self):
+        """
+        Get number of parallel `pg_dump` jobs, if set then dump is made
+        in directory format and streamed as tar archive.
+        """
+        return int(self.settings.get('jobs') or 0)
+
+    def is_streaming(self):
+        return bool(self.get_jobs()) or super().is_streaming()
+
+    def get_archive_format(self):
+        """
+        Get archive format, it's always `tar` for directory format
+        dumps, as files are compressed by `pg_dump`.
+        """
+        if self.get_jobs():
+            return 'tar'
+        return super().get_archive_format()
+
+    def open_stream(self, temp_dir=None):
+        """
+        Start dump process and return output stream. For parallel dump
+        it's a tar stream of dump directory files, every file is added
+        as soon as it's written and then removed from temp directory.
+        """
+        if not self.get_jobs():
+            return super().open_stream(temp_dir)
+        dump_dir = self._prepare_data_path(temp_dir)
+        args, env = self.get_dump_command(dump_dir)
+        echo("... %s with %s jobs" % (args[0], self.get_jobs()))
+        proc = subprocess.Popen(self.get_priority_args() + args, env=env)
+        output = DumpOutput(proc)
+        chunks = iter_dump_dir_tar(proc, dump_dir,
+                                   os.path.basename(dump_dir))
+        return IterStream(iter_counted(chunks, output), source=output)
+
+    def estimate_temp_size(self, size=None):
+        """
+        Parallel dump uses temp space only for files being written, as
+        every file is streamed and removed when it's closed, so size of
+        `jobs` largest tables is reserved.
+        """
+        if not self.get_jobs():
+            return super().estimate_temp_size(size)
+        try:
+            return self._query_size(
+                "SELECT COALESCE(SUM(size), 0) FROM ("
+                "SELECT pg_table_size(c.oid) AS size FROM pg_class c "
+                "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE c.relkind IN ('r', 'm') AND n.nspname NOT IN "
+                "('pg_catalog', 'information_schema') "
+                "ORDER BY size DESC LIMIT %d) t" % self.get_jobs())
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            echo("*** can't estimate size of %s: %s" % (self, e))
+
+    def _estimate_size(self):
+        return self._query_size(
+            'SELECT pg_database_size(current_database())')
+
+    def _query_size(self, query):
+        output = subprocess.check_output(
+            ['psql', '--no-psqlrc', '--tuples-only', '--no-align',
+             '--command', query] +
+            self._connection_args() + [self.db],
+            env=self._connection_env()
+        )
+        return int(output.strip())
+
+    def copy_data(self, data_dir):
+        """Make database dump via `pg_dump`. Return `True` on success."""
+        dump_file = self._prepare_data_path(data_dir)
+        args, env = self.get_dump_command(dump_file)
+        options = self.expand_setting('options')
+        echo("... %s with options %s" % (args[0], options or '(none)'))
+        proc = subprocess.Popen(self.get_priority_args() + args, env=env)
+        proc.wait()
+        return (proc.returncode == 0)
+
+    def get_dump_command(self, dump_file=None):
+        args = ['pg_dump']
+        if dump_file:
+            args.append('--file=%s' % dump_file)
+        jobs = self.get_jobs()
+        if jobs:
+            args += ['--format=directory', '--jobs=%d' % jobs]
+            level = self.get_compression_level()
+            if level is not None:
+                args.append('--compress=%d' % level)
+        args += self._connection_args()
+        options = self.expand_setting('options')
+        if options:
+            args += options.split(' ')
+        args.append(self.db)
+        return args, self._connection_env()
+
+    def get_load_command(self):
+        args = ['psql', '--no-psqlrc', '--quiet', '--set=ON_ERROR_STOP=1']
+        args += self._connection_args()
+        args.append(self.db)
+        return args, self._connection_env()
+
+    def load(self, files, temp_dir):
+        """
+        Load dump to database, directory format dump of parallel backup
+        is saved to temp dir and restored by `pg_restore` with `jobs`
+        processes.
+        """
+        if not self.get_jobs():
+            return super().load(files, temp_dir)
+        dump_dir = None
+        for name, fp in files:
+            path = _safe_join(temp_dir, name)
+            _smakedirs(os.path.dirname(path))
+            with open(path, 'wb') as out:
+                shutil.copyfileobj(fp, out, CHUNK_SIZE)
+            dump_dir = os.path.dirname(path)
+        if not dump_dir:
+            raise RuntimeError("Dump is not found in archive")
+        args = ['pg_restore', '--jobs=%d' % self.get_jobs(),
+                '--dbname=%s' % self.db] + self._connection_args()
+        args.append(dump_dir)
+        echo("... pg_restore with %s jobs" % self.get_jobs())
+        subprocess.check_call(args, env=self._connection_env())
+
+    def _connection_args(self):
+        args = []
+        if self.url.port:
+            args.append('--port=%s' % self.url.port)
+        if self.url.hostname:
+            args.append('--host=%s' % self.url.hostname)
+        if self.url.username:
+            args.append('--username=%s' % self.url.username)
+        return args
+
+    def _connection_env(self):
+        env = self.environ.copy()
+        if self.url.password:
+            env['PGPASSWORD'] = self.url.password
+        return env
+
+
+class MySQLBackupSource(DbSource):
+    def get_jobs(self):
+        """
+        Get number of parallel `mysqldump` processes, if set then every
+        table is dumped separately and dumps are streamed as tar archive.
+        """
+        return int(self.settings.get('jobs') or 0)
+
+    def is_streaming(self):
+        return bool(self.get_jobs()) or super().is_streaming()
+
+    def get_archive_format(self):
+        """
+        Get archive format, it's always `tar` for per-table dumps, as
+        every table dump is compressed separately.
+        """
+        if self.get_jobs():
+            return 'tar'
+        return super().get_archive_format()
+
+    def get_consistency(self):
+        """
+        Get consistency of parallel dump by `consistent` setting, it's
+        `snapshot` by default: tables are split between `jobs` dump
+        processes, their transactions are started under global read
+        lock, which is released as soon as all transactions are
+        started. With `lock` (or `yes`) lock is held until all tables
+        are dumped, with `no` every table is dumped in its own
+        transaction without lock.
+        """
+        value = self.settings.get('consistent', 'snapshot')
+        if value is True or value == 'yes':
+            return 'lock'
+        if value is False or value in (None, 'no'):
+            return 'no'
+        if value not in ('snapshot', 'lock'):
+            raise ValueError("Unknown consistency `%s` for %s" % (
+                value, self))
+        return value
+
+    def get_table_format(self):
+        """Get compression format for per-table dumps, default is `gz`."""
+        aformat = (self.expand_setting('format') or
+                   self.backup.defaults.get('format'))
+        return aformat if aformat in STREAM_CODECS else 'gz'
+
+    def estimate_temp_size(self, size=None):
+        """Per-table dumps use temp space until they're streamed."""
+        if self.get_jobs():
+            return self.estimate_size() if size is None else size
+        return super().estimate_temp_size(size)
+
+    def _estimate_size(self):
+        output = subprocess.check_output(
+            ['mysql', '--batch', '--skip-column-names'] +
+            self._connection_args() +
+            ['--execute',
+             "SELECT COALESCE(SUM(data_length + index_length), 0) "
+             "FROM information_schema.tables "
+             "WHERE table_schema = DATABASE()", self.db],
+            env=self.environ.copy()
+        )
+        return int(output.strip())
+
+    def copy_data(self, data_dir):
+        """Make database dump via `mysqldump`. Return `True` on success."""
+        dump_file = self._prepare_data_path(data_dir)
+        args, _ = self.get_dump_command(dump_file)
+        options = self.expand_setting('options')
+        echo("... %s with options %s" % (args[0], options or '(none)'))
+        result = subprocess.call(self.get_priority_args() + args,
+                                 stderr=subprocess.STDOUT)
+        return (result == 0)
+
+    def get_dump_command(self, dump_file=None):
+        args = ['mysqldump']
+        if dump_file:
+            args.append('--result-file=%s' % dump_file)
+        if self.is_skip_unchanged():
+            # Dump date would make every dump unique
+            args.append('--skip-dump-date')
+        args += self._connection_args()
+        options = self.expand_setting('options')
+        if options:
+            args += options.split(' ')
+        args.append(self.db)
+        return args, self.environ.copy()
+
+    def get_load_command(self):
+        return (['mysql'] + self._connection_args() + [self.db],
+                self.environ.copy())
+
+    def load(self, files, temp_dir):
+        """
+        Load dump to database. Per-table dumps are loaded after schema
+        and triggers after all tables, dumps which are before schema in
+        archive and triggers are saved to temp dir until they're loaded.
+        """
+        if not self.get_jobs():
+            return super().load(files, temp_dir)
+        pending = []
+        triggers = None
+        has_schema = False
+        for name, fp in files:
+            if os.path.basename(name).startswith('_triggers.'):
+                triggers = os.path.join(temp_dir, os.path.basename(name))
+                with open(triggers, 'wb') as out:
+                    shutil.copyfileobj(fp, out, CHUNK_SIZE)
+            elif os.path.basename(name).startswith('_schema.'):
+                self.load_file(name, fp)
+                has_schema = True
+                for path in pending:
+                    with open(path, 'rb') as table_fp:
+                        self.load_file(path, table_fp)
+                    os.unlink(path)
+            elif has_schema:
+                self.load_file(name, fp)
+            else:
+                path = os.path.join(temp_dir, os.path.basename(name))
+                with open(path, 'wb') as out:
+                    shutil.copyfileobj(fp, out, CHUNK_SIZE)
+                pending.append(path)
+        if not has_schema:
+            raise RuntimeError("Schema dump is not found in archive")
+        if triggers:
+            with open(triggers, 'rb') as fp:
+                self.load_file(triggers, fp)
+            os.unlink(triggers)
+
+    def list_tables(self):
+        """Get list of base tables in database via `mysql` client."""
+        output = subprocess.check_output(
+            ['mysql', '--batch', '--skip-column-names'] +
+            self._connection_args() +
+            ['--execute', "SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'",
+             self.db],
+            env=self.environ.copy()
+        )
+        return [line.split(b'\t')[0].decode('utf-8')
+                for line in output.splitlines() if line]
+
+    def get_table_sizes(self):
+        """Get dict of base tables sizes in bytes via `mysql` client."""
+        output = subprocess.check_output(
+            ['mysql', '--batch', '--skip-column-names'] +
+            self._connection_args() +
+            ['--execute',
+             "SELECT table_name, COALESCE(data_length + index_length, 0) "
+             "FROM information_schema.tables "
+             "WHERE table_schema = DATABASE() "
+             "AND table_type = 'BASE TABLE'", self.db],
+            env=self.environ.copy()
+        )
+        sizes = {}
+        for line in output.splitlines():
+            if line:
+                name, size = line.split(b'\t')
+                sizes[name.decode('utf-8')] = int(size)
+        return sizes
+
+    def open_stream(self, temp_dir=None):
+        """
+        Start dump and return output stream. For parallel dump it's a
+        tar stream of compressed schema and tables dumps, every dump is
+        added as soon as it's finished and then removed from temp dir.
+        """
+        if not self.get_jobs():
+            return super().open_stream(temp_dir)
+        dump_dir = self._prepare_data_path(temp_dir)
+        _smakedirs(dump_dir)
+        counter = ReadCounter()
+        return IterStream(self._iter_tables_tar(dump_dir, counter),
+                          source=counter)
+
+    def _iter_tables_tar(self, dump_dir, counter):
+        """
+        Dump schema, tables and triggers with up to `jobs` processes,
+        yield tar stream of dumps. Bytes of dumps before compression
+        are added to `counter`. Consistency of tables dumps depends on
+        `consistent` setting, see :meth:`get_consistency()`.
+        """
+        consistency = self.get_consistency()
+        jobs = self.get_jobs()
+        if consistency == 'snapshot':
+            sizes = self.get_table_sizes()
+            # All dumps of snapshot have to run at once
+            limit = self.backup.limits.get_limit('table') or jobs
+            groups = split_shards(
+                dict((name, (size,)) for name, size in sizes.items()),
+                min(jobs, limit))
+            echo("... mysqldump %s tables by %s jobs in consistent "
+                 "snapshot" % (len(sizes), len(groups)))
+            parts = [('_data-%03d' % number,
+                      ['--no-create-info', '--skip-triggers', self.db] + group)
+                     for number, group in enumerate(groups, 1)]
+        else:
+            tables = self.list_tables()
+            echo("... mysqldump %s tables with %s jobs" % (len(tables),
+                                                         jobs))
+            parts = [(table, ['--no-create-info', '--skip-triggers',
+                              self.db, table]) for table in tables]
+        snapshots = len(parts) if consistency == 'snapshot' else 0
+        parts.append(('_schema', ['--no-data', '--routines', '--events',
+                                  '--skip-triggers', self.db]))
+        # Triggers are loaded after data, so loaded rows don't fire them
+        parts.append(('_triggers', ['--no-create-info', '--no-data',
+                                    '--triggers', self.db]))
+        arc_dir = os.path.basename(dump_dir)
+        procs = {}
+        futures = []
+        releases = []
+        lock = None
+        pool = ThreadPoolExecutor(max_workers=jobs)
+        try:
+            if snapshots:
+                # Slots are taken before lock, so all snapshot dumps
+                # start while it's held
+                releases = self.backup.reserve_stage('table', snapshots)
+            if consistency == 'lock' or snapshots:
+                lock = self._lock_tables()
+            # Snapshot dumps are submitted first, so all of them start
+            for number, (name, args) in enumerate(parts):
+                release = releases[number] if number < snapshots else None
+                futures.append(pool.submit(
+                    self._dump_table, dump_dir, name, args, procs, counter,
+                    release))
+            if snapshots:
+                self._wait_snapshots(lock, dict(
+                    (name, future) for (name, _), future in
+                    zip(parts[:snapshots], futures)), procs)
+                self._unlock_tables(lock)
+                lock = None
+            for future in as_completed(futures):
+                path = future.result()
+                name = os.path.basename(path)
+                for chunk in iter_tar_file(path, '%s/%s' % (arc_dir, name)):
+                    yield chunk
+                os.unlink(path)
+            yield TAR_END
+        finally:
+            for future in futures:
+                future.cancel()
+            for proc in list(procs.values()):
+                if proc.poll() is None:
+                    proc.kill()
+            pool.shutdown(wait=True)
+            # Slots of snapshot dumps which were never run
+            for number, release in enumerate(releases):
+                if number >= len(futures) or futures[number].cancelled():
+                    release()
+            if lock:
+                self._unlock_tables(lock)
+
+    def _dump_table(self, dump_dir, name, args, procs, counter,
+                    release=None):
+        """
+        Dump table or tables by `mysqldump` arguments and compress to
+        file in dump dir, dump size is added to `counter`. Process is
+        run within `table` stage limit, or with reserved slot which is
+        freed by `release` callable. Return file path.
+        """
+        if release is None:
+            with self.backup.stage('table'):
+                return self._write_dump(dump_dir, name, args, procs,
+                                        counter)
+        try:
+            return self._write_dump(dump_dir, name, args, procs, counter)
+        finally:
+            release()
+
+    def _write_dump(self, dump_dir, name, args, procs, counter):
+        aformat = self.get_table_format()
+        path = os.path.join(dump_dir, '%s.sql%s' % (
+            name.replace('/', '_'), ARCHIVE_EXTENSIONS[aformat]))
+        codec = STREAM_CODECS[aformat]
+        args = (['mysqldump', '--single-transaction'] +
+                self._connection_args() +
+                (self.expand_setting('options') or '').split() + args)
+        proc = subprocess.Popen(self.get_priority_args() + args,
+                                env=self.environ.copy(),
+                                stdout=subprocess.PIPE)
+        procs[name] = proc
+        output = DumpOutput(proc)
+        chunks = iter_chunks(output)
+        if codec:
+            chunks = iter_compress(chunks, codec(
+                self.get_compression_level(),
+                self.get_compression_threads()))
+        with open(path, 'wb') as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+        procs.pop(name, None)
+        counter.add(output.bytes_read)
+        return path
+
+    def _lock_tables(self):
+        """
+        Acquire global read lock in separate `mysql` session, lock is
+        held until session's stdin is closed. Return process.
+        """
+        proc = subprocess.Popen(
+            ['mysql', '--batch', '--skip-column-names'] +
+            self._connection_args() + [self.db],
+            env=self.environ.copy(),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        proc.stdin.write(b"FLUSH TABLES WITH READ LOCK;\n"
+                         b"SELECT 'locked';\n")
+        proc.stdin.flush()
+        if proc.stdout.readline().strip() != b'locked':
+            proc.kill()
+            proc.wait()
+            raise RuntimeError("Can't acquire global read lock")
+        echo("... global read lock acquired for %s" % self)
+        return proc
+
+    def _wait_snapshots(self, lock, futures, procs, timeout=60):
+        """
+        Wait until dump processes of `futures` dict by part names start
+        transactions, while global read lock is held by `lock` session.
+        Transactions are found by `_pid` connection attribute, which is
+        process ID of `mysqldump` in `procs` dict by part names, so
+        other sessions are not counted. Finished dumps are counted as
+        started.
+        """
+        deadline = time.time() + timeout
+        while True:
+            started = 0
+            pids = []
+            for name, future in futures.items():
+                if future.done():
+                    future.result()
+                    started += 1
+                elif name in procs:
+                    pids.append("'%s'" % procs[name].pid)
+            if pids:
+                lock.stdin.write((
+                    "SELECT COUNT(DISTINCT a.attr_value) "
+                    "FROM information_schema.innodb_trx t "
+                    "JOIN performance_schema.session_connect_attrs a "
+                    "ON a.processlist_id = t.trx_mysql_thread_id "
+                    "WHERE a.attr_name = '_pid' AND a.attr_value IN (%s) "
+                    "AND t.trx_mysql_thread_id > CONNECTION_ID();\n" %
+                    ', '.join(pids)).encode())
+                lock.stdin.flush()
+                line = lock.stdout.readline()
+                if not line.strip():
+                    raise RuntimeError("Can't check dump transactions, "
+                                       "`performance_schema` is required")
+                started += int(line)
+            if started >= len(futures):
+                break
+            if time.time() > deadline:
+                raise RuntimeError("Dump transactions are not started in "
+                                   "%s seconds" % timeout)
+            time.sleep(0.1)
+        echo("... %s dump transactions started for %s" % (
+            len(futures), self))
+
+    def _unlock_tables(self, lock):
+        """Release global read lock by closing `lock` session."""
+        lock.stdin.close()
+        lock.wait()
+
+    def _connection_args(self):
+        args = []
+        if self.url.port:
+            args.append('--port=%s' % self.url.port)
+        if self.url.hostname:
+            args.append('--host=%s' % self.url.hostname)
+        if self.url.username:
+            args.append('--user=%s' % self.url.username)
+        if self.url.password:
+            args.append('--password=%s' % self.url.password)
+        return args
+
+
+class DirBackupSource(BackupSource):
+    # Name of deleted files list in incremental archive
+    deleted_list_name = '.coverme-deleted'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = self.expand_setting('path')
+        if not self.path:
+            raise ValueError("Path not specified for directory "
+                             "backup source, 'path' key is empty")
+        if self.is_sharded() and self.is_incremental():
+            raise ValueError("Sharded directory backup can't be "
+                             "incremental")
+        self._manifest = None
+        self._shards_manifest = None
+
+    def archive(self, temp_dir):
+        """Archive source directory to temp directory.
+        Return archive full path.
+        """
+        # We want to achive `/my/sub/{some dir}` under unique temp dir:
+        # `/tmp/dEdjnr/{name from config}`
+        #
+        # So we make archive from base path `/my/sub/{some dir}`,
+        # root path `/my/sub/` and archive name
+        # `/tmp/dEdjnr/{name from config}`
+        from_path = self.expand_setting('path')
+        base_name = self._prepare_data_path(temp_dir)
+        if self.is_incremental():
+            return self._archive_incremental(from_path, base_name)
+        self.content_hash = None
+        use_hash = self.is_skip_unchanged() and self.settings.get('hash')
+        if self.is_skip_unchanged() and not use_hash:
+            self.content_hash = self._scan_digest(from_path)
+        echo("... archive directory %s" % from_path)
+        with self.backup.stage('archive', source=self) as record:
+            reader = FilesReader(hash=bool(use_hash))
+            arch_path = make_archive(
+                base_name=base_name,
+                root_dir=os.path.dirname(from_path),
+                base_dir=from_path,
+                # logger=log,
+                format=self.get_archive_format(),
+                level=self.get_compression_level(),
+                threads=self.get_compression_threads(),
+                reader=reader)
+            record['bytes_in'] = reader.bytes_read
+            record['bytes_out'] = os.path.getsize(arch_path)
+        if use_hash:
+            base_dir = os.path.normpath(from_path)
+            self.content_hash = self._content_digest(
+                '%s:%s' % (os.path.relpath(name, base_dir), digest)
+                for name, digest in sorted(reader.digests.items()))
+        echo("... archived %s" % arch_path)
+        return arch_path
+
+    def is_streaming(self):
+        """Directories are always archived to temp directory."""
+        return False
+
+    def get_shards(self):
+        """Get number of shards by `shards` setting."""
+        return int(self.settings.get('shards') or 0)
+
+    def is_sharded(self):
+        """Check if sharded mode is enabled with `shards` more than 1."""
+        return self.get_shards() > 1
+
+    def get_shard_uploads(self):
+        """
+        Get number of shards uploaded at once by `shard_uploads` setting
+        of source or defaults, default is 2. Every upload buffers up to
+        `max_concurrency` + 1 parts per vault in memory.
+        """
+        uploads = self.settings.get(
+            'shard_uploads', self.backup.defaults.get('shard_uploads'))
+        return max(1, min(self.get_shards(), int(uploads or 2)))
+
+    def iter_shards(self, temp_dir):
+        """
+        Split directory files to `shards` lists of about equal size and
+        archive them in process pool. Yield 2-tuples: (archive path,
+        upload name) as soon as shard is archived. Manifest of shards
+        is added to attachments when all are done.
+        """
+        from_path = self.expand_setting('path')
+        base_name = self._prepare_data_path(temp_dir)
+        upload_name = self.get_archive_fullname()
+        root_dir = os.path.dirname(from_path)
+        arc_prefix = os.path.relpath(from_path, root_dir)
+        aformat = self.get_archive_format()
+        threads = self.get_compression_threads()
+
+        echo("... scan directory %s" % from_path)
+        files = scan_files(from_path)
+        shards = split_shards(files, self.get_shards())
+        workers = min(len(shards), os.cpu_count() or 1) or 1
+        echo("... archive %s files of directory %s to %s shards" % (
+            len(files), from_path, len(shards)))
+        manifest = {'name': upload_name, 'format': aformat, 'shards': []}
+        # Spawned workers don't inherit locks held by threads
+        context = multiprocessing.get_context('spawn')
+        with self.backup.stage('archive', source=self) as record, \
+                ProcessPoolExecutor(max_workers=workers,
+                                    mp_context=context) as pool:
+            futures = {}
+            for number, paths in enumerate(shards, 1):
+                suffix = '.shard-%03d' % number
+                future = pool.submit(
+                    write_archive, base_name + suffix, aformat, root_dir,
+                    [os.path.join(arc_prefix, path) for path in paths],
+                    level=self.get_compression_level(),
+                    threads=1 if threads is None else threads)
+                futures[future] = (upload_name + suffix, paths)
+            record['bytes_in'] = sum(entry[0] for entry in files.values())
+            record['bytes_out'] = 0
+            for future in as_completed(futures):
+                shard_name, paths = futures[future]
+                arch_path = future.result()
+                size = os.path.getsize(arch_path)
+                record['bytes_out'] += size
+                manifest['shards'].append({
+                    'name': shard_name,
+                    'files': len(paths),
+                    'bytes': sum(files[path][0] for path in paths),
+                    'size': size,
+                })
+                echo("... archived shard %s" % arch_path)
+                yield arch_path, shard_name
+        manifest['shards'].sort(key=lambda shard: shard['name'])
+        manifest_path = base_name + '.shards.json'
+        _save_json(manifest_path, manifest)
+        self._shards_manifest = (manifest_path, upload_name + '.shards.json')
+
+    def estimate_temp_size(self, size=None):
+        """Directory is archived in place, only archive is in temp."""
+        return self.estimate_size() if size is None else size
+
+    def _estimate_size(self):
+        return _dir_size(self.expand_setting('path'))
+
+    def after_extract(self, to_dir):
+        """Remove files listed as deleted in incremental archive."""
+        path = os.path.join(to_dir, self.deleted_list_name)
+        if not os.path.exists(path):
+            return
+        with open(path, encoding='utf-8') as fp:
+            deleted = [line for line in fp.read().splitlines() if line]
+        for rel_path in deleted:
+            target = _safe_join(to_dir, rel_path)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.lexists(target):
+                os.unlink(target)
+        os.unlink(path)
+        echo("... removed %s deleted files" % len(deleted))
+
+    def _scan_digest(self, from_path):
+        """
+        Get content hash of directory by files sizes and modification
+        times. With `hash` setting files digests are calculated while
+        archive is made instead.
+        """
+        files = scan_files(from_path)
+        parts = []
+        for rel_path in sorted(files):
+            size, mtime_ns, _, _ = files[rel_path]
+            parts.append('%s:%s:%s' % (rel_path, size, mtime_ns))
+        return self._content_digest(parts)
+
+    def is_incremental(self):
+        """Check if incremental mode is enabled with `incremental`."""
+        return bool(self.settings.get('incremental'))
+
+    def get_state(self):
+        """
+        Get state to resume upload, incremental manifest is referred by
+        its file path and digest, files list is not copied.
+        """
+        state = super().get_state()
+        manifest = self._manifest
+        if manifest:
+            state['manifest'] = {
+                'path': manifest['path'],
+                'name': manifest['name'],
+                'digest': _file_digest(manifest['path']),
+                'base': manifest['state']['base'],
+                'full_at': manifest['state']['full_at'],
+            }
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        manifest = state.get('manifest')
+        self._manifest = None
+        if manifest:
+            if _file_digest(manifest['path']) != manifest['digest']:
+                raise RuntimeError("Manifest %s is changed" % (
+                    manifest['path']))
+            self._manifest = {
+                'path': manifest['path'],
+                'name': manifest['name'],
+                'state': {
+                    'base': manifest['base'],
+                    'full_at': manifest['full_at'],
+                    'files': _load_json(manifest['path'])['files'],
+                },
+            }
+
+    def get_attachments(self):
+        """Get manifest file for incremental or sharded archive."""
+        if self._shards_manifest:
+            return [self._shards_manifest]
+        if self._manifest:
+            return [(self._manifest['path'],
+                     self._manifest['name'] + '.manifest.json')]
+        return []
+
+    def after_upload(self, results):
+        """
+        Save manifest as the new base for incremental archives, only
+        if everything is uploaded to all vaults.
+        """
+        self._shards_manifest = None
+        manifest, self._manifest = self._manifest, None
+        if not manifest:
+            return
+        if all(ok for vaults in results.values()
+               for ok, _ in vaults.values()):
+            _save_json(self._manifest_path(), manifest['state'])
+        else:
+            echo("*** manifest is not saved for %s, next archive will "
+                 "include the same changes" % self)
+
+    def _archive_incremental(self, from_path, base_name):
+        """
+        Archive files added or changed since last archive according to
+        saved manifest, deleted files are listed in `.coverme-deleted`
+        file. Full archive is made if there's no saved manifest or
+        `full_every` days have passed since last full archive.
+        """
+        state = _load_json(self._manifest_path()) or {}
+        now = datetime.datetime.now()
+        full_every = datetime.timedelta(
+            days=float(self.settings.get('full_every', 7)))
+        full_at = state.get('full_at')
+        is_full = (not full_at or now - datetime.datetime.strptime(
+            full_at, '%Y-%m-%dT%H:%M:%S') >= full_every)
+        prev_files = {} if is_full else state.get('files', {})
+
+        echo("... scan directory %s" % from_path)
+        files = scan_files(from_path)
+        changed = []
+        use_hash = bool(self.settings.get('hash'))
+        for rel_path, entry in files.items():
+            prev = prev_files.get(rel_path)
+            if prev and prev[:3] == entry[:3]:
+                entry[3] = prev[3]
+                continue
+            if use_hash:
+                entry[3] = _file_digest(os.path.join(from_path, rel_path))
+                if prev and prev[3] == entry[3]:
+                    continue
+            changed.append(rel_path)
+        deleted = sorted(set(prev_files) - set(files))
+
+        if not is_full and not changed and not deleted:
+            echo("... no changes in %s since last archive" % from_path)
+            return None
+
+        upload_name = self.get_archive_fullname()
+        root_dir = os.path.dirname(from_path)
+        arc_prefix = os.path.relpath(from_path, root_dir)
+        extra = {}
+        if deleted:
+            extra[self.deleted_list_name] = '\n'.join(
+                os.path.join(arc_prefix, rel_path) for rel_path in deleted
+            ).encode('utf-8')
+        echo("... archive %s %s files of directory %s" % (
+            len(changed), 'new' if is_full else 'changed', from_path))
+        with self.backup.stage('archive', source=self) as record:
+            arch_path = write_archive(
+                base_name, self.get_archive_format(), root_dir,
+                [os.path.join(arc_prefix, rel_path) for rel_path in changed],
+                extra=extra,
+                level=self.get_compression_level(),
+                threads=self.get_compression_threads())
+            record['bytes_in'] = sum(files[rel_path][0]
+                                     for rel_path in changed)
+            record['bytes_out'] = os.path.getsize(arch_path)
+        echo("... archived %s" % arch_path)
+
+        timestamp = now.strftime('%Y-%m-%dT%H:%M:%S')
+        base = upload_name if is_full else state.get('base')
+        manifest_path = base_name + '.manifest.json'
+        _save_json(manifest_path, {
+            'name': upload_name,
+            'full': is_full,
+            'base': base,
+            'created': timestamp,
+            'files': files,
+            'deleted': deleted,
+        })
+        self._manifest = {
+            'path': manifest_path,
+            'name': upload_name,
+            'state': {
+                'base': base,
+                'full_at': timestamp if is_full else full_at,
+                'files': files,
+            },
+        }
+        return arch_path
+
+    def _manifest_path(self):
+        return os.path.join(self.backup.get_state_dir(), 'manifests',
+                            self.get_key() + '.json')
+
+    def __str__(self):
+        return self.settings['path']
+
+
+def scan_files(path):
+    """
+    Walk directory tree and return dict of files by relative path:
+    [size, mtime in ns, inode, digest or None]. Symlinks are not
+    followed and listed as files.
+    """
+    files = {}
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            entries = list(os.scandir(os.path.join(path, rel_dir)))
+        except (FileNotFoundError, PermissionError) as e:
+            LOGS.warning("*** skip directory: %s" % e)
+            continue
+        for entry in entries:
+            rel_path = os.path.join(rel_dir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(rel_path)
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            files[rel_path] = [stat.st_size, stat.st_mtime_ns,
+                               stat.st_ino, None]
+    return files
+
+
+def split_shards(files, count):
+    """
+    Split files dict of :func:`scan_files()` to `count` lists of about
+    equal total size: largest files go first, every file is added to
+    the smallest shard. Return non-empty lists of sorted paths.
+    """
+    heap = [(0, number, []) for number in range(count)]
+    for rel_path in sorted(files, key=lambda path: -files[path][0]):
+        size, number, paths = heapq.heappop(heap)
+        paths.append(rel_path)
+        heapq.heappush(heap, (size + files[rel_path][0], number, paths))
+    return [sorted(paths) for _, _, paths in
+            sorted(heap, key=lambda item: item[1]) if paths]
+
+
+class BaseVault(object):
+    """
+    Base class of vaults: storage of archives by upload names, which
+    are listed, read and deleted to prune and restore backups.
+    """
+    # Vault could upload from non-seekable stream without temp file
+    streaming = False
+
+    def __init__(self, backup, settings, environ):
+        self.backup = backup
+        self.settings = settings
+        self.environ = environ
+        self._index_lock = threading.Lock()
+
+    def expand_setting(self, key, default=None):
+        value = self.settings.get(key, default)
+        return expand_value(value, {'env': self.environ})
+
+    def upload(self, archive_path, upload_name=None, metadata=None):
+        raise NotImplementedError
+
+    def reads_file(self, archive_path):
+        """
+        Check if vault uploads archive from file by path instead of
+        stream shared with other vaults.
+        """
+        return not self.streaming
+
+    def upload_stream(self, stream, upload_name, metadata=None, size=None,
+                      resumable=False):
+        """
+        Upload archive from file-like stream. Return 2-tuple:
+        ((bool) success, (dict) archive data). Expected `size` of
+        stream is provided if it's known, it could be an upper bound.
+        Stream is `resumable` if it's read from archive file, so the
+        same data is uploaded again when failed upload is retried.
+
+        Default implementation spools stream to temp file and
+        uploads it with :meth:`.upload()`.
+        """
+        temp_dir = _smaketemp(self.backup.get_temp_dir())
+        try:
+            path = os.path.join(temp_dir, os.path.basename(upload_name))
+            with open(path, 'wb') as fp:
+                shutil.copyfileobj(stream, fp, CHUNK_SIZE)
+            return self.upload(path, upload_name=upload_name,
+                               metadata=metadata)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def upload_unchanged(self, source_key, content_hash, upload_name):
+        """
+        Reuse last upload of source if it has the same content hash.
+        Return 2-tuple: ((bool) success, (dict) archive data) or `None`
+        if archive has to be uploaded.
+        """
+        prev = self._load_content_index().get(source_key)
+        if not prev or prev['hash'] != content_hash:
+            return None
+        result = self._reuse_upload(prev, upload_name)
+        if result:
+            echo("... unchanged %s reused in %s" % (upload_name, self))
+        return result
+
+    def save_content_hash(self, source_key, content_hash, upload_name, data):
+        """Save content hash of last upload of source."""
+        with self._index_lock:
+            index = self._load_content_index()
+            index[source_key] = {'hash': content_hash, 'name': upload_name,
+                                 'data': data}
+            _save_json(self._content_index_path(), index)
+
+    def list_archives(self, prefix=''):
+        """
+        Iterate over stored archives with name prefix, yield dicts with
+        `key` name, `modified` local datetime and `size`.
+        """
+        raise NotImplementedError
+
+    def delete_archives(self, entries):
+        """Delete archives listed by :meth:`.list_archives()`."""
+        raise NotImplementedError
+
+    def read_head(self, entry, size=4096):
+        """Read first `size` bytes of stored archive as text."""
+        raise NotImplementedError
+
+    def open_archive(self, entry):
+        """Open stored archive listed by :meth:`.list_archives()`."""
+        raise NotImplementedError
+
+    def _reuse_upload(self, prev, upload_name):
+        """
+        Reuse previous upload for new upload name. Default is to skip
+        upload only if name is the same.
+        """
+        if prev['name'] == upload_name:
+            return True, dict(prev['data'], unchanged=True)
+
+    def _content_index_path(self):
+        name = hashlib.sha1(str(self).encode())
+        return os.path.join(self.backup.get_state_dir(), 'content',
+                            name.hexdigest() + '.json')
+
+    def _load_content_index(self):
+        return _load_json(self._content_index_path(), {})
+
+
+class AWSVault(BaseVault):
+    """Base class of AWS vaults with shared clients and bandwidth limits."""
+    def __init__(self, backup, settings, environ):
+        super().__init__(backup, settings, environ)
+        self._client = None
+        self.bandwidth = (RateLimiter(settings['bandwidth'])
+                          if settings.get('bandwidth') else None)
+
+    @property
+    def client(self):
+        """
+        Get boto3 client from shared pool, it's created on first use,
+        so vaults without uploads don't make connections.
+        """
+        if self._client is None:
+            defaults = self.backup.defaults
+            self._client = self.backup.clients.client(
+                self.settings['service'],
+                profile=self.expand_setting('profile'),
+                region=self.expand_setting('region'),
+                access_key_id=self.expand_setting('access_key_id'),
+                secret_access_key=self.expand_setting('secret_access_key'),
+                endpoint_url=self.expand_setting('endpoint_url'),
+                max_pool_connections=self.settings.get(
+                    'max_pool_connections',
+                    defaults.get('max_pool_connections')),
+                tcp_keepalive=self.settings.get(
+                    'tcp_keepalive', defaults.get('tcp_keepalive')),
+            )
+        return self._client
+
+    def throttled(self, data):
+        """
+        Wrap upload body to wait for `bandwidth` limits while it's sent,
+        data is returned as is if there are no limits.
+        """
+        if not (self.bandwidth or self.backup.bandwidth):
+            return data
+        self.client.meta.events.register_first(
+            'before-send', _arm_throttled_body,
+            unique_id='coverme-throttle')
+        return ThrottledBody(data, self.throttle)
+
+    def throttle(self, size):
+        """
+        Wait until `size` bytes could be sent within `bandwidth` limits
+        of vault and of all vaults in defaults.
+        """
+        limiters = [self.bandwidth, self.backup.bandwidth]
+        wait = max([limiter.reserve(size) for limiter in limiters
+                    if limiter] or [0])
+        if wait:
+            time.sleep(wait)
+
+
+class TreeHash(object):
+    """
+    Incremental SHA-256 tree hash as required by Amazon Glacier,
+    digests of 1 MB chunks are added in order with :meth:`.update()`.
+    Only one digest per tree level is kept, so memory is bounded.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self):
+        self._levels = []
+
+    def update(self, chunk_digest):
+        level = 0
+        while level < len(self._levels) and self._levels[level]:
+            chunk_digest = hashlib.sha256(
+                self._levels[level] + chunk_digest).digest()
+            self._levels[level] = None
+            level += 1
+        if level == len(self._levels):
+            self._levels.append(chunk_digest)
+        else:
+            self._levels[level] = chunk_digest
+
+    def update_data(self, data):
+        """Add digests of data split by 1 MB chunks."""
+        for i in range(0, len(data), self.chunk_size):
+            self.update(hashlib.sha256(
+                data[i:i + self.chunk_size]).digest())
+
+    def digest(self):
+        result = None
+        for value in self._levels:
+            if value and result:
+                result = hashlib.sha256(value + result).digest()
+            elif value:
+                result = value
+        return result
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+class GlacierVault(AWSVault):
+    streaming = True
+
+    # Default multipart upload settings, part size must be 1 MB
+    # multiplied by power of 2
+    part_size = 64 * 1024 * 1024
+    max_concurrency = 4
+
+    # Limit of parts per multipart upload
+    max_parts = 10000
+
+    # Hours between inventory retrieval jobs
+    inventory_max_age = 24
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.part_size = parse_size(self.settings.get('part_size',
+                                                      self.part_size))
+        self.max_concurrency = int(self.settings.get('max_concurrency',
+                                                     self.max_concurrency))
+        mb_parts = self.part_size // TreeHash.chunk_size
+        if (self.part_size % TreeHash.chunk_size or
+                mb_parts & (mb_parts - 1)):
+            raise ValueError("Glacier `part_size` must be 1M multiplied "
+                             "by power of 2, e.g. 64M")
+
+    def __str__(self):
+        return "Amazon Glacier [%(region)s] %(name)s" % {
+            'name': self.expand_setting('name'),
+            'region': self.settings['region']
+        }
+
+    def upload(self, archive_path, upload_name=None, metadata=None):
+        """Upload archive to Amazon Glacier. Return 2-tuple:
+        ((bool) success, (dict) archive data).
+        """
+        description = upload_name or os.path.basename(archive_path)
+        with open(archive_path, 'rb') as data:
+            return self.upload_stream(data, description,
+                                      size=os.path.getsize(archive_path))
+
+    def upload_stream(self, stream, upload_name, metadata=None, size=None,
+                      resumable=False):
+        """
+        Upload archive to Amazon Glacier from file-like stream. Return
+        2-tuple: ((bool) success, (dict) archive data).
+
+        Streams larger than `part_size` are sent via multipart upload
+        with up to `max_concurrency` parts in parallel, tree hash is
+        calculated while parts are read. Part size is increased to fit
+        expected `size` in 10000 parts.
+        """
+        description = upload_name
+        part_size = self.get_part_size(size)
+        first = read_full(stream, part_size)
+        if len(first) < part_size:
+            archive_id = self.client.upload_archive(
+                body=self.throttled(first), archiveDescription=description,
+                **self._params()
+            )['archiveId']
+            size = len(first)
+        else:
+            archive_id, size = self._multipart_upload(description, first,
+                                                      stream, part_size)
+        if archive_id:
+            self._add_to_inventory(archive_id, description, size)
+            return True, {'id': archive_id, 'description': description}
+        else:
+            return False, None
+
+    def get_part_size(self, size=None):
+        """
+        Get part size for upload of expected `size`: `part_size` or
+        larger 1M multiplied by power of 2, so upload fits in
+        `max_parts`.
+        """
+        part_size = self.part_size
+        if size:
+            while part_size * self.max_parts < size:
+                part_size *= 2
+        return part_size
+
+    def list_archives(self, prefix=''):
+        """
+        Iterate over archives with description prefix from local
+        inventory, which is synced with Glacier inventory.
+        """
+        self.sync_inventory()
+        for archive in self._load_inventory()['archives']:
+            if archive['description'].startswith(prefix):
+                yield {'key': archive['description'], 'id': archive['id'],
+                       'modified': _parse_utc(archive['created']),
+                       'size': archive['size']}
+
+    def delete_archives(self, entries):
+        """Delete archives by ID, up to `max_concurrency` at once."""
+        client = self.client
+        params = self._params()
+
+        def delete(entry):
+            client.delete_archive(archiveId=entry['id'], **params)
+            return entry['id']
+
+        deleted = set()
+        try:
+            with ThreadPoolExecutor(
+                    max_workers=self.max_concurrency) as pool:
+                for archive_id in pool.map(delete, entries):
+                    deleted.add(archive_id)
+        finally:
+            with self._index_lock:
+                inventory = self._load_inventory()
+                inventory['archives'] = [
+                    archive for archive in inventory['archives']
+                    if archive['id'] not in deleted]
+                inventory['deleted'] = sorted(
+                    set(inventory['deleted']) | deleted)
+                _save_json(self._inventory_path(), inventory)
+
+    def open_archive(self, entry):
+        raise NotImplementedError("Glacier archives have to be retrieved "
+                                  "by job first, restore is not supported")
+
+    def sync_inventory(self):
+        """
+        Update local inventory from Glacier inventory. Retrieval job is
+        started if inventory is older than `inventory_max_age` hours,
+        and as jobs take hours, job result is received on later syncs.
+        """
+        client = self.client
+        params = self._params()
+        with self._index_lock:
+            inventory = self._load_inventory()
+            job_id = inventory['job_id']
+            if job_id:
+                try:
+                    status = client.describe_job(
+                        jobId=job_id, **params)['StatusCode']
+                except client.exceptions.ResourceNotFoundException:
+                    status = 'Failed'
+                if status == 'InProgress':
+                    return
+                if status == 'Succeeded':
+                    output = json.loads(client.get_job_output(
+                        jobId=job_id, **params)['body'].read())
+                    self._merge_inventory(inventory, output)
+                    echo("... inventory of %s is updated" % self)
+                inventory['job_id'] = None
+            requested = inventory['requested']
+            max_age = datetime.timedelta(
+                hours=float(self.settings.get('inventory_max_age',
+                                              self.inventory_max_age)))
+            if not requested or datetime.datetime.now() - \
+                    datetime.datetime.strptime(
+                        requested, '%Y-%m-%dT%H:%M:%S') >= max_age:
+                inventory['job_id'] = client.initiate_job(
+                    jobParameters={'Type': 'inventory-retrieval'}, **params
+                )['jobId']
+                inventory['requested'] = datetime.datetime.now().strftime(
+                    '%Y-%m-%dT%H:%M:%S')
+                echo("... inventory retrieval job started for %s" % self)
+            _save_json(self._inventory_path(), inventory)
+
+    def _merge_inventory(self, inventory, output):
+        """
+        Replace local inventory with Glacier inventory, archives
+        uploaded after inventory date are kept.
+        """
+        inventory_date = output['InventoryDate']
+        deleted = set(inventory['deleted'])
+        archives = [{'id': archive['ArchiveId'],
+                     'description': archive['ArchiveDescription'],
+                     'created': archive['CreationDate'],
+                     'size': archive['Size']}
+                    for archive in output['ArchiveList']
+                    if archive['ArchiveId'] not in deleted]
+        known = set(archive['id'] for archive in archives)
+        archives += [archive for archive in inventory['archives']
+                     if archive['id'] not in known and
+                     archive['created'] > inventory_date]
+        inventory['archives'] = archives
+        # Deleted archives which are not in inventory anymore
+        listed = set(archive['ArchiveId']
+                     for archive in output['ArchiveList'])
+        inventory['deleted'] = sorted(deleted & listed)
+
+    def _add_to_inventory(self, archive_id, description, size):
+        with self._index_lock:
+            inventory = self._load_inventory()
+            inventory['archives'].append({
+                'id': archive_id,
+                'description': description,
+                'created': datetime.datetime.now(
+                    datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'size': size,
+            })
+            _save_json(self._inventory_path(), inventory)
+
+    def _inventory_path(self):
+        name = hashlib.sha1(str(self).encode())
+        return os.path.join(self.backup.get_state_dir(), 'inventory',
+                            name.hexdigest() + '.json')
+
+    def _load_inventory(self):
+        inventory = {'archives': [], 'deleted': [], 'job_id': None,
+                     'requested': None}
+        inventory.update(_load_json(self._inventory_path(), {}))
+        return inventory
+
+    def _params(self):
+        """Get account and vault name parameters of client requests."""
+        return {'accountId': str(self.expand_setting('account') or '-'),
+                'vaultName': self.expand_setting('name')}
+
+    def _reuse_upload(self, prev, upload_name):
+        """
+        Glacier archives are found by ID, not by description, so
+        previous archive is reused as is.
+        """
+        return True, dict(prev['data'], unchanged=True)
+
+    def _multipart_upload(self, description, first, stream, part_size=None):
+        """
+        Upload stream via multipart upload, `first` is first part
+        already read from stream. Return 2-tuple: (archive ID, size).
+        Stream which doesn't fit in `max_parts` fails when the extra
+        part is read, before it's sent.
+        """
+        client = self.client
+        params = self._params()
+        part_size = part_size or self.part_size
+        upload_id = client.initiate_multipart_upload(
+            archiveDescription=description,
+            partSize=str(part_size),
+            **params
+        )['uploadId']
+
+        errors = []
+        slots = threading.BoundedSemaphore(self.max_concurrency)
+        tree_hash = TreeHash()
+
+        def upload_part(offset, data, checksum):
+            try:
+                if not errors:
+                    client.upload_multipart_part(
+                        uploadId=upload_id, checksum=checksum,
+                        body=self.throttled(data),
+                        range='bytes %d-%d/*' % (
+                            offset, offset + len(data) - 1),
+                        **params
+                    )
+            except Exception as e:
+                errors.append(e)
+            finally:
+                slots.release()
+
+        size = 0
+        number = 0
+        data = first
+        try:
+            with ThreadPoolExecutor(
+                    max_workers=self.max_concurrency) as pool:
+                while data and not errors:
+                    number += 1
+                    if number > self.max_parts:
+                        errors.append(ValueError(
+                            "Archive %s exceeds %s parts of %s bytes, set "
+                            "larger `part_size` for %s or `size` of "
+                            "source" % (description, self.max_parts,
+                                        part_size, self)))
+                        break
+                    part_hash = TreeHash()
+                    part_hash.update_data(data)
+                    tree_hash.update_data(data)
+                    slots.acquire()
+                    pool.submit(upload_part, size, data,
+                                part_hash.hexdigest())
+                    size += len(data)
+                    data = read_full(stream, part_size)
+            if errors:
+                raise errors[0]
+            return client.complete_multipart_upload(
+                uploadId=upload_id, archiveSize=str(size),
+                checksum=tree_hash.hexdigest(), **params
+            )['archiveId'], size
+        except Exception:
+            client.abort_multipart_upload(uploadId=upload_id, **params)
+            raise
+
+
+class S3Bucket(AWSVault):
+    streaming = True
+
+    # Default multipart upload settings
+    part_size = 64 * 1024 * 1024
+    max_concurrency = 4
+    abort_stale_after = 48
+
+    # Limits of parts per multipart upload
+    max_parts = 10000
+    min_part_size = 5 * 1024 * 1024
+
+    # Default deduplication settings for `mode: dedup`
+    chunk_size = 4 * 1024 * 1024
+    chunks_prefix = 'chunks/'
+
+    # Hours between listings of stored chunks to refresh local cache
+    chunks_max_age = 24
+
+    # Hours unreferenced chunks are kept, they could belong to upload
+    # which index isn't stored yet
+    chunks_grace = 24
+
+    # Default size of ranges for parallel downloads
+    range_size = 8 * 1024 * 1024
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.part_size = parse_size(self.settings.get('part_size',
+                                                      self.part_size))
+        self.max_concurrency = int(self.settings.get('max_concurrency',
+                                                     self.max_concurrency))
+        self.abort_stale_after = self.settings.get('abort_stale_after',
+                                                   self.abort_stale_after)
+        self._stale_checked = False
+        self.mode = self.settings.get('mode')
+        if self.mode not in (None, 'dedup'):
+            raise ValueError("Unknown S3 storage mode `%s`" % self.mode)
+        self.chunk_size = parse_size(self.settings.get('chunk_size',
+                                                       self.chunk_size))
+        self.chunks_prefix = self.expand_setting('chunks_prefix',
+                                                 self.chunks_prefix)
+        self.chunks_max_age = float(self.settings.get('chunks_max_age',
+                                                      self.chunks_max_age))
+        self.chunks_grace = float(self.settings.get('chunks_grace',
+                                                    self.chunks_grace))
+        self._chunks_lock = threading.Lock()
+        self._chunks = None
+        self._chunks_listed = None
+        self._chunks_epoch = None
+        # Dedup uploads in progress and chunks collection exclude
+        # each other, as upload could reuse unreferenced chunk
+        self._collect_cond = threading.Condition()
+        self._active_uploads = 0
+        self._collecting = False
+
+    def __str__(self):
+        return "Amazon S3 %(name)s" % self.settings
+
+    @property
+    def bucket_name(self):
+        return self.expand_setting('name')
+
+    def upload(self, archive_path, upload_name=None, metadata=None):
+        """
+        Upload archive to Amazon S3. Return 2-tuple:
+        ((bool) success, (dict) archive data).
+        """
+        key = upload_name or os.path.basename(archive_path)
+        with open(archive_path, 'rb') as data:
+            return self.upload_stream(data, key, metadata=metadata,
+                                      size=os.path.getsize(archive_path),
+                                      resumable=True)
+
+    def upload_stream(self, stream, upload_name, metadata=None, size=None,
+                      resumable=False):
+        """
+        Upload archive to Amazon S3 from file-like stream. Return
+        2-tuple: ((bool) success, (dict) archive data).
+
+        Streams larger than `part_size` are sent via multipart upload
+        with up to `max_concurrency` parts in parallel. Part size is
+        increased to fit expected `size` in 10000 parts. Unfinished
+        upload of `resumable` stream, i.e. archive file, is kept and
+        resumed on next upload to the same key, parts already stored
+        with the same MD5 are not sent again. Every part is sent with
+        Content-MD5 for integrity check.
+        """
+        metadata = metadata or {}
+        if self.mode == 'dedup':
+            return self._dedup_upload(stream, upload_name, metadata)
+        self.abort_stale_uploads()
+        key = upload_name
+        state = self._load_upload_state(key)
+        if state and state.get('part_size'):
+            part_size = state['part_size']
+        else:
+            part_size = self.get_part_size(size)
+        first = read_full(stream, part_size)
+        if len(first) < part_size and not state:
+            self.client.put_object(Bucket=self.bucket_name, ACL='private',
+                                   Body=self.throttled(first), Key=key,
+                                   ContentMD5=_content_md5(first),
+                                   Metadata=metadata)
+            return True, {'key': key}
+        parts = self._multipart_upload(key, first, stream, state, metadata,
+                                       part_size, resumable)
+        return True, {'key': key, 'parts': parts}
+
+    def get_part_size(self, size=None):
+        """
+        Get part size for upload of expected `size`: `part_size` or
+        larger one rounded up to 1M, so upload fits in `max_parts`.
+        """
+        if self.part_size < self.min_part_size:
+            raise ValueError("S3 `part_size` of %s must be at least 5M, "
+                             "set for %s" % (self.part_size, self))
+        if not size or size <= self.part_size * self.max_parts:
+            return self.part_size
+        mb = 1024 * 1024
+        part_size = -(-size // self.max_parts)
+        return -(-part_size // mb) * mb
+
+    def _reuse_upload(self, prev, upload_name):
+        """
+        Copy previous upload to new key on server side, it's skipped if
+        key is the same and object still exists. Return `None` if
+        previous object is not found.
+        """
+        client = self.client
+        bucket = self.bucket_name
+        prev_key = prev['data']['key']
+        key = upload_name
+        if self.mode == 'dedup':
+            key += '.cdc.json'
+        try:
+            if prev_key == key:
+                client.head_object(Bucket=bucket, Key=key)
+            else:
+                client.copy({'Bucket': bucket, 'Key': prev_key},
+                            bucket, key, ExtraArgs={'ACL': 'private'})
+        except client.exceptions.ClientError as e:
+            echo("*** can't reuse %s in %s: %s" % (prev_key, self, e))
+            return None
+        data = dict(prev['data'], key=key, unchanged=True)
+        if 'new_chunks' in data:
+            data['new_chunks'] = 0
+        return True, data
+
+    def list_archives(self, prefix=''):
+        """
+        Iterate over objects with key prefix by paginated listing,
+        chunks of dedup mode are skipped.
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name,
+                                       Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if (self.mode == 'dedup' and
+                        obj['Key'].startswith(self.chunks_prefix)):
+                    continue
+                yield {'key': obj['Key'],
+                       'modified': obj['LastModified'].astimezone().replace(
+                           tzinfo=None),
+                       'size': obj['Size']}
+
+    def delete_archives(self, entries):
+        """
+        Delete objects by batches of 1000 keys, up to `max_concurrency`
+        batches at once. In dedup mode chunks which are not referenced
+        anymore are deleted after indexes.
+        """
+        keys = [entry['key'] for entry in entries]
+        self._delete_keys(keys)
+        if (self.mode == 'dedup' and
+                any(key.endswith('.cdc.json') for key in keys)):
+            self.collect_chunks()
+
+    def collect_chunks(self):
+        """
+        Delete chunks which are not listed in any index in bucket by
+        mark and sweep: all indexes are read to mark used chunks, then
+        unused chunks older than `chunks_grace` hours are deleted. New
+        epoch is written to collection marker before indexes are read,
+        so uploads from other hosts drop their chunks caches. Return
+        number of deleted chunks.
+        """
+        with self._collect_cond:
+            while self._active_uploads or self._collecting:
+                self._collect_cond.wait()
+            self._collecting = True
+        try:
+            return self._collect_chunks()
+        finally:
+            with self._collect_cond:
+                self._collecting = False
+                self._collect_cond.notify_all()
+
+    def _collect_chunks(self):
+        marker = {'epoch': os.urandom(8).hex(), 'started': time.time(),
+                  'finished': None}
+        self._write_gc_marker(marker)
+        try:
+            return self._mark_and_sweep(marker)
+        finally:
+            marker['finished'] = time.time()
+            self._write_gc_marker(marker)
+
+    def _mark_and_sweep(self, marker):
+        client = self.client
+        bucket = self.bucket_name
+        index_keys = []
+        chunks = []
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket):
+            for obj in page.get('Contents', []):
+                if obj['Key'].startswith(self.chunks_prefix):
+                    chunks.append(obj)
+                elif obj['Key'].endswith('.cdc.json'):
+                    index_keys.append(obj['Key'])
+
+        def read_index(key):
+            return json.loads(client.get_object(
+                Bucket=bucket, Key=key)['Body'].read())
+
+        used = set()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            for index in pool.map(read_index, index_keys):
+                if index.get('prefix') == self.chunks_prefix:
+                    used.update(digest for digest, _ in index['chunks'])
+        started = datetime.datetime.now(datetime.timezone.utc)
+        deadline = started - datetime.timedelta(hours=self.chunks_grace)
+        stored = set()
+        unused = []
+        for obj in chunks:
+            digest = obj['Key'].rsplit('/', 1)[-1]
+            if digest in used or obj['LastModified'] > deadline:
+                stored.add(digest)
+            else:
+                unused.append(obj['Key'])
+        echo("... %s of %s chunks are not used by %s indexes in %s" % (
+            len(unused), len(chunks), len(index_keys), self))
+        self._delete_keys(unused)
+        with self._chunks_lock:
+            self._write_chunks_cache(stored, started.timestamp(),
+                                     marker['epoch'])
+        if unused:
+            echo("+++ deleted %s unused chunks from %s" % (len(unused), self))
+        return len(unused)
+
+    def _delete_keys(self, keys):
+        """Delete objects by keys with batch requests."""
+        client = self.client
+        bucket = self.bucket_name
+
+        def delete(batch):
+            response = client.delete_objects(Bucket=bucket, Delete={
+                'Objects': [{'Key': key} for key in batch],
+                'Quiet': True,
+            })
+            return response.get('Errors', [])
+
+        batches = [keys[i:i + 1000] for i in range(0, len(keys), 1000)]
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            errors = sum(pool.map(delete, batches), [])
+        if errors:
+            raise RuntimeError("%s objects are not deleted, e.g. %s: %s" % (
+                len(errors), errors[0]['Key'], errors[0]['Message']))
+
+    def read_head(self, entry, size=4096):
         """
-        Copy data from source and make archive within temp directory.
+        Read first `size` bytes of object as text by ranged request,
+        for dedup index first chunk is read.
         """
-        data_dir = self._prepare_data_path(temp_dir)
-        not_empty = self.copy_data(data_dir)
-        if not_empty:
-            arch_path = self._make_archive(data_dir)
-            echo("... archived %s" % arch_path)
+        client = self.client
+        bucket = self.bucket_name
+        key = entry['key']
+        if key.endswith('.cdc.json'):
+            index = json.loads(client.get_object(
+                Bucket=bucket, Key=key)['Body'].read())
+            if not index['chunks']:
+                return ''
+            data = self._get_chunk(index['prefix'],
+                                   index['chunks'][0][0])[:size]
         else:
-            arch_path = None
-        return arch_path
-
-    def copy_data(self, data_dir):
-        """Copy backup data to temp directory."""
-        raise NotImplementedError
+            data = client.get_object(Bucket=bucket, Key=key,
+                                     Range='bytes=0-%d' % (size - 1)
+                                     )['Body'].read()
+        return data.decode('utf-8', 'replace')
 
-    def get_vault_keys(self):
+    def open_archive(self, entry):
         """
-        Get vaults keys to upload archive. If not specified in config,
-        return ['*'] which mean all available vaults.
+        Open stored archive for reading as stream. Object is downloaded
+        by ranged requests of `range_size`, up to `max_concurrency` at
+        once, dedup archive is assembled from chunks listed in index.
         """
-        return self.expand_setting('to', ['*'])
+        client = self.client
+        bucket = self.bucket_name
+        key = entry['key']
+        if key.endswith('.cdc.json'):
+            index = json.loads(client.get_object(
+                Bucket=bucket, Key=key)['Body'].read())
+            tasks = (lambda digest=digest: self._get_chunk(index['prefix'],
+                                                           digest)
+                     for digest, _ in index['chunks'])
+        else:
+            size = entry.get('size')
+            if size is None:
+                size = client.head_object(Bucket=bucket,
+                                          Key=key)['ContentLength']
+            range_size = parse_size(self.settings.get('range_size',
+                                                      self.range_size))
 
-    def get_archive_format(self):
-        """Get archive format."""
-        default_format = self.backup.defaults.get('format') or 'zip'
-        return self.expand_setting('format') or default_format
+            def get_range(start):
+                end = min(start + range_size, size) - 1
+                return client.get_object(
+                    Bucket=bucket, Key=key, Range='bytes=%d-%d' % (start, end)
+                )['Body'].read()
 
-    def get_archive_basename(self):
+            tasks = (lambda start=start: get_range(start)
+                     for start in range(0, size, range_size))
+        return IterStream(iter_prefetch(tasks, self.max_concurrency))
+
+    def _get_chunk(self, prefix, digest):
+        """Download chunk of dedup mode and check its digest."""
+        key = '%s%s/%s' % (prefix, digest[:2], digest)
+        body = self.client.get_object(
+            Bucket=self.bucket_name, Key=key)['Body'].read()
+        data = zlib.decompress(body)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError("Chunk %s is corrupted" % digest)
+        return data
+
+    def abort_stale_uploads(self):
         """
-        Get base name for archive without extension, e.g. for MySQL
-        dump archive it could return `mysql-2016-10-20.sql` and the derived
-        zip-archive will have name `mysql-2016-10-20.sql.zip`.
+        Abort unfinished multipart uploads of coverme initiated more
+        than `abort_stale_after` hours ago, so their parts are not
+        stored forever. Only uploads recorded in `statedir` are
+        aborted, other uploads to bucket are never touched.
         """
-        return self.expand_setting('name')
+        if self._stale_checked or not self.abort_stale_after:
+            return
+        self._stale_checked = True
+        client = self.client
+        bucket = self.bucket_name
+        expired = time.time() - float(self.abort_stale_after) * 3600
+        state_dir = os.path.join(self.backup.get_state_dir(), 'uploads')
+        if not os.path.isdir(state_dir):
+            return
+        for name in os.listdir(state_dir):
+            path = os.path.join(state_dir, name)
+            state = _load_json(path)
+            if not state or state.get('bucket') != bucket:
+                continue
+            initiated = state.get('initiated') or os.path.getmtime(path)
+            if initiated >= expired:
+                continue
+            try:
+                client.abort_multipart_upload(Bucket=bucket,
+                                              Key=state['key'],
+                                              UploadId=state['upload_id'])
+            except client.exceptions.NoSuchUpload:
+                pass
+            self._delete_upload_state(state['key'])
+            echo("... aborted stale upload %s to %s" % (state['key'], self))
 
-    def get_archive_fullname(self):
+    def _multipart_upload(self, key, first, stream, state, metadata=None,
+                          part_size=None, resumable=False):
         """
-        Get archive name with extension, e.g. for MySQL
-        dump archive it could return `mysql-2016-10-20.sql`.
-
-        The name pattern configured as `name` parameter in backup
-        source definition in config.
+        Upload stream via multipart upload, `first` is first part
+        already read from stream. Return number of parts. Stream which
+        doesn't fit in `max_parts` fails when the extra part is read,
+        before it's sent. Failed upload is aborted unless it's
+        `resumable` and failed by sending parts, errors of stream, e.g.
+        of failed dump, always abort it as it can't be resumed.
         """
-        name = self.get_archive_basename()
-        aformat = self.get_archive_format()
-        ext = ARCHIVE_EXTENSIONS.get(aformat)
-        if not ext:
-            ext = '.%s' % aformat
-            LOGS.warning("*** archive format `%s` is not registered with"
-                        " `register_archive_extension()`" % aformat)
-        return name + ext
+        client = self.client
+        bucket = self.bucket_name
+        part_size = part_size or self.part_size
+        upload_id, stored = self._resume_upload(key, state, part_size)
+        if not upload_id:
+            upload_id = client.create_multipart_upload(
+                Bucket=bucket, Key=key, ACL='private',
+                Metadata=metadata or {}
+            )['UploadId']
+            self._save_upload_state(key, {'upload_id': upload_id,
+                                          'initiated': time.time(),
+                                          'part_size': part_size})
+        else:
+            echo("... resuming upload %s to %s" % (key, self))
 
-    def get_local_dir(self):
-        """Get directory path for local backups."""
-        default = self.backup.get_local_dir()
-        localdir = self.expand_setting('localdir') or default
-        if localdir:
-            return os.path.realpath(localdir)
+        etags = {}
+        errors = []
+        slots = threading.BoundedSemaphore(self.max_concurrency)
 
-    def _make_archive(self, dir_name):
-        """Make archive of the specified directory near that directory."""
-        return shutil.make_archive(dir_name,
-                                   root_dir=dir_name,
-                                   base_dir=None,
-                                   format=self.get_archive_format())
+        def upload_part(number, data, md5):
+            try:
+                if not errors:
+                    etags[number] = client.upload_part(
+                        Bucket=bucket, Key=key, UploadId=upload_id,
+                        PartNumber=number, Body=self.throttled(data),
+                        ContentMD5=base64.b64encode(md5).decode()
+                    )['ETag']
+            except Exception as e:
+                errors.append(e)
+            finally:
+                slots.release()
 
-    def _prepare_data_path(self, base_dir):
+        number = 0
+        data = first
+        stream_error = None
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            while data and not errors:
+                number += 1
+                if number > self.max_parts:
+                    stream_error = ValueError(
+                        "Archive %s exceeds %s parts of %s bytes, set "
+                        "larger `part_size` for %s or `size` of source" % (
+                            key, self.max_parts, part_size, self))
+                    break
+                etag = stored.get(number)
+                md5 = hashlib.md5(data).digest()
+                if etag and etag.strip('"') == md5.hex():
+                    etags[number] = etag
+                else:
+                    slots.acquire()
+                    pool.submit(upload_part, number, data, md5)
+                try:
+                    data = read_full(stream, part_size)
+                except Exception as e:
+                    stream_error = e
+                    break
+        if stream_error or errors:
+            if stream_error or not resumable:
+                echo("... aborting upload %s to %s" % (key, self))
+                client.abort_multipart_upload(Bucket=bucket, Key=key,
+                                              UploadId=upload_id)
+                self._delete_upload_state(key)
+            raise stream_error or errors[0]
+
+        client.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'PartNumber': n, 'ETag': etags[n]} for n in sorted(etags)
+            ]}
+        )
+        self._delete_upload_state(key)
+        return number
+
+    def _dedup_upload(self, stream, upload_name, metadata=None):
         """
-        Join base dir with :meth:`.get_archive_basename()` and create
-        all parent dirs in the resulting tree. Return joined path.
+        Upload stream as content-defined chunks, every chunk is stored
+        once by its SHA-256 under `chunks_prefix` and compressed with
+        zlib. Small index object `{upload_name}.cdc.json` lists chunks
+        of the archive. Return 2-tuple: ((bool) success, (dict) data).
         """
-        path = os.path.join(base_dir, self.get_archive_basename())
-        _smakedirs(os.path.dirname(path))
-        return path
+        with self._collect_cond:
+            while self._collecting:
+                self._collect_cond.wait()
+            self._active_uploads += 1
+        try:
+            return self._store_chunks(stream, upload_name, metadata)
+        finally:
+            with self._collect_cond:
+                self._active_uploads -= 1
+                self._collect_cond.notify_all()
 
+    def _store_chunks(self, stream, upload_name, metadata):
+        marker = self._read_gc_marker()
+        if marker and not marker['finished'] and (
+                time.time() - marker['started'] < self.chunks_grace * 3600):
+            raise RuntimeError("Chunks are being collected in %s, upload "
+                               "later" % self)
+        known = self._load_chunks(marker)
+        client = self.client
+        bucket = self.bucket_name
+        chunks = []
+        added = set()
+        errors = []
+        slots = threading.BoundedSemaphore(self.max_concurrency)
 
-class DbSource(BackupSource):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.url = urlparse(self.expand_setting('url'))
-        self.db = self.url.path.strip('/')
-        if not self.db:
-            raise ValueError(
-                "Database is not defined %s" % self.settings
-            )
-
-    def __str__(self):
-        return '%s://%s%s' % (self.url.scheme, self.url.hostname, self.url.path)
+        def upload_chunk(digest, data):
+            try:
+                if not errors:
+                    body = zlib.compress(data)
+                    client.put_object(Bucket=bucket, ACL='private',
+                                      Key=self._chunk_key(digest),
+                                      Body=self.throttled(body),
+                                      ContentMD5=_content_md5(body))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                slots.release()
 
+        size = 0
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            for data in iter_cdc_chunks(stream, self.chunk_size):
+                if errors:
+                    break
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append([digest, len(data)])
+                size += len(data)
+                if digest not in known and digest not in added:
+                    added.add(digest)
+                    slots.acquire()
+                    pool.submit(upload_chunk, digest, data)
+        if errors:
+            raise errors[0]
 
-class PostgresqlBackupSource(DbSource):
-    def copy_data(self, data_dir):
-        """Make database dump via `pg_dump`. Return `True` on success."""
-        dump_file = self._prepare_data_path(data_dir)
-        args = ['pg_dump', '--file=%s' % dump_file]
-        env = self.environ.copy()
-        if self.url.port:
-            args.append('--port=%s' % self.url.port)
-        if self.url.hostname:
-            args.append('--host=%s' % self.url.hostname)
-        if self.url.username:
-            args.append('--username=%s' % self.url.username)
-        if self.url.password:
-            env['PGPASSWORD'] = self.url.password
-        options = self.expand_setting('options')
-        if options:
-            args += options.split(' ')
-        args.append(self.db)
-        echo("... %s with options %s" % (args[0], options or '(none)'))
-        proc = subprocess.Popen(args, env=env)
-        proc.wait()
-        return (proc.returncode == 0)
+        index_key = upload_name + '.cdc.json'
+        index = {
+            'name': upload_name,
+            'size': size,
+            'compression': 'zlib',
+            'prefix': self.chunks_prefix,
+            'chunks': chunks,
+        }
+        body = json.dumps(index).encode('utf-8')
+        client.put_object(Bucket=bucket, ACL='private', Key=index_key,
+                          Body=body, ContentMD5=_content_md5(body),
+                          Metadata=metadata or {})
+        # Collection started before index is stored could miss it and
+        # delete reused chunks, later one marks them as used
+        reused = any(digest not in added for digest, _ in chunks)
+        if reused and self._read_gc_marker() != marker:
+            client.delete_object(Bucket=bucket, Key=index_key)
+            raise RuntimeError("Chunks were collected in %s during upload "
+                               "of %s, upload again" % (self, upload_name))
+        self._save_chunks(added)
+        return True, {'key': index_key, 'chunks': len(chunks),
+                      'new_chunks': len(added)}
 
+    def _chunk_key(self, digest):
+        return '%s%s/%s' % (self.chunks_prefix, digest[:2], digest)
 
-class MySQLBackupSource(DbSource):
-    def copy_data(self, data_dir):
-        """Make database dump via `mysqldump`. Return `True` on success."""
-        dump_file = self._prepare_data_path(data_dir)
-        args = ['mysqldump', '--result-file=%s' % dump_file]
-        if self.url.port:
-            args.append('--port=%s' % self.url.port)
-        if self.url.hostname:
-            args.append('--host=%s' % self.url.hostname)
-        if self.url.username:
-            args.append('--user=%s' % self.url.username)
-        if self.url.password:
-            args.append('--password=%s' % self.url.password)
-        options = self.expand_setting('options')
-        if options:
-            args += options.split(' ')
-        args.append(self.db)
-        echo("... %s with options %s" % (args[0], options or '(none)'))
-        result = subprocess.call(args, stderr=subprocess.STDOUT)
-        return (result == 0)
+    def _chunks_cache_path(self):
+        name = hashlib.sha1(('%s/%s' % (self.bucket_name,
+                                        self.chunks_prefix)).encode())
+        return os.path.join(self.backup.get_state_dir(), 'chunks',
+                            name.hexdigest() + '.txt')
 
+    def _load_chunks(self, marker=None):
+        """
+        Get set of stored chunks digests. It's cached in `statedir` and
+        listed from bucket if there's no cache yet, it's older than
+        `chunks_max_age` hours or chunks were collected since listing,
+        i.e. epoch of collection `marker` is changed.
+        """
+        epoch = marker['epoch'] if marker else None
+        with self._chunks_lock:
+            path = self._chunks_cache_path()
+            if self._chunks is None and os.path.exists(path):
+                with open(path) as fp:
+                    lines = fp.read().split()
+                headers = dict(line[1:].split('=', 1) for line in lines
+                               if line.startswith('#'))
+                if 'listed' in headers:
+                    self._chunks_listed = float(headers['listed'])
+                    self._chunks_epoch = headers.get('epoch') or None
+                    self._chunks = set(line for line in lines
+                                       if not line.startswith('#'))
+            if (self._chunks is None or time.time() - self._chunks_listed >
+                    self.chunks_max_age * 3600 or
+                    self._chunks_epoch != epoch):
+                self._write_chunks_cache(set(self._list_chunks()),
+                                         epoch=epoch)
+            return self._chunks
 
-class DirBackupSource(BackupSource):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.path = self.expand_setting('path')
-        if not self.path:
-            raise ValueError("Path not specified for directory "
-                             "backup source, 'path' key is empty")
+    def _list_chunks(self):
+        """Iterate over stored chunks objects."""
+        echo("... listing stored chunks in %s" % self)
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name,
+                                       Prefix=self.chunks_prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'].rsplit('/', 1)[-1]
 
-    def archive(self, temp_dir):
-        """Archive source directory to temp directory.
-        Return archive full path.
+    def _write_chunks_cache(self, digests, listed=None, epoch=None):
         """
-        # We want to achive `/my/sub/{some dir}` under unique temp dir:
-        # `/tmp/dEdjnr/{name from config}`
-        #
-        # So we make archive from base path `/my/sub/{some dir}`,
-        # root path `/my/sub/` and archive name
-        # `/tmp/dEdjnr/{name from config}`
-        from_path = self.expand_setting('path')
-        base_name = self._prepare_data_path(temp_dir)
-        echo("... archive directory %s" % from_path)
-        arch_path = shutil.make_archive(
-            base_name=base_name,
-            root_dir=os.path.dirname(from_path),
-            base_dir=from_path,
-            # logger=log,
-            format=self.get_archive_format())
-        echo("... archived %s" % arch_path)
-        return arch_path
+        Replace cache of stored chunks, it has headers of listing time
+        and collection epoch.
+        """
+        self._chunks = digests
+        self._chunks_listed = listed or time.time()
+        self._chunks_epoch = epoch
+        path = self._chunks_cache_path()
+        _smakedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write('\n'.join(['#listed=%s' % self._chunks_listed,
+                                '#epoch=%s' % (epoch or '')] +
+                               sorted(digests)))
 
-    def __str__(self):
-        return self.settings['path']
+    def _gc_marker_key(self):
+        return self.chunks_prefix.rstrip('/') + '.gc.json'
 
+    def _read_gc_marker(self):
+        """
+        Read marker of chunks collection: epoch, start and finish times.
+        Return `None` if chunks were never collected.
+        """
+        client = self.client
+        try:
+            body = client.get_object(Bucket=self.bucket_name,
+                                     Key=self._gc_marker_key())['Body']
+        except client.exceptions.NoSuchKey:
+            return None
+        return json.loads(body.read())
 
-class AWSVault(object):
-    def __init__(self, backup, settings, environ):
-        self.backup = backup
-        self.settings = settings
-        self.environ = environ
-        session = boto3.session.Session(
-            profile_name=self.expand_setting('profile'),
-        )
-        self.service = session.resource(
-            settings['service'],
-            region_name=self.expand_setting('region'),
-            aws_access_key_id=self.expand_setting('access_key_id'),
-            aws_secret_access_key=self.expand_setting('secret_access_key'),
-            endpoint_url=self.expand_setting('endpoint_url')
-        )
+    def _write_gc_marker(self, marker):
+        body = json.dumps(marker).encode('utf-8')
+        self.client.put_object(Bucket=self.bucket_name, ACL='private',
+                               Key=self._gc_marker_key(), Body=body,
+                               ContentMD5=_content_md5(body))
 
-    def expand_setting(self, key, default=None):
-        value = self.settings.get(key, default)
-        return expand_value(value, {'env': self.environ})
+    def _save_chunks(self, digests):
+        """Add new chunks digests to cache."""
+        if not digests:
+            return
+        with self._chunks_lock:
+            self._chunks.update(digests)
+            path = self._chunks_cache_path()
+            _smakedirs(os.path.dirname(path))
+            with open(path, 'a') as fp:
+                fp.write('\n' + '\n'.join(sorted(digests)))
 
+    def _resume_upload(self, key, state, part_size):
+        """
+        Get 2-tuple for unfinished upload: (upload ID, dict of stored
+        parts ETags by number). Return (None, {}) if nothing to resume.
+        """
+        if not state:
+            return None, {}
+        client = self.client
+        stored = {}
+        try:
+            paginator = client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.bucket_name,
+                                           Key=key,
+                                           UploadId=state['upload_id']):
+                for part in page.get('Parts', []):
+                    if part['Size'] == part_size:
+                        stored[part['PartNumber']] = part['ETag']
+        except client.exceptions.NoSuchUpload:
+            self._delete_upload_state(key)
+            return None, {}
+        return state['upload_id'], stored
 
-class GlacierVault(AWSVault):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        account_id = self.expand_setting('account', '')
-        name = self.expand_setting('name')
-        self.vault = self.service.Vault(str(account_id), name)
+    def _upload_state_path(self, key):
+        name = hashlib.sha1(('%s/%s' % (self.bucket_name, key)).encode())
+        return os.path.join(self.backup.get_state_dir(), 'uploads',
+                            name.hexdigest() + '.json')
 
-    def __str__(self):
-        return "Amazon Glacier [%(region)s] %(name)s" % {
-            'name': self.vault.name,
-            'region': self.settings['region']
-        }
+    def _load_upload_state(self, key):
+        return _load_json(self._upload_state_path(key))
 
-    def upload(self, archive_path, upload_name=None):
-        """Upload archive to Amazon Glacier. Return 2-tuple:
-        ((bool) success, (dict) archive data).
-        """
-        # self.vault.load()
-        with open(archive_path, 'rb') as data:
-            description = upload_name or os.path.basename(archive_path)
-            archive = self.vault.upload_archive(
-                body=data, archiveDescription=description
-            )
-        if archive:
-            return True, {'id': archive.id, 'description': description}
-        else:
-            return False, None
+    def _save_upload_state(self, key, state):
+        state = dict(state, bucket=self.bucket_name, key=key)
+        _save_json(self._upload_state_path(key), state)
 
+    def _delete_upload_state(self, key):
+        path = self._upload_state_path(key)
+        if os.path.exists(path):
+            os.unlink(path)
 
-class S3Bucket(AWSVault):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        name = self.expand_setting('name')
-        self.bucket = self.service.Bucket(name)
+
+class LocalVault(BaseVault):
+    """
+    Local backups directory written as one more vault concurrently with
+    remote uploads. Archive file is cloned by reflink or hard link if
+    directory is on the same file system, otherwise shared upload
+    stream is copied, so archive is read only once.
+    """
+    streaming = True
 
     def __str__(self):
-        return "Amazon S3 %(name)s" % self.settings
+        return "Local directory %(path)s" % self.settings
 
-    def upload(self, archive_path, upload_name=None):
+    def reads_file(self, archive_path):
+        """Clone archive file if it's on the same file system."""
+        path = self.settings['path']
+        _smakedirs(path)
+        return os.stat(archive_path).st_dev == os.stat(path).st_dev
+
+    def upload(self, archive_path, upload_name=None, metadata=None):
         """
-        Upload archive to Amazon S3. Return 2-tuple:
+        Clone archive file into directory. Return 2-tuple:
         ((bool) success, (dict) archive data).
         """
-        key = upload_name or os.path.basename(archive_path)
-        with open(archive_path, 'rb') as data:
-            obj = self.bucket.put_object(
-                ACL='private', Body=data, Key=key
-            )
-        if obj:
-            return True, {'key': obj.key}
-        else:
-            return False, None
+        path = self._get_path(upload_name or os.path.basename(archive_path))
+        method = _clone_file(archive_path, path)
+        return True, {'path': path, 'method': method}
+
+    def upload_stream(self, stream, upload_name, metadata=None, size=None,
+                      resumable=False):
+        """
+        Copy archive from file-like stream into directory, file is
+        written under temp name and renamed when it's complete.
+        """
+        path = self._get_path(upload_name)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                shutil.copyfileobj(stream, fp, CHUNK_SIZE)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return True, {'path': path, 'method': 'copy'}
+
+    def _reuse_upload(self, prev, upload_name):
+        """Clone previous file, return `None` if it's not found."""
+        prev_path = prev['data']['path']
+        path = self._get_path(upload_name)
+        if prev_path != path:
+            try:
+                _clone_file(prev_path, path)
+            except (IOError, OSError) as e:
+                echo("*** can't reuse %s in %s: %s" % (prev_path, self, e))
+                return None
+        elif not os.path.exists(path):
+            return None
+        return True, dict(prev['data'], path=path, unchanged=True)
+
+    def list_archives(self, prefix=''):
+        """Iterate over files under directory with name prefix."""
+        base_dir = self.settings['path']
+        for dir_path, _, filenames in os.walk(base_dir):
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                key = os.path.relpath(path, base_dir).replace(os.sep, '/')
+                if filename.startswith('.tmp-') or not key.startswith(prefix):
+                    continue
+                stat = os.stat(path)
+                yield {'key': key,
+                       'modified': datetime.datetime.fromtimestamp(
+                           stat.st_mtime),
+                       'size': stat.st_size}
+
+    def delete_archives(self, entries):
+        for entry in entries:
+            os.unlink(self._get_path(entry['key']))
+
+    def read_head(self, entry, size=4096):
+        with open(self._get_path(entry['key']), 'rb') as fp:
+            return fp.read(size).decode('utf-8', 'replace')
+
+    def open_archive(self, entry):
+        fp = open(self._get_path(entry['key']), 'rb')
+        return IterStream(iter_chunks(fp), source=fp)
+
+    def _get_path(self, key):
+        path = os.path.join(self.settings['path'], *key.split('/'))
+        _smakedirs(os.path.dirname(path))
+        return path
 
 
 def main():
@@ -532,11 +5444,25 @@ def main():
     @click.option('-c', '--config', show_default=True, default='backup.yml',
                   help="Backups configuration file."
                        "Specify '-' to read from STDIN.")
+    @click.option('--resume', is_flag=True,
+                  help="Resume unfinished uploads of failed run.")
+    @click.option('-t', '--tags', default=None,
+                  help="Run only sources with any of tags, comma separated.")
+    @click.option('-x', '--exclude-tags', default=None,
+                  help="Skip sources with any of tags, comma separated.")
+    @click.option('-s', '--source', 'names', multiple=True,
+                  help="Run only source by `id`, name pattern, path or URL, "
+                       "could be repeated.")
+    @click.option('--plan', is_flag=True,
+                  help="Print order of sources with estimated duration "
+                       "and exit.")
     @click.pass_context
-    def backup(ctx, config):
+    def backup(ctx, config, resume, tags, exclude_tags, names, plan):
         params = get_params(config)
         environ = deepcopy(os.environ)
-        tool, errors = Backup.create_with_config(environ, **params)
+        tool, errors = Backup.create_with_config(
+            environ, source_filter=SourceFilter(tags, exclude_tags, names),
+            **params)
 
         if errors:
             path = errors.pop('path')
@@ -549,7 +5475,93 @@ def main():
                  "    https://github.com/05bit/coverme\n")
             sys.exit(1)
 
-        tool.run()
+        if plan:
+            items = tool.plan()
+            workers = int(tool.defaults.get('workers') or 1)
+            for source, size, seconds in items:
+                click.echo("%10s  %10s  %s" % (
+                    _format_duration(seconds), _format_size(size), source))
+            click.echo("%10s  total with %s workers" % (
+                _format_duration(Planner.wall_time(items, workers)),
+                workers))
+            return
+
+        tool.run(resume=resume)
+
+    @cli.command()
+    @click.option('-c', '--config', show_default=True, default='backup.yml',
+                  help="Backups configuration file."
+                       "Specify '-' to read from STDIN.")
+    @click.option('--dry-run', is_flag=True,
+                  help="Only show backups to delete.")
+    @click.pass_context
+    def prune(ctx, config, dry_run):
+        """Delete old backups according to `keep` policies."""
+        environ = deepcopy(os.environ)
+        tool, errors = Backup.create_with_config(environ,
+                                                 **get_params(config))
+        if errors:
+            for k, v in errors.items():
+                echo("*** %s %s" % (k, v))
+            sys.exit(1)
+        for source in tool.sources:
+            tool.prune(source, dry_run=dry_run)
+        tool.metrics.export()
+
+    @cli.command()
+    @click.option('-c', '--config', show_default=True, default='backup.yml',
+                  help="Backups configuration file."
+                       "Specify '-' to read from STDIN.")
+    @click.option('-s', '--source', required=True,
+                  help="Source `id`, name pattern, path or URL.")
+    @click.option('-d', '--date', default=None,
+                  help="Restore latest backup made before date, e.g. "
+                       "2016-10-20 or 2016-10-20T05:30, default: latest.")
+    @click.option('--vault', default=None,
+                  help="Vault key, default: first vault of source.")
+    @click.option('--to', 'to_dir', default=None,
+                  help="Extract archive to directory.")
+    @click.option('--load', is_flag=True,
+                  help="Load dump to database with `psql` or `mysql`.")
+    @click.option('--list', 'list_only', is_flag=True,
+                  help="List backups of source.")
+    @click.pass_context
+    def restore(ctx, config, source, date, vault, to_dir, load, list_only):
+        """Restore backup from vault."""
+        environ = deepcopy(os.environ)
+        tool, errors = Backup.create_with_config(environ,
+                                                 **get_params(config))
+        if errors:
+            for k, v in errors.items():
+                echo("*** %s %s" % (k, v))
+            sys.exit(1)
+        source = tool.find_source(source)
+        if list_only:
+            vault_key = vault or tool._get_vault_keys(source)[0]
+            groups = tool.find_backups(source,
+                                       tool._get_vault(source, vault_key))
+            for name, group in sorted(groups.items(),
+                                      key=lambda item: item[1]['time']):
+                click.echo("%s  %12s  %s" % (
+                    group['time'].strftime('%Y-%m-%d %H:%M:%S'),
+                    sum(entry['size'] or 0 for entry in group['entries']),
+                    name))
+            return
+        if bool(to_dir) == bool(load):
+            raise click.UsageError("Either `--to` or `--load` is required")
+        tool.restore(source, vault_key=vault, date=_parse_date(date),
+                     to_dir=to_dir, load=load)
+
+    @cli.command()
+    @click.option('-c', '--config', show_default=True, default='backup.yml',
+                  help="Backups configuration file, reloaded on change.")
+    @click.option('--poll', show_default=True, default=10,
+                  help="Interval in seconds to check config and jobs.")
+    @click.pass_context
+    def daemon(ctx, config, poll):
+        """Run sources by their schedules."""
+        environ = deepcopy(os.environ)
+        Daemon(environ, config, poll_interval=poll).run()
 
     try:
         cli()
@@ -573,13 +5585,153 @@ def _smaketemp(base_dir, prefix=''):
     return tempfile.mkdtemp(dir=base_dir, prefix=prefix)
 
 
-def _smove(src, dst_dir):
-    """Move file to destination directory with overwrite."""
+def _clone_file(src, dst):
+    """
+    Clone file by reflink if file system supports it, by hard link if
+    it's the same file system, otherwise copy. Destination is replaced
+    atomically. Return used method: `reflink`, `hardlink` or `copy`.
+    """
+    dst_dir = os.path.dirname(dst)
     _smakedirs(dst_dir)
-    dst_path = os.path.join(dst_dir, os.path.basename(src))
-    if os.path.exists(dst_path):
-        os.unlink(dst_path)
-    shutil.move(src, dst_dir)
+    fd, temp_path = tempfile.mkstemp(dir=dst_dir, prefix='.tmp-')
+    try:
+        method = 'copy'
+        with os.fdopen(fd, 'wb') as dst_fp, open(src, 'rb') as src_fp:
+            if fcntl is not None:
+                try:
+                    fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+                    method = 'reflink'
+                except (IOError, OSError):
+                    pass
+        if method == 'copy':
+            try:
+                os.unlink(temp_path)
+                os.link(src, temp_path)
+                method = 'hardlink'
+            except OSError:
+                shutil.copyfile(src, temp_path)
+        os.replace(temp_path, dst)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return method
+
+
+def _file_digest(path, algorithm='sha256'):
+    """Get hex digest of file contents."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fp:
+        for chunk in iter_chunks(fp):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _format_duration(seconds):
+    """Format seconds as `H:MM:SS`, `?` if unknown."""
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+def _format_size(size):
+    """Format size in bytes with binary unit, `?` if unknown."""
+    if size is None:
+        return '?'
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return '%.1f%s' % (size, unit) if unit != 'B' else '%dB' % size
+        size /= 1024.0
+    return '%.1fT' % size
+
+
+def _parse_date(value):
+    """
+    Parse date or date and time, date only means the end of day.
+    Return `None` for empty value.
+    """
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M',
+                '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return (datetime.datetime.strptime(value, '%Y-%m-%d') +
+            datetime.timedelta(days=1, microseconds=-1))
+
+
+def _parse_utc(value):
+    """Parse UTC time in ISO format to local naive datetime."""
+    value = value.rstrip('Z').split('.')[0]
+    dt = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    return dt.replace(tzinfo=datetime.timezone.utc).astimezone().replace(
+        tzinfo=None)
+
+
+def _content_md5(data):
+    """Get base64 encoded MD5 of data for `Content-MD5` header."""
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+def _load_json(path, default=None):
+    """Load JSON from file or return default if file not exists."""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return default
+
+
+def _save_json(path, data):
+    """Save data to JSON file atomically."""
+    _smakedirs(os.path.dirname(path))
+    temp_path = '%s.%s.tmp' % (path, threading.get_ident())
+    with open(temp_path, 'w') as fp:
+        json.dump(data, fp)
+    os.replace(temp_path, path)
+
+
+def _dir_size(path):
+    """Get total size of files in directory or size of file."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+
+def _safe_join(base_dir, rel_path):
+    """Join relative path to base dir, path can't be outside of it."""
+    path = os.path.normpath(os.path.join(base_dir, rel_path))
+    if os.path.commonpath([base_dir, path]) != os.path.normpath(base_dir):
+        raise ValueError("Path `%s` is outside of `%s`" % (rel_path, base_dir))
+    return path
+
+
+def _import_object(path):
+    """Import object by 'module:name' or 'module.name' path."""
+    if ':' in path:
+        module_name, name = path.split(':', 1)
+    else:
+        module_name, name = path.rsplit('.', 1)
+    obj = importlib.import_module(module_name)
+    for attr in name.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def _prometheus_escape(value):
+    """Escape Prometheus label value."""
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
 
 
 def _stdout_logging(level):
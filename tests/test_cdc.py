@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import random
+
+import pytest
+
+import coverme
+
+numpy = pytest.importorskip('numpy')
+
+
+def chunks(data, avg_size, **kwargs):
+    return list(coverme.iter_cdc_chunks(io.BytesIO(data), avg_size,
+                                        **kwargs))
+
+
+def random_data(size, seed=1):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'big')
+
+
+@pytest.mark.parametrize('size, avg_size', [
+    (0, 4096), (100, 4096), (1024, 4096), (300000, 4096),
+    (1000000, 16384), (300000, 256 * 1024),
+])
+def test_numpy_and_python_chunks_equal(monkeypatch, size, avg_size):
+    data = random_data(size)
+    expected = chunks(data, avg_size)
+    monkeypatch.setattr(coverme, 'numpy', None)
+    assert chunks(data, avg_size) == expected
+    assert b''.join(expected) == data
+
+
+def test_numpy_and_python_chunks_equal_on_repeated_data(monkeypatch):
+    # No boundary is found in data of the same bytes, chunks are max size
+    data = b'\0' * 100000 + random_data(50000) + b'x' * 70000
+    expected = chunks(data, 4096)
+    monkeypatch.setattr(coverme, 'numpy', None)
+    assert chunks(data, 4096) == expected
+
+
+def test_chunk_sizes_bounds():
+    result = chunks(random_data(500000), 4096)
+    assert all(1024 <= len(chunk) <= 16384 for chunk in result[:-1])
+    assert len(result[-1]) <= 16384
+    sizes = chunks(random_data(500000), 4096, min_size=2048,
+                   max_size=8192)
+    assert all(2048 <= len(chunk) <= 8192 for chunk in sizes[:-1])
+
+
+def test_chunks_dont_depend_on_offset():
+    data = random_data(300000)
+    shifted = chunks(os.urandom(5000) + data, 4096)
+    # After first boundaries in data chunks are the same
+    assert len(set(chunks(data, 4096)[3:]) - set(shifted)) == 0
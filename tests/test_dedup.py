@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import pytest
+
+import coverme
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+BUCKET = 'dedup'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'test'),
+                        ('AWS_SECRET_ACCESS_KEY', 'test'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def make_backup(tmp_path, host):
+    """Backup with its own statedir, as it runs on another host."""
+    src = tmp_path / 'src'
+    src.mkdir(exist_ok=True)
+    settings = {
+        'defaults': {
+            'statedir': str(tmp_path / host / 'state'),
+            'tmpdir': str(tmp_path / host / 'tmp'),
+        },
+        'backups': [{
+            'type': 'dir', 'path': str(src), 'id': 'src', 'format': 'tar',
+            'name': 'src-{yyyy}{mm}{dd}{HH}{MM}{SS}{UU}',
+        }],
+        'vaults': {
+            # Negative grace collects even just uploaded chunks
+            'dd': {'service': 's3', 'name': BUCKET, 'mode': 'dedup',
+                   'chunk_size': '16K', 'chunks_grace': -1},
+        },
+    }
+    return coverme.Backup(settings, {}), src
+
+
+def missing_chunks(client):
+    """Get chunks referenced by indexes in bucket which don't exist."""
+    keys = set(obj['Key'] for obj in
+               client.list_objects_v2(Bucket=BUCKET).get('Contents', []))
+    missing = []
+    for key in keys:
+        if key.endswith('.cdc.json'):
+            index = json.loads(client.get_object(
+                Bucket=BUCKET, Key=key)['Body'].read())
+            missing += [digest for digest, _ in index['chunks']
+                        if '%s%s/%s' % (index['prefix'], digest[:2], digest)
+                        not in keys]
+    return missing
+
+
+def index_keys(client):
+    return [obj['Key'] for obj in
+            client.list_objects_v2(Bucket=BUCKET).get('Contents', [])
+            if obj['Key'].endswith('.cdc.json')]
+
+
+def test_cache_dropped_after_collection_by_other_host(s3, tmp_path):
+    host_a, src = make_backup(tmp_path, 'a')
+    host_b, _ = make_backup(tmp_path, 'b')
+    (src / 'data.bin').write_bytes(os.urandom(100000))
+
+    host_a.run()
+    vault_b = host_b.vaults['dd']
+    vault_b.delete_archives([{'key': key} for key in index_keys(s3)])
+    assert not s3.list_objects_v2(Bucket=BUCKET,
+                                  Prefix='chunks/').get('Contents')
+
+    # Host A still has all chunks in its cache, but they're collected
+    host_a.run()
+    assert len(index_keys(s3)) == 1
+    assert missing_chunks(s3) == []
+
+
+def test_upload_fails_if_collected_meanwhile(s3, tmp_path):
+    host_a, src = make_backup(tmp_path, 'a')
+    host_b, _ = make_backup(tmp_path, 'b')
+    (src / 'data.bin').write_bytes(os.urandom(100000))
+    host_a.run()
+    first = index_keys(s3)
+
+    vault_a = host_a.vaults['dd']
+    load_chunks = vault_a._load_chunks
+
+    def load_and_collect(marker=None):
+        # Other host prunes first backup while this one is uploading
+        known = load_chunks(marker)
+        host_b.vaults['dd'].delete_archives([{'key': key}
+                                             for key in first])
+        return known
+
+    vault_a._load_chunks = load_and_collect
+    host_a.run()
+    assert index_keys(s3) == []
+    assert missing_chunks(s3) == []
+
+    # Upload is retried with chunks listed again
+    vault_a._load_chunks = load_chunks
+    host_a.run()
+    assert len(index_keys(s3)) == 1
+    assert missing_chunks(s3) == []
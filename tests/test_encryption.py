@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import base64
+import os
+
+import pytest
+
+import coverme
+
+pytest.importorskip('cryptography')
+
+KEY = os.urandom(32)
+
+
+def encrypt(data, key=KEY, chunk_size=16):
+    return b''.join(coverme.iter_encrypt([data], key, chunk_size))
+
+
+def decrypt(data, key=KEY):
+    return b''.join(coverme.iter_decrypt([data], key))
+
+
+@pytest.mark.parametrize('size', [0, 1, 15, 16, 17, 100])
+def test_round_trip(size):
+    data = os.urandom(size)
+    encrypted = encrypt(data)
+    assert len(encrypted) == coverme.encrypted_size(size, 16)
+    assert decrypt(encrypted) == data
+
+
+def test_round_trip_by_small_chunks():
+    data = os.urandom(100)
+    encrypted = encrypt(data)
+    chunks = [encrypted[i:i + 7] for i in range(0, len(encrypted), 7)]
+    assert b''.join(coverme.iter_decrypt(chunks, KEY)) == data
+
+
+def test_tampered_chunk():
+    encrypted = bytearray(encrypt(os.urandom(100)))
+    encrypted[coverme.ENCRYPTION_HEADER.size + 20] ^= 1
+    with pytest.raises(ValueError, match='corrupted'):
+        decrypt(bytes(encrypted))
+
+
+@pytest.mark.parametrize('size', [0, 1, 31, 32])
+def test_truncated_stream(size):
+    # Stream cut at chunk border must fail too, the last chunk is marked
+    encrypted = encrypt(os.urandom(100))
+    frame = 16 + 16
+    cut = coverme.ENCRYPTION_HEADER.size + size
+    if size == 32:
+        cut = coverme.ENCRYPTION_HEADER.size + frame * 2
+    with pytest.raises(ValueError):
+        decrypt(encrypted[:cut])
+
+
+def test_wrong_key():
+    encrypted = encrypt(b'data')
+    with pytest.raises(ValueError, match='other key'):
+        decrypt(encrypted, os.urandom(32))
+
+
+def test_parse_key():
+    assert coverme.parse_key(base64.b64encode(KEY).decode()) == KEY
+    with pytest.raises(ValueError):
+        coverme.parse_key('not a key')
+
+
+def make_backup(tmp_path, **source):
+    src = tmp_path / 'src'
+    src.mkdir(exist_ok=True)
+    settings = {
+        'defaults': {
+            'statedir': str(tmp_path / 'state'),
+            'tmpdir': str(tmp_path / 'tmp'),
+            'localdir': str(tmp_path / 'local'),
+            'encryption_key': base64.b64encode(KEY).decode(),
+        },
+        'backups': [dict({
+            'type': 'dir', 'path': str(src), 'id': 'src', 'format': 'gztar',
+            'name': 'src-{yyyy}{mm}{dd}{HH}{MM}{SS}{UU}',
+        }, **source)],
+        'vaults': {},
+    }
+    return coverme.Backup(settings, {}), src
+
+
+def local_files(tmp_path):
+    local = tmp_path / 'local'
+    return sorted(str(path.relative_to(local))
+                  for path in local.rglob('*') if path.is_file())
+
+
+def test_incremental_manifests_encrypted(tmp_path):
+    # Chain is kept by base read from encrypted manifest
+    backup, src = make_backup(tmp_path, incremental=True, keep={'last': 1})
+    (src / 'a.txt').write_text('first')
+    backup.run()
+    (src / 'b.txt').write_text('second')
+    backup.run()
+
+    names = local_files(tmp_path)
+    manifests = [name for name in names if name.endswith('.manifest.json')]
+    assert len(names) == 4 and len(manifests) == 2
+    for name in names:
+        data = (tmp_path / 'local' / name).read_bytes()
+        assert data.startswith(coverme.ENCRYPTION_MAGIC)
+
+    source = backup.sources[0]
+    to_dir = tmp_path / 'out'
+    chain = backup.restore(source, vault_key=coverme.LOCAL_VAULT_KEY,
+                           to_dir=str(to_dir))
+    assert len(chain) == 2
+    assert (to_dir / 'src' / 'a.txt').read_text() == 'first'
+    assert (to_dir / 'src' / 'b.txt').read_text() == 'second'
+
+
+def test_sharded_manifest_encrypted(tmp_path):
+    backup, src = make_backup(tmp_path, shards=2)
+    for i in range(4):
+        (src / ('f%d.txt' % i)).write_text('data %d' % i)
+    backup.run()
+
+    names = local_files(tmp_path)
+    assert len(names) == 3
+    assert any(name.endswith('.shards.json') for name in names)
+    for name in names:
+        data = (tmp_path / 'local' / name).read_bytes()
+        assert data.startswith(coverme.ENCRYPTION_MAGIC)
+
+    to_dir = tmp_path / 'out'
+    backup.restore(backup.sources[0], vault_key=coverme.LOCAL_VAULT_KEY,
+                   to_dir=str(to_dir))
+    assert sorted(os.listdir(str(to_dir / 'src'))) == [
+        'f0.txt', 'f1.txt', 'f2.txt', 'f3.txt']
+
+
+def test_restore_without_key(tmp_path):
+    backup, src = make_backup(tmp_path)
+    (src / 'a.txt').write_text('data')
+    backup.run()
+    source = backup.sources[0]
+    del backup.defaults['encryption_key']
+    with pytest.raises(ValueError, match='encryption_key'):
+        backup.restore(source, vault_key=coverme.LOCAL_VAULT_KEY,
+                       to_dir=str(tmp_path / 'out'))
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import threading
+import time
+
+import pytest
+
+import coverme
+
+DATA = os.urandom(coverme.CHUNK_SIZE * 20 + 123)
+
+
+class Consumer(object):
+    """Read reader in thread, as vault upload does."""
+
+    def __init__(self, reader, delay=0, fail_after=None):
+        self.reader = reader
+        self.delay = delay
+        self.fail_after = fail_after
+        self.data = []
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                if (self.fail_after is not None and
+                        len(self.data) >= self.fail_after):
+                    raise RuntimeError("upload failed")
+                chunk = self.reader.read(coverme.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.data.append(chunk)
+                time.sleep(self.delay)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.reader.detach()
+
+    def join(self):
+        self.thread.join(10)
+        assert not self.thread.is_alive()
+        return b''.join(self.data)
+
+
+def run_fanout(fanout):
+    thread = threading.Thread(target=fanout.run)
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+
+
+def test_all_readers_get_stream():
+    fanout = coverme.FanOut(io.BytesIO(DATA), 3, queue_size=2)
+    consumers = [Consumer(reader) for reader in fanout.readers]
+    run_fanout(fanout)
+    for consumer in consumers:
+        assert consumer.join() == DATA and consumer.error is None
+        assert consumer.reader.bytes_read == len(DATA)
+
+
+def test_slow_reader():
+    # Producer waits for slow reader, fast ones get all data anyway
+    fanout = coverme.FanOut(io.BytesIO(DATA), 3, queue_size=2)
+    consumers = [Consumer(fanout.readers[0], delay=0.01)]
+    consumers += [Consumer(reader) for reader in fanout.readers[1:]]
+    run_fanout(fanout)
+    for consumer in consumers:
+        assert consumer.join() == DATA and consumer.error is None
+
+
+def test_failed_reader_does_not_block_others():
+    fanout = coverme.FanOut(io.BytesIO(DATA), 3, queue_size=2)
+    failed = Consumer(fanout.readers[0], fail_after=2)
+    consumers = [Consumer(fanout.readers[1], delay=0.005),
+                 Consumer(fanout.readers[2])]
+    run_fanout(fanout)
+    failed.join()
+    assert isinstance(failed.error, RuntimeError)
+    for consumer in consumers:
+        assert consumer.join() == DATA and consumer.error is None
+
+
+def test_all_readers_failed_stops_reading():
+    stream = io.BytesIO(DATA)
+    fanout = coverme.FanOut(stream, 2, queue_size=2)
+    consumers = [Consumer(reader, fail_after=1) for reader in fanout.readers]
+    run_fanout(fanout)
+    for consumer in consumers:
+        consumer.join()
+        assert isinstance(consumer.error, RuntimeError)
+    assert stream.tell() < len(DATA)
+
+
+class FailingStream(object):
+    def __init__(self, size):
+        self.fp = io.BytesIO(DATA[:size])
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        if not data:
+            raise IOError("dump failed")
+        return data
+
+
+@pytest.mark.parametrize('delay', [0, 0.01])
+def test_failed_stream_raised_in_readers(delay):
+    fanout = coverme.FanOut(FailingStream(coverme.CHUNK_SIZE * 5), 2,
+                            queue_size=2)
+    consumers = [Consumer(fanout.readers[0], delay=delay),
+                 Consumer(fanout.readers[1])]
+    run_fanout(fanout)
+    for consumer in consumers:
+        assert consumer.join() == DATA[:coverme.CHUNK_SIZE * 5]
+        assert isinstance(consumer.error, IOError)
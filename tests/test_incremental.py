@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+
+import coverme
+
+
+def make_backup(tmp_path, **source):
+    src = tmp_path / 'src'
+    src.mkdir(exist_ok=True)
+    settings = {
+        'defaults': {
+            'statedir': str(tmp_path / 'state'),
+            'tmpdir': str(tmp_path / 'tmp'),
+            'localdir': str(tmp_path / 'local'),
+        },
+        'backups': [dict({
+            'type': 'dir', 'path': str(src), 'id': 'src', 'format': 'tar',
+            'name': 'src-{yyyy}{mm}{dd}{HH}{MM}{SS}{UU}', 'incremental': True,
+        }, **source)],
+        'vaults': {},
+    }
+    return coverme.Backup(settings, {}), src
+
+
+def read_tree(path):
+    result = {}
+    for dir_path, _, file_names in os.walk(str(path)):
+        for name in file_names:
+            full = os.path.join(dir_path, name)
+            with open(full) as fp:
+                result[os.path.relpath(full, str(path))] = fp.read()
+    return result
+
+
+def restore(backup, to_dir):
+    return backup.restore(backup.sources[0],
+                          vault_key=coverme.LOCAL_VAULT_KEY,
+                          to_dir=str(to_dir))
+
+
+def test_restore_chain(tmp_path):
+    backup, src = make_backup(tmp_path)
+    (src / 'a.txt').write_text('a1')
+    (src / 'sub').mkdir()
+    (src / 'sub' / 'b.txt').write_text('b1')
+    backup.run()
+
+    (src / 'a.txt').write_text('a2 changed')
+    (src / 'c.txt').write_text('c1')
+    backup.run()
+
+    (src / 'sub' / 'b.txt').unlink()
+    (src / 'd.txt').write_text('d1')
+    backup.run()
+
+    chain = restore(backup, tmp_path / 'out')
+    assert len(chain) == 3
+    assert read_tree(tmp_path / 'out' / 'src') == {
+        'a.txt': 'a2 changed', 'c.txt': 'c1', 'd.txt': 'd1'}
+
+
+def test_full_archive_starts_new_chain(tmp_path):
+    backup, src = make_backup(tmp_path, full_every=0)
+    (src / 'a.txt').write_text('a1')
+    backup.run()
+    (src / 'a.txt').unlink()
+    (src / 'b.txt').write_text('b1')
+    backup.run()
+
+    # Every archive is full, only the latest one is extracted
+    chain = restore(backup, tmp_path / 'out')
+    assert len(chain) == 1
+    assert read_tree(tmp_path / 'out' / 'src') == {'b.txt': 'b1'}
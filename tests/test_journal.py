@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import pytest
+
+import coverme
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+BUCKET = 'journal'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'test'),
+                        ('AWS_SECRET_ACCESS_KEY', 'test'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def make_backup(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'data.bin').write_bytes(os.urandom(12 * 1024 * 1024))
+    settings = {
+        'defaults': {
+            'statedir': str(tmp_path / 'state'),
+            'tmpdir': str(tmp_path / 'tmp'),
+            'localdir': str(tmp_path / 'local'),
+        },
+        'backups': [{
+            'type': 'dir', 'path': str(src), 'id': 'src', 'format': 'tar',
+            'name': 'src-{yyyy}{mm}{dd}{HH}{MM}{SS}{UU}',
+        }],
+        'vaults': {
+            'b1': {'service': 's3', 'name': BUCKET, 'part_size': '5M'},
+        },
+    }
+    return coverme.Backup(settings, {})
+
+
+def read_journal(tmp_path):
+    path = tmp_path / 'state' / 'journal.json'
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def test_resume_failed_upload(s3, tmp_path):
+    backup = make_backup(tmp_path)
+    source = backup.sources[0]
+    client = backup.vaults['b1'].client
+    upload_part = client.upload_part
+    sent = []
+
+    def fail_second_part(**kwargs):
+        if kwargs['PartNumber'] == 2:
+            raise RuntimeError("connection lost")
+        sent.append(kwargs['PartNumber'])
+        return upload_part(**kwargs)
+
+    client.upload_part = fail_second_part
+    backup.run()
+    assert 'Contents' not in s3.list_objects_v2(Bucket=BUCKET)
+    local = os.listdir(str(tmp_path / 'local'))
+    assert len(local) == 1
+
+    # Archive is kept in temp dir, upload to local dir is recorded
+    entry = read_journal(tmp_path)[source.get_key()]
+    name = entry['name']
+    assert local == [name]
+    assert list(entry['uploads'][name]) == [coverme.LOCAL_VAULT_KEY]
+    (path, _, size, digest), = entry['files']
+    assert os.path.getsize(path) == size and digest
+
+    # Only vault missing archive gets it, by parts not stored yet
+    sent[:] = []
+    client.upload_part = lambda **kwargs: (
+        sent.append(kwargs['PartNumber']) or upload_part(**kwargs))
+    backup.run(resume=True)
+    assert sorted(sent) == [2, 3]
+    body = s3.get_object(Bucket=BUCKET, Key=name)['Body'].read()
+    assert body == (tmp_path / 'local' / name).read_bytes()
+    assert os.listdir(str(tmp_path / 'local')) == [name]
+    assert read_journal(tmp_path) == {}
+    assert not os.path.exists(entry['temp_dir'])
+
+
+def test_changed_archive_not_resumed(s3, tmp_path):
+    backup = make_backup(tmp_path)
+    source = backup.sources[0]
+    client = backup.vaults['b1'].client
+    upload_part = client.upload_part
+
+    def fail(**kwargs):
+        raise RuntimeError("connection lost")
+
+    client.upload_part = fail
+    backup.run()
+    entry = read_journal(tmp_path)[source.get_key()]
+    (path, _, _, _), = entry['files']
+    with open(path, 'r+b') as fp:
+        fp.write(b'changed')
+
+    # Source runs again instead, kept temp dir is removed
+    client.upload_part = upload_part
+    backup.run(resume=True)
+    assert read_journal(tmp_path) == {}
+    assert not os.path.exists(entry['temp_dir'])
+    assert len(os.listdir(str(tmp_path / 'local'))) == 2
+    keys = [obj['Key'] for obj in s3.list_objects_v2(
+        Bucket=BUCKET)['Contents']]
+    assert len(keys) == 1 and keys[0] != entry['name']
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import os
+import stat
+import sys
+import tarfile
+
+import pytest
+
+import coverme
+
+# Fake `mysql` answers sizes query, and in session mode the lock and
+# dump transactions queries, transactions are files by `mysqldump` pid
+MYSQL = r'''#!%(python)s
+import os, re, sys
+state = %(state)r
+args = sys.argv[1:]
+if '--execute' in args:
+    query = args[args.index('--execute') + 1]
+    if 'table_name' in query:
+        for number, size in enumerate([500, 400, 300, 200, 100]):
+            print('t%%d\t%%d' %% (number, size))
+    sys.exit(0)
+log = open(os.path.join(state, 'log'), 'a')
+for line in sys.stdin:
+    if 'FLUSH TABLES' in line:
+        log.write('lock\n')
+    elif "'locked'" in line:
+        print('locked', flush=True)
+    elif 'innodb_trx' in line:
+        pids = re.search(r"IN \(([^)]*)\)", line).group(1)
+        pids = [pid.strip(" '") for pid in pids.split(',')]
+        started = [pid for pid in pids if os.path.exists(
+            os.path.join(state, 'trx-%%s' %% pid))]
+        # Transaction of other session is not counted
+        print(len(started), flush=True)
+    log.flush()
+log.write('unlock\n')
+'''
+
+MYSQLDUMP = r'''#!%(python)s
+import os, sys, time
+state = %(state)r
+time.sleep(0.2)
+if '--single-transaction' in sys.argv:
+    open(os.path.join(state, 'trx-%%s' %% os.getpid()), 'w').close()
+    with open(os.path.join(state, 'log'), 'a') as log:
+        log.write('trx\n')
+time.sleep(0.2)
+print('-- dump %%s' %% ' '.join(sys.argv[1:]))
+'''
+
+
+@pytest.fixture
+def fakebin(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    state = tmp_path / 'fake'
+    bindir.mkdir()
+    state.mkdir()
+    for name, script in [('mysql', MYSQL), ('mysqldump', MYSQLDUMP)]:
+        path = bindir / name
+        path.write_text(script % {'python': sys.executable,
+                                  'state': str(state)})
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', '%s:%s' % (bindir, os.environ['PATH']))
+    return state
+
+
+def make_backup(tmp_path, defaults=None, **source):
+    settings = {
+        'defaults': dict({
+            'statedir': str(tmp_path / 'state'),
+            'tmpdir': str(tmp_path / 'tmp'),
+        }, **(defaults or {})),
+        'backups': [dict({
+            'type': 'database', 'url': 'mysql://root@127.0.0.1/test',
+            'name': 'mysql', 'jobs': 2,
+        }, **source)],
+        'vaults': {},
+    }
+    return coverme.Backup(settings, dict(os.environ))
+
+
+def dump_files(backup, tmp_path):
+    source = backup.sources[0]
+    stream = source.open_stream(str(tmp_path))
+    try:
+        data = stream.read()
+    finally:
+        stream.close()
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        for member in tar.getmembers():
+            files[os.path.basename(member.name)] = tar.extractfile(
+                member).read()
+    return files
+
+
+def test_snapshot_dumps_start_within_lock(fakebin, tmp_path):
+    # Table limit is less than jobs, snapshot is split by free slots
+    backup = make_backup(tmp_path, {'max_parallel': 1})
+    files = dump_files(backup, tmp_path)
+    assert sorted(files) == ['_data-001.sql.gz', '_schema.sql.gz',
+                             '_triggers.sql.gz']
+    data = gzip.decompress(files['_data-001.sql.gz']).decode()
+    assert all(' t%d' % number in data for number in range(5))
+    log = (fakebin / 'log').read_text().split()
+    assert log[:3] == ['lock', 'trx', 'unlock']
+
+
+def test_snapshot_dumps_by_jobs(fakebin, tmp_path):
+    backup = make_backup(tmp_path)
+    files = dump_files(backup, tmp_path)
+    assert sorted(files) == ['_data-001.sql.gz', '_data-002.sql.gz',
+                             '_schema.sql.gz', '_triggers.sql.gz']
+    log = (fakebin / 'log').read_text().split()
+    assert log[:4] == ['lock', 'trx', 'trx', 'unlock']
+
+
+def test_slots_released(fakebin, tmp_path):
+    backup = make_backup(tmp_path, {'max_parallel': 2})
+    dump_files(backup, tmp_path)
+    releases = backup.limits.reserve('table', 2)
+    for release in releases:
+        release()
+
+
+def test_table_format_from_defaults(tmp_path):
+    backup = make_backup(tmp_path, {'format': 'xz'})
+    assert backup.sources[0].get_table_format() == 'xz'
+    backup = make_backup(tmp_path, {'format': 'xz'}, format='zst')
+    assert backup.sources[0].get_table_format() == 'zst'
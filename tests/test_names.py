@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import pytest
+
+import coverme
+
+
+def make_source(name, **settings):
+    backup = coverme.Backup({
+        'backups': [dict({'type': 'dir', 'path': '/tmp', 'name': name},
+                         **settings)],
+        'vaults': {},
+    }, {'HOST': 'db1'})
+    return backup.sources[0]
+
+
+@pytest.mark.parametrize('key, name', [
+    ('media/2016-10-20.tar.gz', 'media/2016-10-20.tar.gz'),
+    ('media/2016-10-20.zip', 'media/2016-10-20.zip'),
+    # Raw format has no extension
+    ('media/2016-10-20', 'media/2016-10-20'),
+    ('media/2016-10-20.tar.zst.enc', 'media/2016-10-20.tar.zst.enc'),
+    ('media/2016-10-20.tar.zst.shard-001', 'media/2016-10-20.tar.zst'),
+    ('media/2016-10-20.tar.zst.enc.shards.json',
+     'media/2016-10-20.tar.zst.enc'),
+    ('media/2016-10-20.tar.gz.manifest.json', 'media/2016-10-20.tar.gz'),
+    ('media/2016-10-20.tar.gz.cdc.json', 'media/2016-10-20.tar.gz'),
+    ('media/2016-10-20.tar.gz.manifest.json.cdc.json',
+     'media/2016-10-20.tar.gz'),
+])
+def test_name_pattern_matches(key, name):
+    pattern, prefix = make_source('media/{yyyy}-{mm}-{dd}').get_name_pattern()
+    assert prefix == 'media/'
+    assert pattern.match(key).group('name') == name
+
+
+@pytest.mark.parametrize('key', [
+    'media/2016-10-20.tar.gz.tmp',
+    'media/16-10-20.tar.gz',
+    'other/2016-10-20.tar.gz',
+    'media/2016-10-20.tar.gz.shard-x',
+    'chunks.gc.json',
+])
+def test_name_pattern_does_not_match(key):
+    pattern, _ = make_source('media/{yyyy}-{mm}-{dd}').get_name_pattern()
+    assert pattern.match(key) is None
+
+
+def test_name_pattern_repeated_and_env():
+    source = make_source('{env[HOST]}/{yyyy}/{yyyy}-{mm}-{dd}-{HH}{MM}')
+    pattern, prefix = source.get_name_pattern()
+    assert prefix == 'db1/'
+    match = pattern.match('db1/2016/2016-10-20-0530.tar.gz')
+    assert source.get_backup_time(match, None) == \
+        datetime.datetime(2016, 10, 20, 5, 30)
+    # Repeated field must be the same
+    assert pattern.match('db1/2015/2016-10-20-0530.tar.gz') is None
+
+
+def test_backup_time_without_date():
+    source = make_source('media/latest')
+    pattern, prefix = source.get_name_pattern()
+    assert prefix == 'media/latest'
+    modified = datetime.datetime(2016, 10, 20, 5, 30)
+    match = pattern.match('media/latest.zip')
+    assert source.get_backup_time(match, modified) == modified
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import pytest
+import yaml
+
+import coverme
+
+CONFIGS = [
+    {'id': 'db', 'url': 'postgres://localhost/db', 'name': 'db-{dd}',
+     'tags': 'db, daily'},
+    {'id': 'media', 'path': '/srv/media', 'name': 'media-{dd}',
+     'tags': ['files', 'weekly']},
+    {'path': '/etc', 'name': 'etc-{dd}', 'tags': 'files,daily'},
+    {'path': '/srv/logs', 'name': 'logs-{dd}'},
+]
+
+
+def matched(source_filter):
+    return [conf['name'] for conf in CONFIGS if source_filter.match(conf)]
+
+
+@pytest.mark.parametrize('kwargs, expected', [
+    ({}, ['db-{dd}', 'media-{dd}', 'etc-{dd}', 'logs-{dd}']),
+    ({'tags': 'daily'}, ['db-{dd}', 'etc-{dd}']),
+    ({'tags': 'db,weekly'}, ['db-{dd}', 'media-{dd}']),
+    ({'exclude_tags': 'files'}, ['db-{dd}', 'logs-{dd}']),
+    ({'tags': 'daily', 'exclude_tags': 'db'}, ['etc-{dd}']),
+    ({'names': ['media']}, ['media-{dd}']),
+    ({'names': ['/etc', 'logs-{dd}']}, ['etc-{dd}', 'logs-{dd}']),
+    ({'names': ['postgres://localhost/db'], 'tags': 'daily'}, ['db-{dd}']),
+    ({'names': ['media'], 'exclude_tags': 'weekly'}, []),
+    ({'names': ['missing']}, []),
+])
+def test_source_filter(kwargs, expected):
+    source_filter = coverme.SourceFilter(**kwargs)
+    assert bool(source_filter) == bool(kwargs)
+    assert matched(source_filter) == expected
+
+
+def test_filtered_backup_creates_only_used_vaults(tmp_path):
+    settings = {
+        'defaults': {'statedir': str(tmp_path / 'state'),
+                     'tmpdir': str(tmp_path / 'tmp')},
+        'backups': [
+            {'type': 'dir', 'path': str(tmp_path), 'id': 'a', 'name': 'a',
+             'tags': 'daily', 'to': ['v1']},
+            {'type': 'dir', 'path': str(tmp_path), 'id': 'b', 'name': 'b',
+             'to': ['v2']},
+        ],
+        'vaults': {
+            'v1': {'service': 's3', 'name': 'bucket1'},
+            'v2': {'service': 's3', 'name': 'bucket2'},
+        },
+    }
+    backup = coverme.Backup(settings, {},
+                            source_filter=coverme.SourceFilter('daily'))
+    assert [source.settings['id'] for source in backup.sources] == ['a']
+    assert list(backup.vaults) == ['v1']
+
+    _, errors = coverme.Backup.create_with_config(
+        {}, stream=['---\n' + yaml.safe_dump(settings)],
+        source_filter=coverme.SourceFilter('weekly'))
+    assert 'backups' in errors
+
+
+class FakeSource(object):
+    def __init__(self, key, size):
+        self.key = key
+        self.size = size
+
+    def get_key(self):
+        return self.key
+
+    def estimate_size(self):
+        return self.size
+
+
+def keys(plan):
+    return [source.get_key() for source, _, _ in plan]
+
+
+def test_plan_longest_first(tmp_path):
+    planner = coverme.Planner(str(tmp_path / 'plan.json'), '1M')
+    mb = 1024 * 1024
+    sources = [FakeSource('small', mb), FakeSource('unknown', None),
+               FakeSource('large', 10 * mb), FakeSource('medium', 5 * mb)]
+    plan = planner.plan(sources)
+    assert keys(plan) == ['large', 'medium', 'small', 'unknown']
+    assert [seconds for _, _, seconds in plan] == [10, 5, 1, None]
+
+
+def test_plan_by_history(tmp_path):
+    planner = coverme.Planner(str(tmp_path / 'plan.json'), '1M')
+    mb = 1024 * 1024
+    slow = FakeSource('slow', 2 * mb)
+    fast = FakeSource('fast', 8 * mb)
+    unknown = FakeSource('unknown', None)
+    # Slow source runs at 100K per second, the fast one at 8M
+    planner.record(slow, 2 * mb, 20)
+    planner.record(fast, 8 * mb, 1)
+    planner.record(unknown, 3 * mb, 30)
+    plan = planner.plan([fast, unknown, slow])
+    assert keys(plan) == ['unknown', 'slow', 'fast']
+    assert [seconds for _, _, seconds in plan] == [30, 20, 1]
+
+    # History is read by new planner
+    planner = coverme.Planner(str(tmp_path / 'plan.json'))
+    assert planner.estimate(slow, 4 * mb) == 40
+
+
+def test_wall_time():
+    plan = [(None, None, seconds) for seconds in [10, 6, 5, 4, None]]
+    assert coverme.Planner.wall_time(plan, 1) == 25
+    assert coverme.Planner.wall_time(plan, 2) == 14
+    assert coverme.Planner.wall_time(plan, 0) == 25
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import base64
+import os
+
+import pytest
+
+import coverme
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+pytest.importorskip('cryptography')
+
+BUCKET = 'restore'
+KEY = base64.b64encode(os.urandom(32)).decode()
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'test'),
+                        ('AWS_SECRET_ACCESS_KEY', 'test'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def make_tree(path):
+    (path / 'sub' / 'deep').mkdir(parents=True)
+    (path / 'a.txt').write_text('first')
+    (path / 'empty').write_bytes(b'')
+    (path / 'sub' / 'b.bin').write_bytes(os.urandom(300000))
+    for i in range(4):
+        (path / 'sub' / 'deep' / ('f%d.txt' % i)).write_text('data %d' % i)
+
+
+def read_tree(path):
+    return dict((str(item.relative_to(path)), item.read_bytes())
+                for item in path.rglob('*') if item.is_file())
+
+
+SOURCES = [
+    {'id': 'plain', 'format': 'gztar'},
+    {'id': 'zip', 'format': 'zip'},
+    {'id': 'sharded', 'format': 'tar', 'shards': 2},
+    {'id': 'encrypted', 'format': 'gztar', 'encryption_key': KEY},
+    {'id': 'encrypted-sharded', 'format': 'tar', 'shards': 3,
+     'encryption_key': KEY},
+]
+
+
+@pytest.mark.parametrize('source', SOURCES, ids=[s['id'] for s in SOURCES])
+def test_round_trip(s3, tmp_path, source):
+    src = tmp_path / 'data' / 'tree'
+    make_tree(src)
+    backup = coverme.Backup({
+        'defaults': {
+            'statedir': str(tmp_path / 'state'),
+            'tmpdir': str(tmp_path / 'tmp'),
+        },
+        'backups': [dict({
+            'type': 'dir', 'path': str(src),
+            'name': '%s-{yyyy}{mm}{dd}{HH}{MM}{SS}{UU}' % source['id'],
+        }, **source)],
+        'vaults': {
+            'b1': {'service': 's3', 'name': BUCKET, 'range_size': '64K'},
+        },
+    }, {})
+    backup.run()
+    keys = [obj['Key'] for obj in
+            s3.list_objects_v2(Bucket=BUCKET).get('Contents', [])]
+    if source.get('shards'):
+        assert any(key.endswith('.shards.json') for key in keys)
+    if source.get('encryption_key'):
+        for key in keys:
+            body = s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+            assert body.startswith(coverme.ENCRYPTION_MAGIC)
+
+    to_dir = tmp_path / 'out'
+    backup.restore(backup.sources[0], vault_key='b1', to_dir=str(to_dir))
+    if source.get('shards'):
+        restored = to_dir / 'tree'
+    else:
+        # Archive keeps full path of directory, as `make_archive()` with
+        # absolute `base_dir` does
+        restored = to_dir / str(src).lstrip(os.sep)
+    assert read_tree(restored) == read_tree(src)
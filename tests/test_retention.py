@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import pytest
+
+import coverme
+
+
+def daily(days, start='2016-10-01'):
+    """Backups made at 03:00 every day from `start`."""
+    first = datetime.datetime.strptime(start, '%Y-%m-%d').replace(hour=3)
+    result = []
+    for day in range(days):
+        timestamp = first + datetime.timedelta(days=day)
+        result.append((timestamp, timestamp.strftime('%Y-%m-%d')))
+    return result
+
+
+def test_last_by_default():
+    policy = coverme.RetentionPolicy({})
+    assert policy.select(daily(10)) == {'2016-10-10'}
+    assert str(policy) == 'last 1'
+
+
+def test_last():
+    policy = coverme.RetentionPolicy({'last': 3})
+    assert policy.select(daily(10)) == {
+        '2016-10-08', '2016-10-09', '2016-10-10'}
+
+
+def test_daily_weekly_monthly():
+    policy = coverme.RetentionPolicy({'daily': 3, 'weekly': 2,
+                                      'monthly': 2})
+    assert str(policy) == 'last 1, 3 daily, 2 weekly, 2 monthly'
+    # Last backup 2016-11-14 is Monday, weeks overlap with days
+    assert policy.select(daily(45)) == {
+        '2016-11-14', '2016-11-13', '2016-11-12',
+        # monthly: latest of October
+        '2016-10-31',
+    }
+    policy = coverme.RetentionPolicy({'weekly': 3})
+    assert policy.select(daily(45)) == {
+        '2016-11-14', '2016-11-13', '2016-11-06'}
+
+
+def test_periods_with_gaps():
+    # Periods without backups are not counted
+    backups = daily(1, '2016-01-15') + daily(1, '2016-05-15') + \
+        daily(1, '2016-10-15')
+    policy = coverme.RetentionPolicy({'monthly': 2})
+    assert policy.select(backups) == {'2016-10-15', '2016-05-15'}
+
+
+def test_hourly_and_yearly():
+    first = datetime.datetime(2015, 12, 31, 22)
+    backups = [(first + datetime.timedelta(minutes=30 * i), str(i))
+               for i in range(6)]
+    policy = coverme.RetentionPolicy({'hourly': 2, 'yearly': 2})
+    # 22:00 22:30 23:00 23:30 | 00:00 00:30 of the next year
+    assert policy.select(backups) == {'5', '3'}
+
+
+def test_unknown_period():
+    with pytest.raises(ValueError, match='fortnightly'):
+        coverme.RetentionPolicy({'fortnightly': 2})
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+
+import pytest
+
+import coverme
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+BUCKET = 'uploads'
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'test'),
+                        ('AWS_SECRET_ACCESS_KEY', 'test'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def make_vault(tmp_path, **settings):
+    backup = coverme.Backup({
+        'defaults': {
+            'statedir': str(tmp_path / 'state'),
+            'tmpdir': str(tmp_path / 'tmp'),
+        },
+        'backups': [],
+        'vaults': {
+            'b1': dict({'service': 's3', 'name': BUCKET,
+                        'part_size': '5M'}, **settings),
+        },
+    }, {})
+    return backup.vaults['b1']
+
+
+class FailingStream(object):
+    """Stream which fails after `size` bytes, as failed dump does."""
+
+    def __init__(self, data, size):
+        self.fp = io.BytesIO(data)
+        self.size = size
+
+    def read(self, size=-1):
+        if self.fp.tell() >= self.size:
+            raise RuntimeError("dump failed")
+        return self.fp.read(min(size, self.size - self.fp.tell()))
+
+
+def uploads(client):
+    return client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', [])
+
+
+def state_files(tmp_path):
+    state_dir = tmp_path / 'state' / 'uploads'
+    return os.listdir(str(state_dir)) if state_dir.exists() else []
+
+
+def test_stream_upload_by_parts(s3, tmp_path):
+    vault = make_vault(tmp_path)
+    data = os.urandom(12 * MB)
+    success, result = vault.upload_stream(io.BytesIO(data), 'dump.tar')
+    assert success and result == {'key': 'dump.tar', 'parts': 3}
+    body = s3.get_object(Bucket=BUCKET, Key='dump.tar')['Body'].read()
+    assert body == data
+    assert uploads(s3) == [] and state_files(tmp_path) == []
+
+
+def test_small_stream_upload(s3, tmp_path):
+    vault = make_vault(tmp_path)
+    success, result = vault.upload_stream(io.BytesIO(b'data'), 'small')
+    assert success and result == {'key': 'small'}
+    body = s3.get_object(Bucket=BUCKET, Key='small')['Body'].read()
+    assert body == b'data'
+
+
+def test_failed_stream_aborts_upload(s3, tmp_path):
+    vault = make_vault(tmp_path)
+    stream = FailingStream(os.urandom(12 * MB), 7 * MB)
+    with pytest.raises(RuntimeError, match='dump failed'):
+        vault.upload_stream(stream, 'dump.tar')
+    assert uploads(s3) == [] and state_files(tmp_path) == []
+
+
+def test_failed_file_upload_resumed(s3, tmp_path):
+    vault = make_vault(tmp_path)
+    path = tmp_path / 'archive.tar'
+    data = os.urandom(12 * MB)
+    path.write_bytes(data)
+    upload_part = vault.client.upload_part
+    sent = []
+
+    def fail_last_part(**kwargs):
+        if kwargs['PartNumber'] == 3:
+            raise RuntimeError("connection lost")
+        sent.append(kwargs['PartNumber'])
+        return upload_part(**kwargs)
+
+    vault.client.upload_part = fail_last_part
+    with pytest.raises(RuntimeError, match='connection lost'):
+        vault.upload(str(path))
+    assert len(uploads(s3)) == 1 and len(state_files(tmp_path)) == 1
+
+    # Only missing part is sent again
+    sent[:] = []
+    vault.client.upload_part = lambda **kwargs: (
+        sent.append(kwargs['PartNumber']) or upload_part(**kwargs))
+    success, result = vault.upload(str(path))
+    assert success and result['parts'] == 3 and sent == [3]
+    body = s3.get_object(Bucket=BUCKET, Key='archive.tar')['Body'].read()
+    assert body == data
+    assert uploads(s3) == [] and state_files(tmp_path) == []
+
+
+def test_failed_stream_upload_not_kept(s3, tmp_path):
+    vault = make_vault(tmp_path)
+    upload_part = vault.client.upload_part
+
+    def fail_part(**kwargs):
+        if kwargs['PartNumber'] == 2:
+            raise RuntimeError("connection lost")
+        return upload_part(**kwargs)
+
+    vault.client.upload_part = fail_part
+    with pytest.raises(RuntimeError, match='connection lost'):
+        vault.upload_stream(io.BytesIO(os.urandom(12 * MB)), 'dump.tar')
+    assert uploads(s3) == [] and state_files(tmp_path) == []
+
+
+def test_small_part_size_rejected(s3, tmp_path):
+    vault = make_vault(tmp_path, part_size='1M')
+    with pytest.raises(ValueError, match='at least 5M'):
+        vault.upload_stream(io.BytesIO(b'data'), 'small')
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import threading
+from concurrent.futures import Future
+
+import pytest
+import yaml
+
+import coverme
+
+
+def dt(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M')
+
+
+@pytest.mark.parametrize('expr, after, expected', [
+    ('*/15 * * * *', '2016-10-20 05:07', '2016-10-20 05:15'),
+    ('*/15 * * * *', '2016-10-20 05:45', '2016-10-20 06:00'),
+    ('30 2-4 * * *', '2016-10-20 04:30', '2016-10-21 02:30'),
+    ('@daily', '2016-12-31 23:59', '2017-01-01 00:00'),
+    ('@hourly', '2016-10-20 05:00', '2016-10-20 06:00'),
+    ('@monthly', '2016-10-20 05:00', '2016-11-01 00:00'),
+    # 2016-10-20 is Thursday, Sunday is both 0 and 7
+    ('0 3 * * 0', '2016-10-20 05:00', '2016-10-23 03:00'),
+    ('0 3 * * 7', '2016-10-20 05:00', '2016-10-23 03:00'),
+    ('0 0 * * 1,3', '2016-10-20 05:00', '2016-10-24 00:00'),
+    # Day of month or day of week matches, as in cron
+    ('0 0 25 * 6', '2016-10-20 05:00', '2016-10-22 00:00'),
+    ('0 0 29 2 *', '2017-01-01 00:00', '2020-02-29 00:00'),
+])
+def test_cron_next_after(expr, after, expected):
+    assert coverme.CronSchedule(expr).next_after(dt(after)) == dt(expected)
+
+
+@pytest.mark.parametrize('expr', [
+    '* * * *', '60 * * * *', '* 24 * * *', '5-1 * * * *', '*/0 * * * *',
+    '0 0 31 2 *',
+])
+def test_cron_invalid(expr):
+    with pytest.raises(ValueError):
+        coverme.CronSchedule(expr).next_after(dt('2016-10-20 05:00'))
+
+
+def test_interval_next_after():
+    schedule = coverme.IntervalSchedule('6h')
+    assert schedule.next_after(dt('2016-10-20 05:00')) == \
+        dt('2016-10-20 11:00')
+    with pytest.raises(ValueError):
+        coverme.IntervalSchedule('0s')
+
+
+class InlineExecutor(object):
+    """Executor running jobs in `submit()`, before it returns."""
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def test_daemon_job_finished_before_submit_returns(tmp_path):
+    config = tmp_path / 'backup.yml'
+    config.write_text(yaml.safe_dump({
+        'defaults': {'statedir': str(tmp_path / 'state'),
+                     'tmpdir': str(tmp_path / 'tmp')},
+        'backups': [{'type': 'dir', 'path': str(tmp_path), 'name': 'dir',
+                     'every': '1h'}],
+        'vaults': {'s3': {'service': 's3', 'name': 'bucket'}},
+    }))
+    daemon = coverme.Daemon({}, str(config))
+    assert daemon.reload()
+    daemon._pool = InlineExecutor()
+    runs = []
+    daemon.backup._run_source = lambda source, size=None: runs.append(source)
+
+    now = datetime.datetime.now()
+    daemon.tick(now)
+    assert len(runs) == 1
+    assert daemon.running == {}
+
+    # Slot is released, so the next due run is started
+    daemon.tick(now + datetime.timedelta(hours=2))
+    assert len(runs) == 2
+    assert daemon.running == {}
+
+
+def test_daemon_reload_keeps_running_state(tmp_path):
+    config = tmp_path / 'backup.yml'
+    settings = {
+        'defaults': {'statedir': str(tmp_path / 'state'),
+                     'tmpdir': str(tmp_path / 'tmp'),
+                     'tmp_budget': 100, 'limits': {'dump': 1}},
+        'backups': [{'type': 'dir', 'path': str(tmp_path), 'name': 'dir',
+                     'every': '1h'}],
+        'vaults': {'s3': {'service': 's3', 'name': 'bucket'}},
+    }
+    config.write_text(yaml.safe_dump(settings))
+    daemon = coverme.Daemon({}, str(config))
+    assert daemon.reload()
+    prev = daemon.backup
+
+    # Running job holds temp space and dump slot while config changes
+    with prev.temp_space.reserve(80), prev.limits.acquire('dump'):
+        settings['defaults'].update(tmp_budget=200, max_jobs=2)
+        config.write_text(yaml.safe_dump(settings))
+        os.utime(str(config), (0, 0))
+        assert daemon.reload()
+        backup = daemon.backup
+        assert backup is not prev
+        assert backup.temp_space is prev.temp_space
+        assert backup.temp_space.reserved == 80
+        assert backup.temp_space.budget == 200
+        assert backup.limits is prev.limits
+        releases = []
+        started = threading.Thread(target=lambda: releases.extend(
+            backup.limits.reserve('dump', 1)))
+        started.start()
+        started.join(0.2)
+        assert started.is_alive()
+    started.join(1)
+    assert len(releases) == 1
+    releases[0]()
+
+    # Stopped daemon joins pool replaced on reload too, run in thread
+    # doesn't set signal handlers
+    old_pool = daemon._old_pools[0]
+    daemon.stop()
+    runner = threading.Thread(target=daemon.run)
+    runner.start()
+    runner.join(5)
+    assert old_pool._shutdown and daemon._old_pools == []
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import coverme
+
+
+def make_backup(tmp_path, **source):
+    src = tmp_path / 'src'
+    src.mkdir(exist_ok=True)
+    settings = {
+        'defaults': {
+            'statedir': str(tmp_path / 'state'),
+            'tmpdir': str(tmp_path / 'tmp'),
+            'localdir': str(tmp_path / 'local'),
+        },
+        'backups': [dict({
+            'type': 'dir', 'path': str(src), 'id': 'src', 'format': 'tar',
+            'name': 'src-{yyyy}{mm}{dd}{HH}{MM}{SS}{UU}', 'shards': 2,
+        }, **source)],
+        'vaults': {},
+    }
+    return coverme.Backup(settings, {}), src
+
+
+def local_files(tmp_path):
+    return sorted(path.name for path in (tmp_path / 'local').rglob('*')
+                  if path.is_file())
+
+
+def test_sharded_backup_pruned(tmp_path):
+    backup, src = make_backup(tmp_path, keep={'last': 1})
+    for i in range(4):
+        (src / ('f%d.txt' % i)).write_text('data %d' % i)
+    backup.run()
+    backup.run()
+    names = local_files(tmp_path)
+    assert len(names) == 3
+    assert len([name for name in names if name.endswith('.shards.json')]) == 1
+
+
+def test_sharded_backup_without_attachments(tmp_path, monkeypatch):
+    backup, src = make_backup(tmp_path)
+    (src / 'a.txt').write_text('data')
+    source = backup.sources[0]
+    pruned = []
+    monkeypatch.setattr(source, 'get_attachments', lambda: [])
+    monkeypatch.setattr(backup, '_prune_uploaded',
+                        lambda source, results: pruned.append(results))
+    backup.run()
+    assert list(pruned[0]) == [coverme.LOCAL_VAULT_KEY]
+    assert pruned[0][coverme.LOCAL_VAULT_KEY][0]
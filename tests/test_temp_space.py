@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+
+import pytest
+
+import coverme
+
+
+def make_space(tmp_path, budget=100, min_free=None):
+    return coverme.TempSpace(str(tmp_path / 'tmp'), budget=budget,
+                             min_free=min_free)
+
+
+def start(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_waits_when_over_budget(tmp_path):
+    space = make_space(tmp_path)
+    started = threading.Event()
+
+    def second():
+        with space.reserve(60):
+            started.set()
+
+    with space.reserve(60):
+        thread = start(second)
+        assert not started.wait(0.2)
+        assert space.reserved == 60 and space.running == 1
+    assert started.wait(2)
+    thread.join(2)
+    assert space.reserved == 0 and space.running == 0
+
+
+def test_larger_than_budget_runs_alone(tmp_path):
+    space = make_space(tmp_path)
+    with space.reserve(500):
+        assert space.reserved == 500
+    started = threading.Event()
+
+    def large():
+        with space.reserve(500):
+            started.set()
+
+    # Large source waits until running one is finished
+    with space.reserve(10):
+        thread = start(large)
+        assert not started.wait(0.2)
+    assert started.wait(2)
+    thread.join(2)
+    assert space.reserved == 0
+
+
+def test_released_on_failure(tmp_path):
+    space = make_space(tmp_path)
+    paths = []
+    with pytest.raises(ValueError):
+        with space.temp_dir(80) as temp_dir:
+            paths.append(temp_dir)
+            assert os.path.isdir(temp_dir)
+            raise ValueError("dump failed")
+    assert space.reserved == 0 and space.running == 0
+    assert not os.path.exists(paths[0])
+    # Space is free for the next source at once
+    with space.temp_dir(80):
+        assert space.reserved == 80
+
+
+def test_kept_dir_released(tmp_path):
+    space = make_space(tmp_path)
+    with pytest.raises(RuntimeError):
+        with space.temp_dir(80) as temp_dir:
+            space.keep(temp_dir)
+            raise RuntimeError("upload failed")
+    assert os.path.isdir(temp_dir) and space.reserved == 0
+
+
+def test_concurrent_reservations(tmp_path):
+    space = make_space(tmp_path)
+    lock = threading.Lock()
+    peaks = []
+    active = [0]
+
+    def run():
+        with space.temp_dir(30):
+            with lock:
+                active[0] += 30
+                peaks.append(active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 30
+
+    threads = [start(run) for _ in range(12)]
+    for thread in threads:
+        thread.join(5)
+    assert len(peaks) == 12 and max(peaks) <= 90
+    assert space.reserved == 0 and space.running == 0
+    assert os.listdir(space.base_dir) == []
+
+
+def test_not_enough_free_space(tmp_path):
+    space = make_space(tmp_path, budget=None, min_free=2 ** 62)
+    with pytest.raises(RuntimeError, match='Not enough free space'):
+        with space.reserve(1):
+            pass
+    assert space.reserved == 0 and space.running == 0
+
+
+def test_update_wakes_waiting(tmp_path):
+    space = make_space(tmp_path)
+    started = threading.Event()
+
+    def second():
+        with space.reserve(60):
+            started.set()
+
+    with space.reserve(60):
+        thread = start(second)
+        assert not started.wait(0.2)
+        space.update(budget=200)
+        assert started.wait(2)
+    thread.join(2)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+
+import pytest
+
+import coverme
+
+MB = 1024 * 1024
+
+
+def reference_tree_hash(data):
+    """Tree hash computed level by level, as described by AWS."""
+    hashes = [hashlib.sha256(data[i:i + MB]).digest()
+              for i in range(0, len(data), MB)]
+    while len(hashes) > 1:
+        pairs = [hashes[i:i + 2] for i in range(0, len(hashes), 2)]
+        hashes = [hashlib.sha256(b''.join(pair)).digest()
+                  if len(pair) == 2 else pair[0] for pair in pairs]
+    return hashes[0].hex()
+
+
+@pytest.mark.parametrize('size', [
+    1, MB - 1, MB, MB + 1, 2 * MB, 3 * MB, 5 * MB + 10, 7 * MB, 8 * MB,
+    9 * MB + 1,
+])
+def test_tree_hash(size):
+    data = os.urandom(size)
+    tree_hash = coverme.TreeHash()
+    tree_hash.update_data(data)
+    assert tree_hash.hexdigest() == reference_tree_hash(data)
+
+
+def test_tree_hash_by_parts():
+    # Parts are multiples of 1 MB, as Glacier multipart upload requires
+    data = os.urandom(5 * MB + 100)
+    tree_hash = coverme.TreeHash()
+    for i in range(0, len(data), 2 * MB):
+        tree_hash.update_data(data[i:i + 2 * MB])
+    assert tree_hash.hexdigest() == reference_tree_hash(data)